@@ -0,0 +1,324 @@
+#!/usr/bin/python
+# This is distributed under cc0. See the LICENCE file distributed along with
+# this code.
+
+"""Estimate how a client will do in a scenario without simulating it.
+
+   We model a single client as a small Markov chain with one step per
+   circuit attempt.  The state is how many guards the client has picked
+   (n, up to the most it is allowed, K) and what it is doing with them:
+
+       G   using a good guard that is alive
+       E   using an evil guard
+       D   using a guard that has died (killed by churn or a sniper)
+       W   every guard it has is marked down; waiting to retry or add one
+       A   (prop259 only) just added guard n, which costs a failed attempt
+
+   Since relays' bandwidth doesn't depend on whether they're evil, every
+   new guard is evil with probability pevil, independently.  Relay
+   reliability, churn and the decorators' probabilities give each step's
+   chance of success and of the guard dying.  The chain is run forward for
+   the length of the simulation (it usually reaches its stationary
+   distribution after a few hundred steps, after which we stop iterating),
+   accumulating the expected number of successful circuits and of guards
+   added.
+
+   Relays only go up and down once per two-minute tick, and a client that
+   finds its guard down moves to another one for the rest of the tick, so
+   we spread each tick's chance of a relay being down over its attempts.
+
+   The chain ignores several things the simulator does: the client's
+   dystopia detection (we treat the dystopic guard list as K more guards
+   of the same kind, and under a FascistNetwork we charge a prop259 client
+   for burning through its utopic guards up front), and exactly when the
+   primary-guard retry timer fires.  Run with --validate to see how far
+   off that makes it for a given scenario before trusting it to prune a
+   sweep.
+
+       ./lib/analytic.py SPEC
+       ./lib/analytic.py SPEC --validate 20 -j 4
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import time
+
+from math import floor
+from multiprocessing import Pool
+
+from py3hax import *
+import client
+import replicate
+import scenario
+import tornet
+
+
+# Circuit attempts per simulated hour, attempts per tick of relays going
+# up and down, and churns per hour, as in scenario.runClient().
+ATTEMPTS_PER_HOUR = 180
+ATTEMPTS_PER_TICK = 6
+CHURNS_PER_HOUR = 3600 // scenario.CHURN_INTERVAL
+
+# Stop iterating the chain once the distribution moves less than this.
+CONVERGED = 1e-8
+
+G, E, D, W, A = range(5)
+N_KINDS = 5
+
+
+class GuardChain(object):
+    """The Markov chain for one client in one scenario."""
+
+    def __init__(self, scen, params):
+        """'scen' is a scenario dict, as for scenario.scenarioArgs(), and
+           'params' a client.ClientParams."""
+        args = scenario.scenarioArgs(scen)
+        nNodes = args.total_relays or scenario.NETWORK_SIZE
+
+        # The decorators' probabilities, as decorateNetwork() sets them up.
+        f = tornet.FLAKY_RELIABILITY if args.flaky_network else 1.0
+        block = tornet.P_BLOCK_GOOD if args.evil_filtering else 0.0
+        kill = tornet.P_KILL_GOOD if args.sniper_network else 0.0
+
+        # Chance that a guard dies to churn in any one step.
+        churn = (CHURNS_PER_HOUR * tornet.meanChurnKills(tornet.AVGDEL) /
+                 nNodes / ATTEMPTS_PER_HOUR)
+
+        # Guards we burn through before the chain starts, and the failed
+        # attempts that costs.
+        self._burned = 0
+        self._prop259 = params.PROP259
+        if self._prop259:
+            running = nNodes * tornet.NODE_RELIABILITY
+            perList = max(1, int(floor(running *
+                                       params.UTOPIC_GUARDS_THRESHOLD)))
+            if args.fascist_firewall:
+                # We only get to use the dystopic list.
+                self._K = perList
+                self._burned = perList
+            else:
+                self._K = 2 * perList
+        else:
+            self._K = params.N_PRIMARY_GUARDS
+            if args.fascist_firewall:
+                # A prop241 client never looks beyond the utopic guards,
+                # none of which it can reach.
+                f = 0.0
+        self._qE = tornet.PEVIL
+
+        # Chance that each probe of a good or evil guard gets an answer.
+        up = 1 - (1 - tornet.NODE_RELIABILITY) / ATTEMPTS_PER_TICK
+        aG = up * f * (1 - block)
+        aE = up * f
+        self._success = {G: aG, E: aE}
+        self._keep = {G: (1 - kill) * (1 - churn), E: 1 - churn}
+        self._churn = churn
+
+    def _index(self, n, kind):
+        return (n - 1) * N_KINDS + kind
+
+    def _fresh(self, n, prob):
+        """Transitions to a newly picked guard n, with total probability
+           'prob'."""
+        return [ (self._index(n, E), prob * self._qE),
+                 (self._index(n, G), prob * (1 - self._qE)) ]
+
+    def _fail(self, n, kind, retrying):
+        """Return (transitions, expected adds) for an attempt on guard n that
+           failed, with total probability 1."""
+        K = self._K
+        if not self._prop259:
+            if kind == D:
+                # A dead guard drops out of the consensus, so it no longer
+                # counts against the number of listed guards.
+                return self._fresh(n, 1.0), 1.0
+            if n < K:
+                return self._fresh(n + 1, 1.0), 1.0
+            return [ (self._index(K, W), 1.0) ], 0.0
+        if retrying:
+            return [ (self._index(n, W), 1.0) ], 0.0
+        if n < K:
+            return [ (self._index(n + 1, A), 1.0) ], 1.0
+        return [ (self._index(K, W), 1.0) ], 0.0
+
+    def _build(self, retrying):
+        """Return a list, indexed by state, of (transitions, success
+           probability, expected guards added).  If 'retrying', a prop259
+           client retries all its primary guards whenever none are usable
+           (which it does after its first hour)."""
+        K = self._K
+        states = [ None ] * (K * N_KINDS)
+        for n in xrange(1, K + 1):
+            for kind in (G, E):
+                s = self._success[kind]
+                keep = self._keep[kind]
+                trans = [ (self._index(n, kind), s * keep),
+                          (self._index(n, D), s * (1 - keep)) ]
+                failTrans, adds = self._fail(n, kind, retrying)
+                trans += [ (dst, p * (1 - s)) for dst, p in failTrans ]
+                states[self._index(n, kind)] = (trans, s, adds * (1 - s))
+
+            failTrans, adds = self._fail(n, D, retrying)
+            states[self._index(n, D)] = (failTrans, 0.0, adds)
+
+            states[self._index(n, A)] = (self._fresh(n, 1.0), 0.0, 0.0)
+
+            states[self._index(n, W)] = self._wait(n, retrying)
+        return states
+
+    def _wait(self, n, retrying):
+        """The transitions out of state (n, W)."""
+        here = self._index(n, W)
+        if not self._prop259:
+            # Nothing happens until one of our guards drops out of the
+            # consensus, making room for another.
+            leave = min(1.0, n * self._churn)
+            return ([ (here, 1 - leave) ] + self._fresh(n, leave), 0.0, leave)
+        if not retrying:
+            return [ (here, 1.0) ], 0.0, 0.0
+
+        # We retry all n guards, and use the first one that works.  Treat
+        # them as independent draws of the kinds of guard we pick.
+        qE = self._qE
+        sG = self._success[G]
+        sE = self._success[E]
+        aliveG = (1 - qE) * self._keep[G]
+        perGuard = qE * sE + aliveG * sG
+        anyWorks = 1 - (1 - perGuard) ** n
+        trans = []
+        if perGuard > 0:
+            pE = anyWorks * qE * sE / perGuard
+            pG = anyWorks - pE
+            trans += [ (self._index(n, E), pE),
+                       (self._index(n, G), pG * self._keep[G]),
+                       (self._index(n, D), pG * (1 - self._keep[G])) ]
+        # If none of them work because they have all died, we'll add
+        # another guard instead.
+        allDead = (1 - qE - aliveG) ** n
+        adds = 0.0
+        if n < self._K and allDead > 0:
+            trans.append((self._index(n + 1, A), allDead))
+            adds = allDead
+        trans.append((here, 1 - anyWorks - adds))
+        return trans, anyWorks, adds
+
+    def _run(self, states, dist, steps):
+        """Advance 'dist' by 'steps' steps of the chain 'states'.  Return
+           the new distribution and the expected successes and guards added
+           along the way."""
+        successes = 0.0
+        adds = 0.0
+        for step in xrange(steps):
+            new = [ 0.0 ] * len(dist)
+            stepSuccess = 0.0
+            stepAdds = 0.0
+            for i, p in enumerate(dist):
+                if p == 0.0:
+                    continue
+                trans, s, a = states[i]
+                stepSuccess += p * s
+                stepAdds += p * a
+                for dst, q in trans:
+                    new[dst] += p * q
+            successes += stepSuccess
+            adds += stepAdds
+            moved = sum(abs(x - y) for x, y in zip(new, dist))
+            dist = new
+            if moved < CONVERGED:
+                # Every remaining step will look just like this one.
+                remaining = steps - step - 1
+                successes += stepSuccess * remaining
+                adds += stepAdds * remaining
+                break
+        return dist, successes, adds
+
+    def estimate(self, hours=30):
+        """Return a dict with the expected success rate and number of guards
+           picked over 'hours' simulated hours."""
+        dist = [ 0.0 ] * (self._K * N_KINDS)
+        if self._prop259:
+            dist[self._index(1, A)] = 1.0
+        else:
+            for dst, p in self._fresh(1, 1.0):
+                dist[dst] = p
+        adds = 1.0 + self._burned
+
+        # Each burned guard costs an attempt to add it and one to try it.
+        total = hours * ATTEMPTS_PER_HOUR
+        steps = max(0, total - 2 * self._burned)
+        first = min(steps, ATTEMPTS_PER_HOUR)
+        dist, s1, a1 = self._run(self._build(False), dist, first)
+        retrying = self._prop259
+        dist, s2, a2 = self._run(self._build(retrying), dist, steps - first)
+
+        return {
+            "success_rate": (s1 + s2) / total,
+            "guards_added": adds + a1 + a2,
+        }
+
+
+def estimate(scen, params, hours=30):
+    """Return the chain's estimates for 'scen' (a scenario dict) and
+       'params' (a dict of client.ClientParams keywords)."""
+    return GuardChain(scen, client.ClientParams(**params)).estimate(hours)
+
+
+def validate(scen, params, replicates, hours=30, pool=None):
+    """Compare estimate() with 'replicates' runs of the simulator.  Return
+       a dict mapping each metric to (estimate, simulated mean, confidence
+       interval half-width)."""
+    est = estimate(scen, params, hours)
+    stats = dict((metric, replicate.RunningStats()) for metric in est)
+    jobs = [ (seed, scen, params, seed, hours)
+             for seed in xrange(replicates) ]
+    for _, result in replicate._runJobs(jobs, pool):
+        for metric in stats:
+            stats[metric].add(result[metric])
+    return dict((metric, (est[metric], stats[metric].mean(),
+                          stats[metric].halfWidth()))
+                for metric in est)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Estimate client outcomes for every cell of a sweep.")
+    parser.add_argument("spec", help="A JSON file describing the sweep.")
+    parser.add_argument(
+        "--validate", type=int, default=0, metavar="N",
+        help="Also run N replicates of each cell to compare against.")
+    parser.add_argument(
+        "-j", "--workers", type=int, default=0,
+        help="Run validation replicates in this many worker processes.")
+    args = parser.parse_args(argv)
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+    hours = spec.get("hours", 30)
+    pool = Pool(args.workers) if args.workers else None
+
+    for scenName in sorted(spec["scenarios"]):
+        for paramsName in sorted(spec["params"]):
+            scen = spec["scenarios"][scenName]
+            params = spec["params"][paramsName]
+            name = "%s/%s" % (scenName, paramsName)
+            if not args.validate:
+                started = time.time()
+                est = estimate(scen, params, hours)
+                print("%-30s success_rate=%.5f guards_added=%.2f (%.1f ms)"
+                      % (name, est["success_rate"], est["guards_added"],
+                         (time.time() - started) * 1000))
+                continue
+            result = validate(scen, params, args.validate, hours, pool)
+            print(name)
+            for metric, (est, mean, hw) in sorted(result.items()):
+                print("    %-14s estimate=%-10.5g simulated=%.5g+-%.3g"
+                      % (metric, est, mean, hw))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# This is distributed under cc0. See the LICENCE file distributed along with
+# this code.
+
+"""Models of how much bandwidth relays have, in KB/s.
+
+   A tornet.Network draws every node's bandwidth from one of these when
+   the node is created, a whole batch at a time, and can make the
+   bandwidths drift a little with every consensus so that the ordering of
+   relays by bandwidth changes over time the way it does on the real
+   network.
+
+   The empirical model reads measured bandwidths from a file: either one
+   number per line, or a consensus document, whose "w Bandwidth=N" lines
+   we use.
+"""
+
+from __future__ import print_function
+
+import bisect
+import math
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from py3hax import *
+
+
+class BandwidthModel(object):
+    """Base class for distributions of relay bandwidths."""
+
+    def sample(self, n, rng=random):
+        """Return a list of 'n' bandwidths, as positive ints, drawn using the
+           random.Random 'rng'."""
+        raise NotImplementedError()
+
+
+class GammaModel(BandwidthModel):
+    """The simulator's original, completely made-up distribution: a gamma
+       distribution scaled by 'scale'."""
+
+    def __init__(self, alpha=1.0, beta=0.5, scale=100000):
+        self._alpha = alpha
+        self._beta = beta
+        self._scale = scale
+
+    def sample(self, n, rng=random):
+        alpha, beta, scale = self._alpha, self._beta, self._scale
+        return [ max(1, int(rng.gammavariate(alpha, beta) * scale))
+                 for _ in xrange(n) ]
+
+
+class LognormalModel(BandwidthModel):
+    """A lognormal distribution, which fits the long tail of real relay
+       bandwidths much better than a gamma distribution does."""
+
+    def __init__(self, median=5000, sigma=1.5):
+        self._mu = math.log(median)
+        self._sigma = sigma
+
+    def sample(self, n, rng=random):
+        mu, sigma = self._mu, self._sigma
+        return [ max(1, int(rng.lognormvariate(mu, sigma)))
+                 for _ in xrange(n) ]
+
+
+class EmpiricalModel(BandwidthModel):
+    """The distribution of a list of measured bandwidths.  We sample from
+       its empirical CDF, interpolating between the measured values."""
+
+    def __init__(self, bandwidths):
+        values = sorted(float(bw) for bw in bandwidths if bw > 0)
+        if not values:
+            raise ValueError("No bandwidths to build a model from")
+        self._values = values
+        # The cumulative probability at each of the values.
+        n = len(values)
+        self._cdf = [ (i + 0.5) / n for i in xrange(n) ]
+
+    @classmethod
+    def fromFile(cls, path):
+        """Load the bandwidths listed in the file 'path'."""
+        bandwidths = []
+        with open(path) as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if not line:
+                    continue
+                if line.startswith("w "):
+                    for item in line.split()[1:]:
+                        if item.startswith("Bandwidth="):
+                            bandwidths.append(int(item[len("Bandwidth="):]))
+                elif line[0].isdigit():
+                    bandwidths.append(float(line))
+        return cls(bandwidths)
+
+    def _fromUniform(self, u):
+        values, cdf = self._values, self._cdf
+        i = bisect.bisect_left(cdf, u)
+        if i == 0:
+            return values[0]
+        if i == len(cdf):
+            return values[-1]
+        frac = (u - cdf[i - 1]) / (cdf[i] - cdf[i - 1])
+        return values[i - 1] + frac * (values[i] - values[i - 1])
+
+    def sample(self, n, rng=random):
+        uniforms = [ rng.random() for _ in xrange(n) ]
+        if numpy is not None:
+            drawn = numpy.interp(uniforms, self._cdf, self._values)
+        else:
+            drawn = [ self._fromUniform(u) for u in uniforms ]
+        return [ max(1, int(bw)) for bw in drawn ]
+
+
+MODELS = {
+    "gamma": GammaModel,
+    "lognormal": LognormalModel,
+}
+
+def makeModel(name="gamma", path=None):
+    """Return the BandwidthModel called 'name', or, if 'path' is given, an
+       EmpiricalModel of the bandwidths in the file 'path'."""
+    if path:
+        return EmpiricalModel.fromFile(path)
+    if name not in MODELS:
+        raise ValueError("Unknown bandwidth model %r" % name)
+    return MODELS[name]()
+
+
+def drift(current, base, sigma, reversion=0.1, rng=random):
+    """Return a list of new bandwidths, one for each of the bandwidths in
+       'current', after one consensus period of drift.
+
+       Each bandwidth does a random walk in log space with step size
+       'sigma', pulled back towards the matching bandwidth in 'base' by a
+       fraction 'reversion' of the distance each time, so relays reorder
+       without the distribution as a whole wandering off.
+    """
+    gauss = rng.gauss
+    keep = 1.0 - reversion
+    return [ max(1, int(b * math.exp(keep * math.log(float(c) / b) +
+                                     gauss(0, sigma))))
+             for c, b in zip(current, base) ]
+
+
+def stationary(base, sigma, reversion=0.1, rng=random):
+    """Return a list of bandwidths drawn from where drift() would leave the
+       bandwidths 'base' after running for a long time: in log space, a
+       normal distribution around each base bandwidth, with variance
+       sigma**2 / (1 - (1 - reversion)**2)."""
+    keep = 1.0 - reversion
+    spread = sigma / math.sqrt(1.0 - keep * keep)
+    gauss = rng.gauss
+    return [ max(1, int(b * math.exp(gauss(0, spread)))) for b in base ]
@@ -6,13 +6,14 @@
 
 from __future__ import print_function
 
-import random
+import marshal
 
 from functools import partial
 from math import floor
 
 from py3hax import *
-from tornet import compareNodeBandwidth
+import events
+import simloop
 import simtime
 
 
@@ -24,8 +25,11 @@ class ExponentialTimer(object):
 
         After it first fires, it won't be ready again until **initial** seconds
         have passed.  Each time after that, it will increase the delay by a
-        factor of **multiplier**.
+        factor of **multiplier**.  Time is kept by the simtime.SimClock given
+        as the keyword argument **clock**, or by the default one.
         """
+        clock = kwargs.pop("clock", None)
+        self._clock = clock if clock is not None else simtime.DEFAULT.clock
         self._initial_delay = initial
         self._multiplier = multiplier
         self._paused = False
@@ -55,16 +59,24 @@ class ExponentialTimer(object):
         """Return true iff the timer is ready to fire now."""
         if self._paused:
             return False
-        return self._next <= simtime.now()
+        return self._next <= self._clock.now()
 
     def fire(self):
         """Fire the timer."""
         assert self.isReady()
-        self._next = simtime.now() + self._cur_delay
+        self._next = self._clock.now() + self._cur_delay
         self._cur_delay *= self._multiplier
 
         self.fireAction()
 
+    def getState(self):
+        """Return the timer's phase as a tuple of plain values."""
+        return (self._next, self._cur_delay, self._paused)
+
+    def setState(self, state):
+        """Restore a phase previously returned by :meth:`getState`."""
+        self._next, self._cur_delay, self._paused = state
+
 
 class ClientParams(object):
     """Represents the configuration parameters of the client algorithm, as given
@@ -77,7 +89,13 @@ class ClientParams(object):
                  RETRY_MULT=2,
                  PROP241=False,
                  PROP259=False,
-                 PRIORITIZE_BANDWIDTH=True):
+                 PRIORITIZE_BANDWIDTH=True,
+                 N_PRIMARY_GUARDS=3,
+                 PARALLEL_GUARD_ATTEMPTS=1,
+                 UTOPIC_GUARDS_THRESHOLD=None,
+                 DYSTOPIC_GUARDS_THRESHOLD=None,
+                 UTOPIC_GUARDLIST_FAILOVER_THRESHOLD=None,
+                 DYSTOPIC_GUARDLIST_FAILOVER_THRESHOLD=None):
 
         # prop241: if we have seen this many guards...
         self.TOO_MANY_GUARDS = TOO_MANY_GUARDS
@@ -109,13 +127,30 @@ class ClientParams(object):
             # that the network is down.
             self.DYSTOPIC_GUARDLIST_FAILOVER_THRESHOLD = 1.00
 
+        # Any thresholds we were given explicitly override the proposal's
+        # defaults above.
+        for name, value in (
+                ("UTOPIC_GUARDS_THRESHOLD", UTOPIC_GUARDS_THRESHOLD),
+                ("DYSTOPIC_GUARDS_THRESHOLD", DYSTOPIC_GUARDS_THRESHOLD),
+                ("UTOPIC_GUARDLIST_FAILOVER_THRESHOLD",
+                 UTOPIC_GUARDLIST_FAILOVER_THRESHOLD),
+                ("DYSTOPIC_GUARDLIST_FAILOVER_THRESHOLD",
+                 DYSTOPIC_GUARDLIST_FAILOVER_THRESHOLD)):
+            if value is not None:
+                setattr(self, name, value)
+
         # From asn's post and prop259.  This should be a consensus parameter.
         # It stores the number of guards in {U,DYS}TOPIC_GUARDLIST which we
         # (strongly) prefer connecting to above all others.  The ones which we
         # prefer connecting to are those at the top of the
         # {U,DYS}TOPIC_GUARDLIST when said guardlist is ordered in terms of the
         # nodes' measured bandwidth as listed in the most recent consensus.
-        self.N_PRIMARY_GUARDS = 3
+        self.N_PRIMARY_GUARDS = N_PRIMARY_GUARDS
+
+        # How many guards we try to connect to at once.  If this is 1, we
+        # try them one after another; otherwise, the first guard to answer
+        # wins and we abandon the other attempts.
+        self.PARALLEL_GUARD_ATTEMPTS = PARALLEL_GUARD_ATTEMPTS
 
         # If True, select higher bandwidth guards (rather than random ones) when
         # choosing a new guard.
@@ -125,10 +160,13 @@ class ClientParams(object):
 class Guard(object):
     """Represents what a client knows about a guard."""
 
-    def __init__(self, node):
+    def __init__(self, node, clock=None):
         # tornet.Node instance
         self._node = node
 
+        # the simtime.SimClock our client keeps time with.
+        self._clock = clock if clock is not None else simtime.DEFAULT.clock
+
         # True iff we have marked this node as down.
         self._markedDown = False
 
@@ -139,7 +177,7 @@ class Guard(object):
         self._tried = False
 
         # When did we add it (simulated)?
-        self._addedAt = simtime.now()
+        self._addedAt = self._clock.now()
 
         # True iff the node is listed as a guard in the most recent consensus
         self._listed = True
@@ -205,47 +243,78 @@ class Guard(object):
         """Return ``True`` iff this guard was added within the last **nSec**
         simulated seconds.
         """
-        return self._addedAt + nSec >= simtime.now()
+        return self._addedAt + nSec >= self._clock.now()
+
+    def getState(self):
+        """Return everything a client persists about this guard, as a tuple
+        of plain values.  The node is recorded by its ID.
+        """
+        return (self._node.getID(), self._markedDown, self._markedUp,
+                self._tried, self._addedAt, self._listed)
+
+    @classmethod
+    def fromState(cls, state, node, clock=None):
+        """Create a Guard for **node**, keeping time with **clock**, from a
+        tuple returned by :meth:`getState`.
+        """
+        guard = cls(node, clock)
+        (_, guard._markedDown, guard._markedUp,
+         guard._tried, guard._addedAt, guard._listed) = state
+        return guard
 
 
 class Client(object):
     """A stateful client implementation of the guard selection algorithm."""
 
-    def __init__(self, network, parameters):
+    # Bump this whenever the layout of the tuple built by getState() changes.
+    STATE_VERSION = 1
+
+    def __init__(self, network, parameters, eventLog=None, clientID=-1,
+                 policy=None, paths=None):
 
         # a torsim.Network object.
         self._net = network
 
+        # the simtime.Simulation the network belongs to: we keep time with
+        # its clock, and make our random choices with its generator.
+        self._sim = network.getSimulation()
+        self._clock = self._sim.clock
+        self._rng = self._sim.rng
+
         # a ClientParams object
         self._p = parameters
 
-        # lists of current guards in the consensus from the dystopic and
+        # an events.EventWriter to record what we do in, or None; and the
+        # number we're known by there.
+        self._events = eventLog
+        self._clientID = clientID
+
+        # a tornet.ReachabilityPolicy (or MiddleboxPolicy) describing what
+        # we've been configured to think our firewall allows, or None to
+        # assume it's a FascistFirewall.  It decides which guards are dystopic.
+        self._policy = policy
+
+        # a paths.PathBuilder to extend our circuits past the guard with, or
+        # None to count a circuit as built once we reach the guard.
+        self._paths = paths
+
+        # tuples of current guards in the consensus from the dystopic and
         # utopic sets.  each guard is represented here as a torsim.Node.
         self._DYSTOPIC_GUARDS = self._UTOPIC_GUARDS = None
 
-        # The Node.getID() results for every relay with the Guard flag from
-        # the most recent consensus.
-        self._ALL_GUARD_NODE_IDS = set()
+        # The most recent tornet.Consensus we've received.  It's shared with
+        # other clients, so we must never modify it.
+        self._consensus = None
 
         # The number of listed primary guards that we prioritise connecting to.
-        self.NUM_PRIMARY_GUARDS = 3  # chosen by dice roll, guaranteed to be random
+        self.NUM_PRIMARY_GUARDS = parameters.N_PRIMARY_GUARDS
 
         # lists of Guard objects for the dystopic and utopic guards
         # configured on this client.
         self._PRIMARY_DYS = []
         self._PRIMARY_U = []
 
-        self._networkDownRetryTimer = ExponentialTimer(
-            parameters.RETRY_DELAY,
-            parameters.RETRY_MULT,
-            self.retryNetwork,
-        )
-        self._networkDownRetryTimer.pause()
-
-        self._primaryGuardsRetryTimer = ExponentialTimer(
-            3600, # 60 minutes
-            0,    # linear?
-            self.retryPrimaryGuards)
+        self._makeTimers()
 
         # Internal state for whether we think we're on a dystopic network
         self._dystopic = False
@@ -253,10 +322,98 @@ class Client(object):
 
         self.updateGuardLists()
 
-        # Statistics keeping variables:
+        self._resetStats()
+
+    def _resetStats(self):
+        """Start all our statistics afresh, as of now."""
         self._GUARD_BANDWIDTHS = []
         self._CIRCUIT_FAILURES_TOTAL = 0
         self._CIRCUIT_FAILURES = 0
+        # Simulated time of our first successful circuit, if any.
+        self._FIRST_CIRCUIT_AT = None
+        # Circuits that reached the guard but failed at a later hop.
+        self._PATH_FAILURES = 0
+        # Simulated seconds spent waiting for guard connections: during the
+        # circuit we're building, and in total.  Also, how long after we
+        # started our first circuit was finished.
+        self._connectTime = 0.0
+        self._CONNECT_TIME_TOTAL = 0.0
+        self._BOOTSTRAP_LATENCY = None
+        # The guard getGuard() has just connected to for this circuit, if
+        # it did, so that buildCircuit() doesn't connect to it again.
+        self._connectedGuard = None
+
+        # Exposure statistics, kept up to date on every circuit so that they
+        # cost the same however long we run.  See exposure().
+        self._STARTED_AT = self._clock.now()
+        self._CIRCUITS_BUILT = 0
+        self._EVIL_CIRCUITS = 0
+        self._FIRST_EVIL_AT = None
+        self._GUARDS_CONTACTED = set()
+        self._LAST_GUARD = None
+        self._GUARD_SWITCHES = 0
+
+    def warmStart(self, age, deathRate):
+        """Give this client the primary guards it might well have if it had
+        already been running for **age** simulated seconds, on a network
+        where each relay dies at the rate **deathRate** per second, so that
+        measurements can start straight away instead of after a burn-in.
+
+        We pick guards in the order :meth:`addNewGuard` would, each one
+        added when the one before it died.  Those that died before now are
+        replaced with dead copies (see tornet.Network.makeGhost()), marked
+        down and unlisted; the last one is still on the network, and marked
+        up iff the current consensus lists it.
+
+        That is only what happens to a prop259 client whose guards are lost
+        to churn alone.  A prop241 client also adds guards whenever its
+        primary guards are all down, and any client adds more if its local
+        network keeps it from its guards; neither is modelled, so we
+        refuse prop241 clients, and callers must not warm start clients
+        behind a lossy local network (see scenario.warmStartClient()).
+        """
+        if not self.conformsToProp259:
+            raise ValueError("Warm starts only model prop259 clients")
+        now = self._clock.now()
+        lst = self.currentPrimaryGuards
+        candidates = [ n for n in self.getFullList()
+                       if not self.nodeIsInGuardList(n, lst) ]
+        if not self._p.PRIORITIZE_BANDWIDTH:
+            self._rng.shuffle(candidates)
+
+        addedAt = now - age
+        for node in candidates:
+            lifetime = (self._rng.expovariate(deathRate) if deathRate > 0
+                        else float("inf"))
+            died = addedAt + lifetime < now
+            if died:
+                node = self._net.makeGhost(node)
+            guard = Guard(node, self._clock)
+            guard._addedAt = addedAt
+            guard._tried = True
+            guard._listed = not died and self._consensus.isListed(node)
+            guard._markedUp = guard._listed
+            guard._markedDown = not guard._listed
+            lst.append(guard)
+            if not died:
+                break
+            addedAt += lifetime
+
+    def _makeTimers(self):
+        """(Re)create our retry timers in their initial state."""
+        self._networkDownRetryTimer = ExponentialTimer(
+            self._p.RETRY_DELAY,
+            self._p.RETRY_MULT,
+            self.retryNetwork,
+            clock=self._clock,
+        )
+        self._networkDownRetryTimer.pause()
+
+        self._primaryGuardsRetryTimer = ExponentialTimer(
+            3600, # 60 minutes
+            0,    # linear?
+            self.retryPrimaryGuards,
+            clock=self._clock)
 
     @property
     def _state(self):
@@ -349,6 +506,9 @@ class Client(object):
         :param bool dystopic: Should be ``True`` if we think we're on
             a dystopic network, and ``False`` otherwise.
         """
+        if self._events is not None and self._dystopic != bool(dystopic):
+            self._events.record(events.DYSTOPIA, value=bool(dystopic),
+                                client=self._clientID)
         self._dystopic = bool(dystopic)
         if self._dystopic:
             print("We're in a dystopia...")
@@ -366,6 +526,9 @@ class Client(object):
         :param bool utopic: Should be ``True`` if we think we're on
             a *non-dystopic* network, and ``False`` otherwise.
         """
+        if self._events is not None and self._dystopic != (not utopic):
+            self._events.record(events.DYSTOPIA, value=not utopic,
+                                client=self._clientID)
         self._dystopic = not bool(utopic)
         if not self._dystopic:
             print("We're in a utopia...")
@@ -396,6 +559,10 @@ class Client(object):
             self._resetCircuitFailureCount()
             self._networkDownRetryTimer.pause()
 
+        if (self._events is not None and
+                self._networkAppearsDown != bool(isDown)):
+            self._events.record(events.NETWORK_DOWN, value=bool(isDown),
+                                client=self._clientID)
         self._networkAppearsDown = bool(isDown)
 
     @property
@@ -465,37 +632,39 @@ class Client(object):
         return True
 
     def updateGuardLists(self):
-        """Called at start and when a new consensus should be made & received:
+        """Called at start and whenever a new consensus has been published:
            updates *TOPIC_GUARDS."""
-        self._DYSTOPIC_GUARDS = []
-        self._UTOPIC_GUARDS = []
-
         # XXXX I'm not sure what happens if a node changes its ORPort
         # XXXX or when the client changes its policies.
 
-        # We get the latest consensus here.
-        for node in self._net.new_consensus():
-            self._ALL_GUARD_NODE_IDS.add(node.getID())
-            if node.seemsDystopic():
-                self._DYSTOPIC_GUARDS.append(node)
-            else:
-                # XXXX Having this be 'else' means that FirewallPorts
-                # XXXX has affect even when FascistFirewall is disabled.
-                # XXXX Interesting!  And maybe bad!
-                self._UTOPIC_GUARDS.append(node)
+        # We get the latest consensus here.  It comes already split into
+        # utopic and dystopic lists, sorted from highest bandwidth to lowest.
+        self._consensus = self._net.get_consensus()
+        if self._policy is None:
+            self._UTOPIC_GUARDS = self._consensus.getUtopicGuards()
+            self._DYSTOPIC_GUARDS = self._consensus.getDystopicGuards()
+        else:
+            self._UTOPIC_GUARDS, self._DYSTOPIC_GUARDS = \
+                self._policy.partition(self._consensus, self._net)
 
-        # Sort the lists from highest bandwidth to lowest.
-        self._UTOPIC_GUARDS.sort(cmp=compareNodeBandwidth, reverse=True)
-        self._DYSTOPIC_GUARDS.sort(cmp=compareNodeBandwidth, reverse=True)
+        self._markGuardsListed()
 
-        # Now mark every Guard we have as listed or unlisted.
+    def _markGuardsListed(self):
+        """Mark every Guard we have as listed or unlisted."""
         for lst in (self._PRIMARY_DYS, self._PRIMARY_U):
             for g in lst:
-                if g.node.getID() in self._ALL_GUARD_NODE_IDS:
+                if self._consensus.isListed(g.node):
                     g.markListed()
                 else:
                     g.markUnlisted()
 
+    def seemsDystopic(self, node):
+        """Return true iff 'node' seems like one we could use in a dystopic
+           world, as far as our firewall configuration goes."""
+        if self._policy is None:
+            return node.seemsDystopic()
+        return self._policy.seemsDystopic(node, self._net)
+
     def getFullList(self):
         """Get the list of possible Nodes from the consensus for a given
            dystopia setting"""
@@ -528,7 +697,7 @@ class Client(object):
         if self._p.PRIORITIZE_BANDWIDTH:
             node = unused[0]
         else:
-            node = random.choice(unused)
+            node = self._rng.choice(unused)
         self.addGuard(node)
 
     def addGuard(self, node, dystopic=False):
@@ -537,13 +706,17 @@ class Client(object):
             if not self.checkFailoverThreshold():
                 return None
 
-        guard = Guard(node)
+        guard = Guard(node, self._clock)
         print(("Picked new (%stopic) guard: %s" %
-               ("dys" if node.seemsDystopic() else "u", guard)))
+               ("dys" if self.seemsDystopic(node) else "u", guard)))
 
         lst = self.currentPrimaryGuards
         lst.append(guard)
 
+        if self._events is not None:
+            self._events.record(events.GUARD_ADDED, node.getIndex(),
+                                self.seemsDystopic(node), self._clientID)
+
     def nodeIsInGuardList(self, n, gl):
         """Return true iff there is a Guard in 'gl' corresponding to the Node
            'n'."""
@@ -554,6 +727,9 @@ class Client(object):
 
     def markGuard(self, guard, up):
         guard.mark(up)
+        if self._events is not None:
+            self._events.record(events.GUARD_MARKED, guard.node.getIndex(),
+                                up, self._clientID)
 
         # If a utopic guard is up, and we previously thought we were in a
         # dystopia, then we must have left the dystopia.
@@ -561,7 +737,7 @@ class Client(object):
             if self.networkAppearsDown:
                 self.networkAppearsDown = False
 
-            if not guard.node.seemsDystopic() and self.inADystopia:
+            if not self.seemsDystopic(guard.node) and self.inADystopia:
                 print("A utopic guard suddenly worked while we thought we were "
                       "in a dystopia...")
                 self.inAUtopia = True
@@ -657,7 +833,7 @@ class Client(object):
             possible = [ n for n in full if not self.nodeIsInGuardList(n, lst) ]
             if len(possible) == 0:
                 return None
-            newnode = random.choice(possible)
+            newnode = self._rng.choice(possible)
             if self.addGuard(newnode, dystopic) is not None:
                 newguard = lst[-1]
                 assert newguard.node == newnode
@@ -670,7 +846,7 @@ class Client(object):
         if self.conformsToProp259:
             #XXXX Need an easy way to say that the UTOPIC_GUARDS includes
             # routers advertised on 80/443.
-            guards = filter(lambda g: g.canTry(), self.currentPrimaryGuards)
+            guards = [ g for g in self.currentPrimaryGuards if g.canTry() ]
 
             # XXXX [prop259] ADD_TO_SPEC
             # 3.5. If we should retry our primary guards, then do so.
@@ -678,7 +854,7 @@ class Client(object):
                 if self._primaryGuardsRetryTimer.isReady():
                     self._primaryGuardsRetryTimer.fire()
 
-            guards = filter(lambda g: g.canTry(), self.currentPrimaryGuards)
+            guards = [ g for g in self.currentPrimaryGuards if g.canTry() ]
 
             # 4. If there were no available entry guards, the algorithm adds a new entry
             # guard and returns it.  [XXX detail what "adding" means]
@@ -686,35 +862,229 @@ class Client(object):
                 self.addNewGuard()
 
             # Use the first guard that works.
-            for guard in guards:
-                if self.connectToGuard(guard):
-                    return guard
+            self._connectedGuard = self.connectToGuards(guards)
+            return self._connectedGuard
 
     def connectToGuard(self, guard):
         """Try to connect to 'guard' -- if it's up on the network, mark it up.
            Return true on success, false on failure."""
+        up = self._startConnection(guard)
+        self._waitedForConnection(self._connectionDelay(guard, up))
+        self._finishConnection(guard, up)
+        return up
+
+    def connectToGuards(self, guards):
+        """Try to connect to the guards in 'guards', in order, and return the
+           first one that works, or None if none of them do.
+
+           If PARALLEL_GUARD_ATTEMPTS is more than 1, we keep that many
+           connection attempts going at once, on a simloop.EventLoop, and
+           start on the next guard whenever an attempt fails.  The first
+           guard to answer wins, and the attempts still going are abandoned
+           without marking their guards either way."""
+        if self._p.PARALLEL_GUARD_ATTEMPTS <= 1:
+            for guard in guards:
+                if self.connectToGuard(guard):
+                    return guard
+            return None
+
+        loop = simloop.EventLoop(self._clock.now())
+        waiting = iter(guards)
+        inFlight = {}
+        winner = []
+
+        def launch():
+            guard = next(waiting, None)
+            if guard is None:
+                return
+            up = self._startConnection(guard)
+            inFlight[guard] = loop.callLater(
+                self._connectionDelay(guard, up), finished, guard, up)
+
+        def finished(guard, up):
+            del inFlight[guard]
+            self._finishConnection(guard, up)
+            if up:
+                winner.append(guard)
+                for handle in inFlight.values():
+                    handle.cancel()
+                loop.stop()
+            else:
+                launch()
+
+        for _ in xrange(self._p.PARALLEL_GUARD_ATTEMPTS):
+            launch()
+        loop.run()
+
+        self._waitedForConnection(loop.elapsed())
+        return winner[0] if winner else None
+
+    def _startConnection(self, guard):
+        """Start connecting to 'guard'.  Return true iff it's going to
+           work."""
         up = self._net.probe_node_is_up(guard.node)
+        self._GUARDS_CONTACTED.add(guard.node.getID())
+        if self._events is not None:
+            self._events.record(events.PROBE, guard.node.getIndex(), up,
+                                self._clientID)
+        return up
+
+    def _connectionDelay(self, guard, up):
+        """Return how long a connection to 'guard' takes to succeed (if 'up')
+           or time out."""
+        if up:
+            return self._net.connect_latency(guard.node)
+        return self._net.connect_timeout()
+
+    def _waitedForConnection(self, seconds):
+        self._connectTime += seconds
+        self._CONNECT_TIME_TOTAL += seconds
+
+    def _finishConnection(self, guard, up):
+        """A connection to 'guard' has succeeded (if 'up') or timed out."""
         self.markGuard(guard, up)
         self.checkFailoverThreshold()
 
         if up:
             self._GUARD_BANDWIDTHS.append(guard._node.bandwidth)
 
-        return up
-
     def buildCircuit(self):
         """Try to build a circuit; return true if we succeeded."""
+        self._connectTime = 0.0
+        self._connectedGuard = None
         self.maybeCheckNetwork()
 
         if self.networkAppearsDown:
             self._incrementCircuitFailureCount()
+            self._recordCircuit(None, False)
             return False
 
         g = self.getGuard(self.inADystopia)
 
         if not g:
+            self._recordCircuit(None, False)
             return False
-        return self.connectToGuard(g)
+
+        # A prop259 client has already connected to the guard it picked.
+        up = g is self._connectedGuard or self.connectToGuard(g)
+        if up and self._paths is not None:
+            if not self._paths.extendCircuit(g.node, self._consensus,
+                                             self._rng):
+                self._PATH_FAILURES += 1
+                up = False
+        if up:
+            if self._FIRST_CIRCUIT_AT is None:
+                self._FIRST_CIRCUIT_AT = self._clock.now()
+                self._BOOTSTRAP_LATENCY = (self._FIRST_CIRCUIT_AT -
+                                           self._STARTED_AT +
+                                           self._connectTime)
+            self._countCircuit(g)
+        self._recordCircuit(g, up)
+        return up
+
+    def _recordCircuit(self, guard, built):
+        """Record an event for a circuit through 'guard' (or None, if we
+           didn't get as far as picking one)."""
+        if self._events is not None:
+            self._events.record(events.CIRCUIT,
+                                guard.node.getIndex() if guard else -1,
+                                built, self._clientID)
+
+    #####################
+    # State persistence #
+    #####################
+
+    def getState(self):
+        """Return our persistent guard state, serialized as a compact string.
+
+        This is what a real client would write to its state file: the
+        primary guard lists (with each guard's flags and when it was added),
+        whether we think we're in a dystopia or that the network is down, and
+        the phases of our retry timers.  It deliberately leaves out anything
+        derived from the consensus.
+        """
+        state = (self.STATE_VERSION,
+                 self._dystopic,
+                 self._networkAppearsDown,
+                 self._networkDownRetryTimer.getState(),
+                 self._primaryGuardsRetryTimer.getState(),
+                 tuple(g.getState() for g in self._PRIMARY_U),
+                 tuple(g.getState() for g in self._PRIMARY_DYS))
+        # marshal is much cheaper than pickle for flat tuples of builtins,
+        # which matters when restarting thousands of clients.
+        return marshal.dumps(state)
+
+    def setState(self, data):
+        """Replace our persistent guard state with one serialized by
+        :meth:`getState`.
+
+        Guards whose relays the network no longer knows about at all are
+        dropped, since there is no Node left for them to refer to.
+        """
+        state = marshal.loads(data)
+        if state[0] != self.STATE_VERSION:
+            raise ValueError("Unsupported client state version %r" % state[0])
+
+        (_, self._dystopic, self._networkAppearsDown,
+         netDownTimer, primaryTimer, primaryU, primaryDys) = state
+
+        self._networkDownRetryTimer.setState(netDownTimer)
+        self._primaryGuardsRetryTimer.setState(primaryTimer)
+
+        self._PRIMARY_U = self._guardsFromState(primaryU)
+        self._PRIMARY_DYS = self._guardsFromState(primaryDys)
+
+    def _guardsFromState(self, guardStates):
+        """Build a list of Guards from a sequence of Guard.getState()
+           tuples."""
+        guards = []
+        for gs in guardStates:
+            node = self._net.getNode(gs[0])
+            if node is not None:
+                guards.append(Guard.fromState(gs, node, self._clock))
+        return guards
+
+    def _reloadState(self, stateFile=None):
+        """Save our state, optionally round-tripping it through
+        **stateFile**, and load it back in.
+        """
+        data = self.getState()
+        if stateFile:
+            with open(stateFile, 'wb') as f:
+                f.write(data)
+            with open(stateFile, 'rb') as f:
+                data = f.read()
+        return data
+
+    def restart(self, stateFile=None):
+        """Simulate restarting tor: everything that isn't in our state file
+        (including the consensus we had) is lost, and we reload from it.
+        """
+        print("Restarting tor...")
+        data = self._reloadState(stateFile)
+
+        self._DYSTOPIC_GUARDS = self._UTOPIC_GUARDS = None
+        self._consensus = None
+        self._PRIMARY_U = []
+        self._PRIMARY_DYS = []
+        self._makeTimers()
+
+        self.setState(data)
+        self.updateGuardLists()
+
+    def hup(self, stateFile=None):
+        """Simulate sending tor a SIGHUP: we reload our guard state, but keep
+        the consensus we already have.
+        """
+        print("Received SIGHUP, reloading...")
+        data = self._reloadState(stateFile)
+
+        self._PRIMARY_U = []
+        self._PRIMARY_DYS = []
+        self._makeTimers()
+
+        self.setState(data)
+        self._markGuardsListed()
 
     ###########################
     # Statistics keeping code #
@@ -728,5 +1098,45 @@ class Client(object):
         self._CIRCUIT_FAILURES = 0
 
     def averageGuardBandwidth(self, *arg, **kwargs):
+        if not self._GUARD_BANDWIDTHS:
+            return 0.0
         return (float(sum(self._GUARD_BANDWIDTHS)) /
                 float(len(self._GUARD_BANDWIDTHS)))
+
+    def _countCircuit(self, guard):
+        """Update the exposure statistics for a circuit we just built through
+        **guard**.  (Only the statistics get to know which guards are evil.)
+        """
+        node = guard.node
+        self._CIRCUITS_BUILT += 1
+        if node.isReallyEvil():
+            self._EVIL_CIRCUITS += 1
+            if self._FIRST_EVIL_AT is None:
+                self._FIRST_EVIL_AT = self._clock.now()
+        if self._LAST_GUARD is not None and self._LAST_GUARD is not node:
+            self._GUARD_SWITCHES += 1
+        self._LAST_GUARD = node
+
+    def exposure(self):
+        """Return a dict describing how exposed we've been to evil guards:
+
+        - ``evil_circuits``: how many of our circuits went through evil
+          guards, out of ``circuits_built``;
+        - ``first_evil_after``: how many simulated seconds after we started
+          we first built a circuit through an evil guard, or ``None``;
+        - ``distinct_guards``: how many different guards we've tried;
+        - ``guard_switches``: how many times a circuit used a different
+          guard from the circuit before it;
+        - ``elapsed``: how many simulated seconds we've been running.
+        """
+        firstEvil = None
+        if self._FIRST_EVIL_AT is not None:
+            firstEvil = self._FIRST_EVIL_AT - self._STARTED_AT
+        return {
+            "circuits_built": self._CIRCUITS_BUILT,
+            "evil_circuits": self._EVIL_CIRCUITS,
+            "first_evil_after": firstEvil,
+            "distinct_guards": len(self._GUARDS_CONTACTED),
+            "guard_switches": self._GUARD_SWITCHES,
+            "elapsed": self._clock.now() - self._STARTED_AT,
+        }
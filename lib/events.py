@@ -0,0 +1,237 @@
+#!/usr/bin/python
+# This is distributed under cc0. See the LICENCE file distributed along with
+# this code.
+
+"""Record every event in a simulation, column by column, for analysis
+   afterwards.
+
+   An EventWriter buffers events in typed arrays, one per column, and
+   every so often writes each column's buffer to that column's own file as
+   a (by default, zlib-compressed) chunk.  An EventReader memory-maps one
+   column's file and decodes only that column, so looking at, say, event
+   kinds never touches the times or node indices.  If numpy is installed,
+   columns come back as numpy arrays, ready for vectorized analysis.
+   Each run of a simulation replaces the files left by the last one.
+
+   Each column file is a sequence of chunks, each a header
+   struct.pack("<BII", compressed, nbytes, count) followed by nbytes of
+   data holding count items.  DIR/columns.json describes the columns and
+   the event kinds.
+
+       ./lib/main.py --prop259 --events DIR
+       ./lib/events.py DIR
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import zlib
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from py3hax import *
+import simtime
+
+
+# Kinds of event.  For each, what "node" and "value" mean is noted.
+PROBE = 0            # node: guard probed; value: 1 if it answered
+GUARD_MARKED = 1     # node: guard; value: 1 if marked up, 0 if down
+GUARD_ADDED = 2      # node: new guard; value: 1 if it seems dystopic
+DYSTOPIA = 3         # value: 1 if we now think we're in a dystopia
+NETWORK_DOWN = 4     # value: 1 if we now think the network is down
+CIRCUIT = 5          # value: 1 if the circuit was built
+CHURN_KILLED = 6     # node: node removed from the network
+CHURN_ADDED = 7      # node: node added to the network
+LIVENESS = 8         # node: node that went up or down; value: 1 if up
+
+KIND_NAMES = {
+    PROBE: "probe",
+    GUARD_MARKED: "guard_marked",
+    GUARD_ADDED: "guard_added",
+    DYSTOPIA: "dystopia",
+    NETWORK_DOWN: "network_down",
+    CIRCUIT: "circuit",
+    CHURN_KILLED: "churn_killed",
+    CHURN_ADDED: "churn_added",
+    LIVENESS: "liveness",
+}
+
+# The columns, and the array typecodes we store them as.
+COLUMNS = [
+    ("time", "d"),
+    ("client", "i"),
+    ("kind", "B"),
+    ("node", "i"),
+    ("value", "d"),
+]
+
+_CHUNK_HEADER = struct.Struct("<BII")
+
+
+def _toBytes(arr):
+    return arr.tobytes() if hasattr(arr, "tobytes") else arr.tostring()
+
+def _fromBytes(arr, data):
+    if hasattr(arr, "frombytes"):
+        arr.frombytes(data)
+    else:
+        arr.fromstring(data)
+
+
+class EventWriter(object):
+    """Buffers events and writes them out in columnar chunks."""
+
+    def __init__(self, directory, chunkSize=1 << 16, compress=True,
+                 clock=None):
+        """Write events to 'directory', flushing every 'chunkSize' events.
+           If 'compress' is false, chunks are stored raw, which makes them
+           bigger but lets readers decode them straight from the mapped
+           file (see EventReader.column()).  Events are
+           timestamped by the simtime.SimClock 'clock', or the default
+           one."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, "columns.json"), "w") as f:
+            json.dump({"columns": COLUMNS,
+                       "kinds": dict((str(k), v)
+                                     for k, v in KIND_NAMES.items())},
+                      f, sort_keys=True)
+
+        self._chunkSize = chunkSize
+        self._compress = compress
+        self._clock = clock if clock is not None else simtime.DEFAULT.clock
+        self._files = [ open(os.path.join(directory, name + ".col"), "wb")
+                        for name, _ in COLUMNS ]
+        self._newBuffers()
+
+    def _newBuffers(self):
+        self._time, self._client, self._kind, self._node, self._value = \
+            [ array(code) for _, code in COLUMNS ]
+        self._buffers = (self._time, self._client, self._kind, self._node,
+                         self._value)
+
+    def record(self, kind, node=-1, value=0.0, client=-1):
+        """Record an event of kind 'kind' happening now."""
+        self._time.append(self._clock.now())
+        self._client.append(client)
+        self._kind.append(kind)
+        self._node.append(node)
+        self._value.append(value)
+        if len(self._time) >= self._chunkSize:
+            self.flush()
+
+    def flush(self):
+        """Write out any buffered events."""
+        count = len(self._time)
+        if not count:
+            return
+        for f, buf in zip(self._files, self._buffers):
+            data = _toBytes(buf)
+            if self._compress:
+                data = zlib.compress(data, 1)
+            f.write(_CHUNK_HEADER.pack(self._compress, len(data), count))
+            f.write(data)
+        self._newBuffers()
+
+    def close(self):
+        self.flush()
+        for f in self._files:
+            f.close()
+
+
+class EventReader(object):
+    """Reads the columns written by an EventWriter."""
+
+    def __init__(self, directory):
+        self._dir = directory
+        with open(os.path.join(directory, "columns.json")) as f:
+            meta = json.load(f)
+        self._typecodes = dict((name, str(code))
+                               for name, code in meta["columns"])
+        self.kindNames = dict((int(k), v) for k, v in meta["kinds"].items())
+
+    def columns(self):
+        """Return the names of the columns."""
+        return [ name for name, _ in COLUMNS if name in self._typecodes ]
+
+    def column(self, name):
+        """Return all of column 'name', as a numpy array if we have numpy and
+           an array.array otherwise.
+
+           With numpy, raw chunks are copied straight from the mapped file
+           into the result, and a column that is a single raw chunk isn't
+           copied at all: the array is a read-only view of the file."""
+        code = self._typecodes[name]
+        path = os.path.join(self._dir, name + ".col")
+        if os.path.getsize(path) == 0:
+            return numpy.zeros(0, code) if numpy is not None else array(code)
+
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # (compressed, offset, nbytes, count) for each chunk.
+        chunks = []
+        total = 0
+        pos = 0
+        while pos < len(mapped):
+            compressed, nbytes, count = _CHUNK_HEADER.unpack_from(mapped, pos)
+            pos += _CHUNK_HEADER.size
+            chunks.append((compressed, pos, nbytes, count))
+            pos += nbytes
+            total += count
+
+        if numpy is None:
+            result = array(code)
+            for compressed, offset, nbytes, count in chunks:
+                data = mapped[offset:offset + nbytes]
+                _fromBytes(result, zlib.decompress(data) if compressed
+                           else data)
+            mapped.close()
+            return result
+
+        if len(chunks) == 1 and not chunks[0][0]:
+            # The array keeps the mapping open for as long as it's used.
+            _, offset, _, count = chunks[0]
+            return numpy.frombuffer(mapped, code, count, offset)
+
+        result = numpy.empty(total, code)
+        filled = 0
+        for compressed, offset, nbytes, count in chunks:
+            if compressed:
+                data = zlib.decompress(mapped[offset:offset + nbytes])
+                result[filled:filled + count] = numpy.frombuffer(data, code)
+            else:
+                result[filled:filled + count] = \
+                    numpy.frombuffer(mapped, code, count, offset)
+            filled += count
+        mapped.close()
+        return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Summarize an event directory written with --events.")
+    parser.add_argument("dir", help="The event directory.")
+    args = parser.parse_args(argv)
+
+    reader = EventReader(args.dir)
+    kinds = reader.column("kind")
+    counts = {}
+    for kind in kinds:
+        counts[int(kind)] = counts.get(int(kind), 0) + 1
+
+    print("%d events" % len(kinds))
+    for kind in sorted(counts):
+        print("  %-14s %d" % (reader.kindNames.get(kind, kind), counts[kind]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,469 @@
+#!/usr/bin/python
+# This is distributed under cc0. See the LICENCE file distributed along with
+# this code.
+
+"""Keep the history of a simulation's consensuses, and of which guards
+   each client had, as compressed bitmaps over relay indices, so we can
+   ask things like "in which hours was relay X listed?" or "how many of
+   this client's primary guards were listed in each consensus?" after
+   the fact.
+
+   A RunBitmap stores a set of relay indices as its runs: the boundaries
+   between runs of members and non-members, each written as a varint
+   delta from the last.  Consensuses list nearly every relay, so a run
+   usually only ends where a relay is down or has died, and a consensus
+   of a 100,000-relay network takes a few kilobytes.  AND, OR and counts
+   work on the runs directly, without expanding them.
+
+   A ConsensusHistory holds a RunBitmap for every consensus (every relay
+   it lists, and its highest-bandwidth relays) and for every client's
+   primary guards at the time, and can be saved to a file for
+   lib/history.py to summarize.  The highest-bandwidth relays are
+   scattered all over the index space, so they make for lots of short
+   runs; but they hardly change from one consensus to the next, so we
+   store most of those sets as their difference (XOR) from the one
+   before:
+
+       ./lib/main.py --prop259 --history FILE
+       ./lib/history.py FILE
+"""
+
+from __future__ import print_function
+
+import argparse
+import bisect
+import struct
+
+from py3hax import *
+
+
+def _encode(bounds):
+    """Return the increasing sequence of ints 'bounds' as varint deltas."""
+    out = bytearray()
+    last = 0
+    for pos in bounds:
+        delta = pos - last
+        last = pos
+        while delta >= 0x80:
+            out.append((delta & 0x7F) | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return bytes(out)
+
+def _decode(data):
+    """The inverse of _encode(): return a list of ints."""
+    bounds = []
+    pos = delta = shift = 0
+    for byte in bytearray(data):
+        delta |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            pos += delta
+            bounds.append(pos)
+            delta = shift = 0
+    return bounds
+
+def _combine(a, b, keep):
+    """Return the run boundaries of the set of indices whose membership of
+       the sets with run boundaries 'a' and 'b' satisfies keep(inA, inB)."""
+    out = []
+    i = j = 0
+    na, nb = len(a), len(b)
+    inA = inB = inOut = False
+    while i < na or j < nb:
+        if j >= nb or (i < na and a[i] <= b[j]):
+            pos = a[i]
+        else:
+            pos = b[j]
+        if i < na and a[i] == pos:
+            inA = not inA
+            i += 1
+        if j < nb and b[j] == pos:
+            inB = not inB
+            j += 1
+        now = keep(inA, inB)
+        if now != inOut:
+            out.append(pos)
+            inOut = now
+    return out
+
+def _boundsFromBits(bits):
+    """Return the run boundaries of the little-endian bytearray bitset
+       'bits'."""
+    bounds = []
+    inRun = False
+    for byteIdx, byte in enumerate(bits):
+        # Whole bytes that carry on the current run are the common case.
+        if byte == (0xFF if inRun else 0):
+            continue
+        base = byteIdx << 3
+        for bit in xrange(8):
+            if bool(byte & (1 << bit)) != inRun:
+                bounds.append(base + bit)
+                inRun = not inRun
+    if inRun:
+        bounds.append(len(bits) << 3)
+    return bounds
+
+
+class RunBitmap(object):
+    """An immutable set of non-negative ints, run-length encoded."""
+
+    def __init__(self, bounds=()):
+        """Create the set of every i with bounds[2k] <= i < bounds[2k+1] for
+           some k.  'bounds' must be strictly increasing."""
+        self._data = _encode(bounds)
+        self._count = sum(bounds[k + 1] - bounds[k]
+                          for k in xrange(0, len(bounds), 2))
+
+    @classmethod
+    def fromIndices(cls, indices):
+        """Return the set of the ints in 'indices'."""
+        bounds = []
+        for idx in sorted(set(indices)):
+            if bounds and bounds[-1] == idx:
+                bounds[-1] = idx + 1
+            else:
+                bounds.extend((idx, idx + 1))
+        return cls(bounds)
+
+    @classmethod
+    def fromBits(cls, bits):
+        """Return the set of bits set in the little-endian bytearray bitset
+           'bits', as used by tornet.Consensus."""
+        return cls(_boundsFromBits(bits))
+
+    def bounds(self):
+        """Return a list of the boundaries of our runs."""
+        return _decode(self._data)
+
+    def __len__(self):
+        return self._count
+
+    def count(self):
+        """Return the number of members."""
+        return self._count
+
+    def nbytes(self):
+        """Return how many bytes our runs take to store."""
+        return len(self._data)
+
+    def __contains__(self, idx):
+        return bisect.bisect_right(self.bounds(), idx) % 2 == 1
+
+    def __iter__(self):
+        bounds = self.bounds()
+        for k in xrange(0, len(bounds), 2):
+            for idx in xrange(bounds[k], bounds[k + 1]):
+                yield idx
+
+    def __and__(self, other):
+        return RunBitmap(_combine(self.bounds(), other.bounds(),
+                                  lambda a, b: a and b))
+
+    def __or__(self, other):
+        return RunBitmap(_combine(self.bounds(), other.bounds(),
+                                  lambda a, b: a or b))
+
+    def __sub__(self, other):
+        return RunBitmap(_combine(self.bounds(), other.bounds(),
+                                  lambda a, b: a and not b))
+
+    def __xor__(self, other):
+        return RunBitmap(_combine(self.bounds(), other.bounds(),
+                                  lambda a, b: a != b))
+
+    def __eq__(self, other):
+        return isinstance(other, RunBitmap) and self._data == other._data
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._data)
+
+    def andCount(self, other):
+        """Return len(self & other), without building the result."""
+        a, b = self.bounds(), other.bounds()
+        total = 0
+        i = j = 0
+        while i < len(a) and j < len(b):
+            lo = max(a[i], b[j])
+            hi = min(a[i + 1], b[j + 1])
+            if lo < hi:
+                total += hi - lo
+            if a[i + 1] < b[j + 1]:
+                i += 2
+            else:
+                j += 2
+        return total
+
+    @staticmethod
+    def intersection(bitmaps):
+        """Return the members common to every RunBitmap in 'bitmaps'."""
+        bitmaps = list(bitmaps)
+        if not bitmaps:
+            return RunBitmap()
+        result = bitmaps[0].bounds()
+        for bitmap in bitmaps[1:]:
+            result = _combine(result, bitmap.bounds(), lambda a, b: a and b)
+        return RunBitmap(result)
+
+    @staticmethod
+    def union(bitmaps):
+        """Return the members of any RunBitmap in 'bitmaps'."""
+        result = []
+        for bitmap in bitmaps:
+            result = _combine(result, bitmap.bounds(), lambda a, b: a or b)
+        return RunBitmap(result)
+
+
+# Kinds of bitmap in a ConsensusHistory file.
+LISTED = 0
+TOP = 1
+CLIENT_GUARDS = 2
+TOP_CHANGES = 3
+
+# Each bitmap in a file: kind, consensus generation, client (or -1),
+# number of members, and the number of bytes of runs that follow.
+_RECORD = struct.Struct("<BiiII")
+_MAGIC = b"GSHIST1\n"
+
+
+class ConsensusHistory(object):
+    """Every consensus of a simulation, and each client's primary guards
+       while it was current, as RunBitmaps, keyed by consensus
+       generation."""
+
+    # We store every this many consensuses' top relays whole; the rest, we
+    # store as their XOR with the consensus before.
+    KEYFRAME_INTERVAL = 24
+
+    def __init__(self, topFraction=0.1):
+        """For each consensus, we also note the fraction 'topFraction' of
+           the relays it lists that have the most bandwidth."""
+        self._topFraction = topFraction
+        self._listed = {}
+        # generation -> RunBitmap of the top relays, if the generation is
+        # in _keyframes, or else of how they changed since the generation
+        # before.
+        self._top = {}
+        self._keyframes = set()
+        # the top relays of the latest consensus we've recorded.
+        self._lastTop = None
+        # client ID -> {generation -> RunBitmap}
+        self._clients = {}
+
+    def record(self, consensus):
+        """Remember the tornet.Consensus 'consensus', which must be newer
+           than any we've already recorded."""
+        generation = consensus.getGeneration()
+        if self._listed and generation <= max(self._listed):
+            return
+        self._listed[generation] = RunBitmap.fromBits(
+            consensus.getMembership())
+        guards = consensus.getGuards()
+        nTop = int(len(guards) * self._topFraction)
+        top = RunBitmap.fromIndices(node.getIndex() for node in guards[:nTop])
+        if (self._lastTop is None or
+                len(self._listed) % self.KEYFRAME_INTERVAL == 1):
+            self._top[generation] = top
+            self._keyframes.add(generation)
+        else:
+            self._top[generation] = top ^ self._lastTop
+        self._lastTop = top
+
+    def recordClient(self, clientID, generation, guards):
+        """Remember that client number 'clientID' had the client.Guards
+           'guards' as its primary guards while consensus 'generation' was
+           current."""
+        self._clients.setdefault(clientID, {})[generation] = \
+            RunBitmap.fromIndices(g.node.getIndex() for g in guards)
+
+    def mergeClients(self, other):
+        """Add the clients' primary guards noted in the ConsensusHistory
+           'other' to this one."""
+        for clientID, byGeneration in other._clients.items():
+            self._clients.setdefault(clientID, {}).update(byGeneration)
+
+    def generations(self):
+        """Return a sorted list of the consensus generations we know."""
+        return sorted(self._listed)
+
+    def clients(self):
+        """Return a sorted list of the client IDs we know."""
+        return sorted(self._clients)
+
+    def listed(self, generation):
+        """Return a RunBitmap of the relays listed in consensus
+           'generation'."""
+        return self._listed[generation]
+
+    def top(self, generation):
+        """Return a RunBitmap of the highest-bandwidth relays listed in
+           consensus 'generation'."""
+        generations = self.generations()
+        i = bisect.bisect_left(generations, generation)
+        if i == len(generations) or generations[i] != generation:
+            raise KeyError(generation)
+        changes = []
+        while generations[i] not in self._keyframes:
+            changes.append(self._top[generations[i]])
+            i -= 1
+        bounds = self._top[generations[i]].bounds()
+        for bitmap in reversed(changes):
+            bounds = _combine(bounds, bitmap.bounds(), lambda a, b: a != b)
+        return RunBitmap(bounds)
+
+    def _tops(self):
+        """Yield a (generation, RunBitmap of top relays) tuple for each of
+           our consensuses, in order."""
+        bounds = []
+        for generation in self.generations():
+            if generation in self._keyframes:
+                bounds = self._top[generation].bounds()
+            else:
+                bounds = _combine(bounds, self._top[generation].bounds(),
+                                  lambda a, b: a != b)
+            yield generation, RunBitmap(bounds)
+
+    def clientGuards(self, clientID, generation):
+        """Return a RunBitmap of client 'clientID''s primary guards while
+           consensus 'generation' was current."""
+        return self._clients[clientID][generation]
+
+    def listedIn(self, idx):
+        """Return a list of the generations of the consensuses that listed
+           the relay with index 'idx'."""
+        return [ g for g in self.generations() if idx in self._listed[g] ]
+
+    def alwaysListed(self, generations=None):
+        """Return a RunBitmap of the relays listed in every one of the
+           consensuses 'generations' (by default, all of them)."""
+        if generations is None:
+            generations = self.generations()
+        return RunBitmap.intersection(self._listed[g] for g in generations)
+
+    def everListed(self, generations=None):
+        """Return a RunBitmap of the relays listed in any one of the
+           consensuses 'generations' (by default, all of them)."""
+        if generations is None:
+            generations = self.generations()
+        return RunBitmap.union(self._listed[g] for g in generations)
+
+    def listedGuardCounts(self, clientID):
+        """Return a list of (generation, primary guards, how many of them
+           were listed) tuples for client 'clientID'."""
+        return [ (g, len(guards), guards.andCount(self._listed[g]))
+                 for g, guards in sorted(self._clients[clientID].items())
+                 if g in self._listed ]
+
+    def topStability(self):
+        """Return a list of (generation, overlap) tuples, where overlap is
+           the Jaccard index of each consensus's top relays with the top
+           relays of the consensus before it."""
+        result = []
+        prev = None
+        for generation, cur in self._tops():
+            if prev is not None:
+                common = prev.andCount(cur)
+                either = len(prev) + len(cur) - common
+                result.append((generation,
+                               common / float(either) if either else 1.0))
+            prev = cur
+        return result
+
+    def nbytes(self):
+        """Return how many bytes all our bitmaps' runs take."""
+        return (sum(b.nbytes() for b in self._listed.values()) +
+                sum(b.nbytes() for b in self._top.values()) +
+                sum(b.nbytes() for c in self._clients.values()
+                    for b in c.values()))
+
+    def _records(self):
+        for generation in self.generations():
+            yield LISTED, generation, -1, self._listed[generation]
+            if generation in self._keyframes:
+                yield TOP, generation, -1, self._top[generation]
+            else:
+                yield TOP_CHANGES, generation, -1, self._top[generation]
+        for clientID in self.clients():
+            for generation, bitmap in sorted(self._clients[clientID].items()):
+                yield CLIENT_GUARDS, generation, clientID, bitmap
+
+    def save(self, path):
+        """Write everything to the file 'path'."""
+        with open(path, "wb") as f:
+            f.write(_MAGIC)
+            for kind, generation, clientID, bitmap in self._records():
+                f.write(_RECORD.pack(kind, generation, clientID,
+                                     bitmap._count, len(bitmap._data)))
+                f.write(bitmap._data)
+
+    @classmethod
+    def load(cls, path):
+        """Return the ConsensusHistory saved in the file 'path'."""
+        history = cls()
+        with open(path, "rb") as f:
+            data = f.read()
+        if not data.startswith(_MAGIC):
+            raise ValueError("%s isn't a consensus history" % path)
+        pos = len(_MAGIC)
+        while pos < len(data):
+            kind, generation, clientID, count, nbytes = \
+                _RECORD.unpack_from(data, pos)
+            pos += _RECORD.size
+            bitmap = RunBitmap()
+            bitmap._data = data[pos:pos + nbytes]
+            bitmap._count = count
+            pos += nbytes
+            if kind == LISTED:
+                history._listed[generation] = bitmap
+            elif kind in (TOP, TOP_CHANGES):
+                history._top[generation] = bitmap
+                if kind == TOP:
+                    history._keyframes.add(generation)
+            else:
+                history._clients.setdefault(clientID, {})[generation] = \
+                    bitmap
+        return history
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Summarize a consensus history written with --history.")
+    parser.add_argument("file", help="The history file.")
+    parser.add_argument(
+        "--relay", type=int, action="append", default=[], metavar="INDEX",
+        help="Also list the consensuses that listed the relay INDEX.")
+    args = parser.parse_args(argv)
+
+    history = ConsensusHistory.load(args.file)
+    generations = history.generations()
+    print("%d consensuses, %d clients, %d bytes of runs"
+          % (len(generations), len(history.clients()), history.nbytes()))
+    if not generations:
+        return
+    print("Relays ever listed:                 %d"
+          % len(history.everListed()))
+    print("Relays always listed:               %d"
+          % len(history.alwaysListed()))
+    stability = history.topStability()
+    if stability:
+        print("Top relay set overlap (mean):       %.3f"
+              % (sum(o for _, o in stability) / len(stability)))
+    for clientID in history.clients():
+        counts = history.listedGuardCounts(clientID)
+        if counts:
+            print("Client %d primary guards listed (mean): %.2f of %.2f"
+                  % (clientID,
+                     sum(n for _, _, n in counts) / float(len(counts)),
+                     sum(n for _, n, _ in counts) / float(len(counts))))
+    for idx in args.relay:
+        listed = history.listedIn(idx)
+        print("Relay %d listed in %d consensuses: %s"
+              % (idx, len(listed), " ".join(str(g) for g in listed)))
+
+if __name__ == '__main__':
+    main()
@@ -4,63 +4,72 @@ from __future__ import print_function
 
 from py3hax import *
 import tornet
-import simtime
 import client
+import events
+import history
 import options
+import population
+import progress
+import scenario
 
 
 def trivialSimulation(args):
-    num = 1000 if not args.total_relays else args.total_relays
-    print("Number of nodes in simulated Tor network: %d" % num)
-
-    net = tornet.Network(num)
+    eventLog = events.EventWriter(args.events) if args.events else None
+    net = scenario.makeNetwork(args, eventLog)
+    print("Number of nodes in simulated Tor network: %d"
+          % len(net.getNodes()))
 
     # Decorate the network.
-    if args.fascist_firewall:
-        net = tornet.FascistNetwork(net)
-    if args.flaky_network:
-        net = tornet.FlakyNetwork(net)
-    if args.evil_filtering:
-        net = tornet.EvilFilteringNetwork(net)
-    if args.sniper_network:
-        net = tornet.SniperNetwork(net)
-
-    params = client.ClientParams(
-        PROP241=args.prop241,
-        PROP259=args.prop259,
-        PRIORITIZE_BANDWIDTH=not args.no_prioritize_bandwidth)
-    c = client.Client(net, params)
-
-    ok = 0
-    bad = 0
+    policy = scenario.makePolicy(args)
+    net = scenario.decorateNetwork(net, args, policy)
 
-    for period in xrange(30): # one hour each
-        for subperiod in xrange(30): # two minutes each
-            if (subperiod % 10) == 0:
-                # nodes left and arrived
-                net.do_churn()
-            # nodes went up and down
-            net.updateRunning()
+    params = scenario.makeClientParams(args)
+    c = client.Client(net, params, eventLog, 0, policy,
+                      scenario.makePathBuilder(args))
+    scenario.warmStartClient(c, net, args)
 
-            for attempts in xrange(6): # 20 sec each
+    hist = history.ConsensusHistory() if args.history else None
+    if hist is not None:
+        hist.record(net.get_consensus())
 
-                # actually have the client act.
-                if c.buildCircuit():
-                    ok += 1
-                else:
-                    bad += 1
+    def onHour(hour):
+        if hist is not None:
+            consensus = net.get_consensus()
+            hist.record(consensus)
+            hist.recordClient(0, consensus.getGeneration(),
+                              c.allPrimaryGuards)
+        # the user restarts or HUPs tor
+        scenario.maybeRestart(c, args, hour, args.state_file)
 
-                # time passed
-                simtime.advanceTime(20)
+    tracker = progress.Progress(30, net.getSimulation().clock)
+    tracker.clientStates = lambda: (int(c._dystopic),
+                                    int(c._networkAppearsDown))
+    reporter = progress.makeReporter(tracker, args)
 
-        # new consensus
-        c.updateGuardLists()
+    ok, bad = scenario.runClient(c, net, onHour=onHour, tracker=tracker)
+    if eventLog is not None:
+        eventLog.close()
+    if reporter is not None:
+        reporter.close()
+    if hist is not None:
+        hist.save(args.history)
 
     print("Successful client circuits (total): %d (%d)" % (ok, (ok + bad)))
     print("Percentage of successful circuits:  %f%%"
           % ((ok / float(ok + bad)) * 100.0))
     print("Average guard bandwidth capacity:   %d KB/s" % c.averageGuardBandwidth())
+    if args.full_paths:
+        print("Circuits failed beyond the guard:   %d" % c._PATH_FAILURES)
+    if c._BOOTSTRAP_LATENCY is not None:
+        print("Bootstrap latency:                  %.2f s"
+              % c._BOOTSTRAP_LATENCY)
+    print("Guard connection time per circuit:  %.3f s"
+          % (c._CONNECT_TIME_TOTAL / float(ok + bad)))
+    scenario.printExposure(scenario.exposureMetrics([c.exposure()]))
 
 if __name__ == '__main__':
     args = options.makeOptionsParser()
-    trivialSimulation(args)
+    if args.clients > 1 or args.workers:
+        population.populationSimulation(args)
+    else:
+        trivialSimulation(args)
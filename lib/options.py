@@ -49,12 +49,131 @@ def makeOptionsParser():
         help=("Simulate a network that does a DoS attack on a client's "
               "non-evil guard nodes with some probability after each "
               "connection."))
+    net_group.add_argument(
+        "--bandwidth-model", choices=["gamma", "lognormal"], default="gamma",
+        help=("The distribution relays' bandwidths are drawn from.  "
+              "(Default: gamma)"))
+    net_group.add_argument(
+        "--bandwidth-file", metavar="PATH",
+        help=("Draw relays' bandwidths from the empirical distribution of the "
+              "bandwidths in PATH: either one number (in KB/s) per line, or a "
+              "consensus document.  Overrides --bandwidth-model."))
+    net_group.add_argument(
+        "--bandwidth-drift", type=float, default=0.0, metavar="SIGMA",
+        help=("Make relays' bandwidths drift by about SIGMA in log space with "
+              "every consensus, so their ordering changes over time."))
+    net_group.add_argument(
+        "--full-paths", action="store_true",
+        help=("Extend every circuit through a bandwidth-weighted middle and "
+              "exit relay, instead of counting it as built once the guard "
+              "answers."))
+    net_group.add_argument(
+        "--port-policy", action="append", metavar="PORTS",
+        help=("Put clients behind a firewall that only allows connections to "
+              "the comma-separated PORTS, and configure them to know it.  If "
+              "given more than once, clients get each policy in turn."))
+    net_group.add_argument(
+        "--filtered-fraction", type=float, default=0.0, metavar="F",
+        help=("Put each client behind a middlebox that drops connections to "
+              "a random fraction F of relays, different for every client."))
+    net_group.add_argument(
+        "--warm-start", type=float, default=0.0, metavar="HOURS",
+        help=("Start the network in its long-run state, and clients with the "
+              "guards they might have after running for HOURS simulated "
+              "hours, instead of simulating a burn-in.  Only models "
+              "--prop259 clients that lose guards to churn alone, so not "
+              "with -F, -f, -e, -s, --port-policy, --filtered-fraction, or "
+              "--workers."))
+
+    # How should the client behave?
+    client_group = parser.add_argument_group(
+        title="Client Behaviour Options",
+        description=("Control things the user does to the simulated tor "
+                     "client while it is running."))
+    client_group.add_argument(
+        "--restart-every", type=int, metavar="HOURS",
+        help=("Restart the client every HOURS simulated hours, reloading its "
+              "guard state from its state file."))
+    client_group.add_argument(
+        "--hup-every", type=int, metavar="HOURS",
+        help=("Send the client a HUP every HOURS simulated hours, reloading "
+              "its guard state but keeping its consensus."))
+    client_group.add_argument(
+        "--state-file", metavar="PATH",
+        help=("Write the client's guard state to PATH on every restart or "
+              "HUP, and read it back from there.  By default the state is "
+              "only kept in memory."))
+
+    # How many clients, and how should we run them?
+    pop_group = parser.add_argument_group(
+        title="Client Population Options",
+        description=("Simulate many clients sharing one Tor network, "
+                     "optionally spread across worker processes."))
+    pop_group.add_argument(
+        "-n", "--clients", type=int, default=1,
+        help=("The number of simulated clients.  (Default: 1)"))
+    pop_group.add_argument(
+        "-j", "--workers", type=int, default=0,
+        help=("Run the clients in this many worker processes, which read the "
+              "network's state from shared memory.  By default, everything "
+              "runs in one process."))
 
     # Other miscellaneous options
+    parser.add_argument(
+        "--events", metavar="DIR",
+        help=("Record every probe, guard change, and churn event in columnar "
+              "files in DIR, for analysis with lib/events.py.  With "
+              "--workers, each worker's clients are recorded in their own "
+              "subdirectory."))
+    parser.add_argument(
+        "--history", metavar="PATH",
+        help=("Save every consensus, and every client's primary guards at "
+              "the time, as compressed bitmaps in PATH, for analysis with "
+              "lib/history.py."))
     parser.add_argument(
         "-r", "--no-prioritize-bandwidth", action="store_true",
         help=("When selecting a new guard node, the default is to prioritize "
               "nodes with higher bandwidth capacity.  This option causes random "
               "nodes to be chosen"))
+    parser.add_argument(
+        "--parallel-guards", type=int, default=1, metavar="K",
+        help=("Try to connect to up to K primary guards at once, and use the "
+              "first one to answer.  (Default: 1, which tries them one after "
+              "another.)"))
+
+    # Watching long simulations
+    metrics_group = parser.add_argument_group(
+        title="Progress Options",
+        description=("Report live metrics about the simulation, in the "
+                     "Prometheus text format, while it runs."))
+    metrics_group.add_argument(
+        "--metrics-file", metavar="PATH",
+        help="Keep rewriting PATH with the latest metrics.")
+    metrics_group.add_argument(
+        "--metrics-port", type=int, metavar="PORT",
+        help="Serve the latest metrics at http://127.0.0.1:PORT/metrics.")
+    metrics_group.add_argument(
+        "--metrics-interval", type=float, default=5.0, metavar="SECONDS",
+        help="How often to sample the metrics.  (Default: %(default)s)")
+    metrics_group.add_argument(
+        "--progress", action="store_true",
+        help="Print a line of progress to stderr every time we sample.")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.warm_start and args.workers:
+        # Warm-started clients need the network to make them dead guards,
+        # and only the coordinator can add nodes.
+        parser.error("--warm-start doesn't work with --workers")
+    if args.warm_start and not args.prop259:
+        parser.error("--warm-start only models --prop259 clients")
+    if args.warm_start:
+        lossy = [ flag for flag, name in (
+            ("-F", "fascist_firewall"), ("-f", "flaky_network"),
+            ("-e", "evil_filtering"), ("-s", "sniper_network"),
+            ("--port-policy", "port_policy"),
+            ("--filtered-fraction", "filtered_fraction"))
+                  if getattr(args, name) ]
+        if lossy:
+            parser.error("--warm-start doesn't model guards lost to %s"
+                         % ", ".join(lossy))
+    return args
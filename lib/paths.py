@@ -0,0 +1,152 @@
+#!/usr/bin/python
+# This is distributed under cc0. See the LICENCE file distributed along with
+# this code.
+
+"""Build whole three-hop circuits, not just guard connections.
+
+   Once a client has connected to its guard, a PathBuilder picks an exit
+   and then a middle relay, each with probability proportional to its
+   bandwidth, the way tor does.  Exits must have the exit flag, and no two
+   relays in a path may be the same relay, share a declared family, or
+   share a /16.  The circuit works iff both extra hops are running.
+
+   The weighted choices use alias tables, which take O(n) to build but
+   only O(1) per draw.  We build them once per consensus, and share them
+   between every client on the network.  Relays that conflict with the
+   rest of the path are rejected and redrawn, which is rare, so a circuit
+   costs O(1) on average however large the network is.
+"""
+
+from __future__ import print_function
+
+import random
+
+from py3hax import *
+
+
+class AliasSampler(object):
+    """Draws indices from a fixed discrete distribution in O(1) time per
+       draw, using Vose's alias method."""
+
+    def __init__(self, weights):
+        """Sample index i with probability weights[i] / sum(weights)."""
+        n = len(weights)
+        self._n = n
+        self._prob = [ 0.0 ] * n
+        self._alias = [ 0 ] * n
+        if not n:
+            return
+
+        total = float(sum(weights))
+        if total <= 0:
+            scaled = [ 1.0 ] * n
+        else:
+            scaled = [ w * n / total for w in weights ]
+        small = [ i for i, p in enumerate(scaled) if p < 1.0 ]
+        large = [ i for i, p in enumerate(scaled) if p >= 1.0 ]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self._prob[s] = scaled[s]
+            self._alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # Whatever's left is 1, give or take rounding error.
+        for i in small + large:
+            self._prob[i] = 1.0
+
+    def __len__(self):
+        return self._n
+
+    def sample(self, rng=random):
+        """Return a random index."""
+        u = rng.random() * self._n
+        i = int(u)
+        if u - i < self._prob[i]:
+            return i
+        return self._alias[i]
+
+
+class _Position(object):
+    """The relays eligible for one position in a path, and a sampler to
+       choose between them by bandwidth."""
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        # What we need to check each candidate against the rest of the
+        # path, worked out once instead of on every draw.
+        self.keys = [ (node.getSubnet(), node.getFamily()) for node in nodes ]
+        self.sampler = AliasSampler([ node.bandwidth for node in nodes ])
+
+    def choose(self, chosen, tries, rng):
+        """Return a random relay that conflicts with none of the (node,
+           subnet, family) tuples in 'chosen', or None if we can't find one
+           in 'tries' draws."""
+        if not self.nodes:
+            return None
+        for _ in xrange(tries):
+            i = self.sampler.sample(rng)
+            node = self.nodes[i]
+            subnet, family = self.keys[i]
+            for other, otherSubnet, otherFamily in chosen:
+                if (node is other or subnet == otherSubnet or
+                        (family is not None and family == otherFamily)):
+                    break
+            else:
+                return node
+        return None
+
+
+class PathBuilder(object):
+    """Chooses middle and exit relays for circuits, using the guards listed
+       in each client's consensus."""
+
+    # How many times to redraw a relay that conflicts with the rest of the
+    # path before giving up on the circuit.
+    MAX_TRIES = 20
+
+    def __init__(self):
+        # The generation of the consensus our positions are built from.
+        self._generation = None
+        self._exits = self._middles = None
+
+    def _update(self, consensus):
+        """Rebuild our samplers if 'consensus' is newer than the one we
+           built them from."""
+        if consensus.getGeneration() == self._generation:
+            return
+        relays = consensus.getGuards()
+        self._middles = _Position(relays)
+        self._exits = _Position([ node for node in relays if node.isExit() ])
+        self._generation = consensus.getGeneration()
+
+    def choosePath(self, guard, consensus, rng=random):
+        """Return a (middle, exit) tuple of Nodes to extend a circuit from
+           the Node 'guard' through, chosen from 'consensus', or None if we
+           couldn't find a path."""
+        self._update(consensus)
+        chosen = [ (guard, guard.getSubnet(), guard.getFamily()) ]
+
+        exitNode = self._exits.choose(chosen, self.MAX_TRIES, rng)
+        if exitNode is None:
+            return None
+        chosen.append((exitNode, exitNode.getSubnet(), exitNode.getFamily()))
+
+        middle = self._middles.choose(chosen, self.MAX_TRIES, rng)
+        if middle is None:
+            return None
+        return middle, exitNode
+
+    def extendCircuit(self, guard, consensus, rng=random):
+        """Try to extend a circuit from 'guard' to a middle and an exit.
+           Return true iff it worked.  (The connections beyond the guard
+           don't pass through the client's local network, so we ask the
+           relays directly whether they're up.)"""
+        path = self.choosePath(guard, consensus, rng)
+        if path is None:
+            return False
+        middle, exitNode = path
+        return middle.isReallyUp() and exitNode.isReallyUp()
@@ -0,0 +1,310 @@
+#!/usr/bin/python
+# This is distributed under cc0. See the LICENCE file distributed along with
+# this code.
+
+"""Simulate a whole population of clients sharing one Tor network, either
+   in this process or split across worker processes that read the
+   network's state from shared memory.
+"""
+
+from __future__ import print_function
+
+import os
+import random
+import sys
+
+from multiprocessing import Pipe, Process
+
+from py3hax import *
+import client
+import events
+import history
+import progress
+import scenario
+import shared
+import tornet
+
+
+class Population(object):
+    """A group of simulated clients.  Each one sees 'network' through its
+       own decorated local network connection."""
+
+    def __init__(self, network, args, nClients, eventLog=None, firstID=0,
+                 hist=None):
+        """Clients record their events in 'eventLog', if given, numbered
+           from 'firstID'.  If 'hist' is a history.ConsensusHistory, we
+           note each client's primary guards there with every consensus."""
+        self._args = args
+        self._firstID = firstID
+        self._history = hist
+        self._clock = network.getSimulation().clock
+        params = scenario.makeClientParams(args)
+        pathBuilder = scenario.makePathBuilder(args)
+        policies = {}
+        self._clients = []
+        for n in xrange(firstID, firstID + nClients):
+            policy = scenario.makePolicy(args, n, policies)
+            net = scenario.decorateNetwork(network, args, policy)
+            c = client.Client(net, params, eventLog, n, policy, pathBuilder)
+            scenario.warmStartClient(c, net, args)
+            self._clients.append(c)
+        self._ok = 0
+        self._bad = 0
+
+    def runPeriod(self, attempts=6, interval=20):
+        """Have every client try to build 'attempts' circuits,
+           'interval' simulated seconds apart."""
+        for _ in xrange(attempts):
+            for c in self._clients:
+                if c.buildCircuit():
+                    self._ok += 1
+                else:
+                    self._bad += 1
+            self._clock.advanceTime(interval)
+
+    def newHour(self, hour):
+        """A new consensus has been published at the end of simulated hour
+           number 'hour': hand it to every client."""
+        for n, c in enumerate(self._clients):
+            c.updateGuardLists()
+            if self._history is not None:
+                self._history.recordClient(
+                    self._firstID + n, c._consensus.getGeneration(),
+                    c.allPrimaryGuards)
+            stateFile = None
+            if self._args.state_file:
+                stateFile = "%s.%d" % (self._args.state_file, n)
+            scenario.maybeRestart(c, self._args, hour, stateFile)
+
+    def getCircuits(self):
+        """Return a tuple of (successful circuits, failed circuits) so far."""
+        return self._ok, self._bad
+
+    def countStates(self):
+        """Return a tuple of (clients that think they're on a dystopic
+           network, clients that think the network is down).  This only
+           reads the clients' state, so another thread may call it."""
+        clients = self._clients
+        return (sum(1 for c in clients if c._dystopic),
+                sum(1 for c in clients if c._networkAppearsDown))
+
+    def getTotals(self):
+        """Return a tuple of (successful circuits, failed circuits, sum of
+           guard bandwidths, number of guard bandwidths, list of each
+           client's Client.exposure())."""
+        bandwidths = [ bw for c in self._clients
+                       for bw in c._GUARD_BANDWIDTHS ]
+        return (self._ok, self._bad, sum(bandwidths), len(bandwidths),
+                [ c.exposure() for c in self._clients ])
+
+
+def _applyKills(network, kills):
+    """Kill the nodes of 'network' whose indices are in 'kills', in index
+       order."""
+    for idx in sorted(kills):
+        node = network.getNodeByIndex(idx)
+        # (It may have been killed already.)
+        if node is not None:
+            network.kill_node(node)
+
+
+class _LocalRunner(object):
+    """Runs the whole population in this process.  Nodes that clients kill
+       are killed at the end of each tick, just as with workers."""
+
+    def __init__(self, network, args, eventLog=None, hist=None):
+        self._network = network
+        self._deferred = tornet.DeferredKillNetwork(network)
+        self._population = Population(self._deferred, args, args.clients,
+                                      eventLog, hist=hist)
+
+    def runPeriod(self):
+        self._population.runPeriod()
+        _applyKills(self._network, self._deferred.takeKills())
+
+    def newHour(self, hour):
+        self._population.newHour(hour)
+
+    def getCircuits(self):
+        return self._population.getCircuits()
+
+    def countStates(self):
+        return self._population.countStates()
+
+    def finish(self, hist=None):
+        return self._population.getTotals()
+
+
+def _workerMain(conn, state, consensus, network, args, nClients, firstID,
+                seed, worker):
+    """Entry point for worker number 'worker', running 'nClients' clients
+       numbered from 'firstID'."""
+    random.seed(seed)
+    # Our clients' chatter shares stdout with the other workers: write it a
+    # line at a time, so lines don't get split up and interleaved.
+    sys.stdout = os.fdopen(os.dup(sys.stdout.fileno()), "w", 1)
+    eventLog = None
+    if args.events:
+        eventLog = events.EventWriter(
+            os.path.join(args.events, "worker%d" % worker))
+    hist = history.ConsensusHistory() if args.history else None
+    view = shared.SharedNetworkView(state, consensus, network)
+    population = Population(view, args, nClients, eventLog, firstID, hist)
+
+    while True:
+        msg = conn.recv()
+        if msg[0] == "period":
+            view.sync()
+            population.runPeriod()
+            conn.send((view.takeKills(), population.getCircuits(),
+                       population.countStates()))
+        elif msg[0] == "hour":
+            view.sync()
+            population.newHour(msg[1])
+            conn.send(None)
+        elif msg[0] == "finish":
+            if eventLog is not None:
+                eventLog.close()
+            # The coordinator records the consensuses themselves.
+            conn.send(population.getTotals() + (hist,))
+            break
+
+
+class _ParallelRunner(object):
+    """Runs the population in worker processes.  We stay behind as the
+       coordinator: we own the real network, publish its state to shared
+       memory, and apply the nodes killed by each worker's clients at the
+       end of every tick, in index order."""
+
+    def __init__(self, network, args):
+        self._network = network
+
+        # Leave plenty of room for the nodes churn will add.
+        capacity = 2 * len(network.getNodes()) + 10000
+        self._state = shared.SharedNetworkState(network, capacity)
+        self._consensus = shared.SharedConsensus(capacity)
+        self._consensus.write(network.get_consensus(),
+                              self._state.getNIndices())
+
+        # What the workers told us at the end of the last tick: the
+        # numbers of (successful, failed) circuits, and of (dystopic,
+        # network down) clients.
+        self._circuits = (0, 0)
+        self._states = (0, 0)
+
+        nWorkers = min(args.workers, args.clients)
+        # Anything still buffered would be printed again by every worker.
+        sys.stdout.flush()
+        self._conns = []
+        self._procs = []
+        for n in xrange(nWorkers):
+            firstID = args.clients * n // nWorkers
+            nClients = args.clients * (n + 1) // nWorkers - firstID
+            ours, theirs = Pipe()
+            proc = Process(target=_workerMain,
+                           args=(theirs, self._state, self._consensus,
+                                 network, args, nClients, firstID,
+                                 random.getrandbits(64), n))
+            proc.start()
+            self._conns.append(ours)
+            self._procs.append(proc)
+
+    def _broadcast(self, msg):
+        """Send 'msg' to every worker and return a list of their replies."""
+        for conn in self._conns:
+            conn.send(msg)
+        return [ conn.recv() for conn in self._conns ]
+
+    def runPeriod(self, attempts=6, interval=20):
+        self._state.publish(self._network)
+        kills = set()
+        replies = self._broadcast(("period",))
+        for workerKills, _, _ in replies:
+            kills.update(workerKills)
+        self._circuits = tuple(sum(r[1][i] for r in replies) for i in (0, 1))
+        self._states = tuple(sum(r[2][i] for r in replies) for i in (0, 1))
+        _applyKills(self._network, kills)
+        self._network.getSimulation().clock.advanceTime(attempts * interval)
+
+    def newHour(self, hour):
+        self._state.publish(self._network)
+        self._consensus.write(self._network.get_consensus(),
+                              self._state.getNIndices())
+        self._broadcast(("hour", hour))
+
+    def getCircuits(self):
+        return self._circuits
+
+    def countStates(self):
+        return self._states
+
+    def finish(self, hist=None):
+        """Stop the workers, and return their totals summed.  Add what
+           they've noted in their histories to 'hist', if given."""
+        totals = self._broadcast(("finish",))
+        for proc in self._procs:
+            proc.join()
+        if hist is not None:
+            for t in totals:
+                hist.mergeClients(t[5])
+        return (tuple(sum(t[i] for t in totals) for i in xrange(4)) +
+                ([ e for t in totals for e in t[4] ],))
+
+
+def populationSimulation(args):
+    eventLog = events.EventWriter(args.events) if args.events else None
+    net = scenario.makeNetwork(args, eventLog)
+    print("Number of nodes in simulated Tor network: %d"
+          % len(net.getNodes()))
+    print("Number of simulated clients: %d (%d worker processes)"
+          % (args.clients, args.workers))
+
+    hist = history.ConsensusHistory() if args.history else None
+    if hist is not None:
+        hist.record(net.get_consensus())
+
+    if args.workers:
+        runner = _ParallelRunner(net, args)
+    else:
+        runner = _LocalRunner(net, args, eventLog, hist)
+
+    tracker = progress.Progress(30, net.getSimulation().clock, args.clients)
+    tracker.clientStates = runner.countStates
+    reporter = progress.makeReporter(tracker, args)
+
+    for period in xrange(30): # one hour each
+        for subperiod in xrange(30): # two minutes each
+            with tracker.phase("churn"):
+                if (subperiod % 10) == 0:
+                    # nodes left and arrived
+                    net.do_churn()
+                # nodes went up and down
+                net.updateRunning()
+
+            # the clients act for two minutes
+            with tracker.phase("clients"):
+                runner.runPeriod()
+            ok, bad = runner.getCircuits()
+            tracker.setCircuits(ok + bad, ok)
+
+        # new consensus
+        with tracker.phase("consensus"):
+            consensus = net.publish_consensus()
+            if hist is not None:
+                hist.record(consensus)
+            runner.newHour(period + 1)
+
+    ok, bad, bwSum, bwCount, exposures = runner.finish(hist)
+    if eventLog is not None:
+        eventLog.close()
+    if reporter is not None:
+        reporter.close()
+    if hist is not None:
+        hist.save(args.history)
+
+    print("Successful client circuits (total): %d (%d)" % (ok, (ok + bad)))
+    print("Percentage of successful circuits:  %f%%"
+          % ((ok / float(ok + bad)) * 100.0))
+    print("Average guard bandwidth capacity:   %d KB/s"
+          % (float(bwSum) / float(bwCount)))
+    scenario.printExposure(scenario.exposureMetrics(exposures))
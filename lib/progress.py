@@ -0,0 +1,261 @@
+#!/usr/bin/python
+# This is distributed under cc0. See the LICENCE file distributed along with
+# this code.
+
+"""Live progress and metrics for long simulations.
+
+   The simulation keeps a Progress up to date as it goes, by assigning to
+   plain attributes: no locks, so it costs next to nothing.  A Reporter's
+   background thread samples it every few seconds, and renders what it
+   finds in the Prometheus text format, which it writes to a stats file,
+   serves on a local HTTP port at /metrics, prints a summary of, or any
+   of those.  For example:
+
+       ./lib/main.py --prop259 -n 1000 --metrics-port 9100 --progress
+       curl -s localhost:9100/metrics
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import simtime
+
+
+# Prefix for the names of all our metrics.
+PREFIX = "guardsim_"
+
+
+class _Phase(object):
+    """Context manager adding the wall-clock time spent inside it to one of
+       a Progress's phases."""
+    def __init__(self, progress, name):
+        self._progress = progress
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.time()
+
+    def __exit__(self, *exc):
+        phases = self._progress.phases
+        phases[self._name] = (phases.get(self._name, 0.0) +
+                              time.time() - self._start)
+
+
+class Progress(object):
+    """Counters describing how far a simulation has got.  Only the
+       simulation changes them; anything else may read them at any time."""
+
+    def __init__(self, hours, clock=None, clients=1):
+        """Track a simulation that runs for 'hours' simulated hours, on the
+           simtime.SimClock 'clock' (or the default one), with 'clients'
+           clients."""
+        self.clock = clock if clock is not None else simtime.DEFAULT.clock
+        self.hours = hours
+        self.clients = clients
+        self.startedAt = self.clock.now()
+        self.wallStart = time.time()
+
+        # Circuits the clients have tried to build, and how many worked.
+        self.circuits = 0
+        self.succeeded = 0
+
+        # Wall-clock seconds spent in each phase of the simulation loop.
+        self.phases = {}
+
+        # A callable returning a tuple of (clients that think they're in a
+        # dystopia, clients that think the network is down), or None.
+        # It's called from the reporter's thread, so it must only read.
+        self.clientStates = None
+
+    def phase(self, name):
+        """Return a context manager that counts the time spent in it
+           towards the phase called 'name'."""
+        return _Phase(self, name)
+
+    def setCircuits(self, circuits, succeeded):
+        """Record the total number of circuits tried and built so far."""
+        self.circuits = circuits
+        self.succeeded = succeeded
+
+    def simulatedSeconds(self):
+        """Return how many simulated seconds have passed."""
+        return self.clock.now() - self.startedAt
+
+    def fractionDone(self):
+        """Return how much of the simulation has been run, from 0 to 1."""
+        if not self.hours:
+            return 1.0
+        return min(1.0, self.simulatedSeconds() / (self.hours * 3600.0))
+
+
+class Reporter(object):
+    """Samples a Progress every 'interval' seconds on a background thread.
+
+       If 'path' is given, each sample is written there, replacing the file
+       atomically.  If 'port' is given, the latest sample is served over
+       HTTP on localhost.  If 'stream' is given, a one-line summary of each
+       sample is printed to it.
+    """
+
+    def __init__(self, progress, path=None, port=None, stream=None,
+                 interval=5.0):
+        self._progress = progress
+        self._path = path
+        self._stream = stream
+        self._interval = interval
+        self._stop = threading.Event()
+
+        # The text of the latest sample, and what we need to work out
+        # rates between samples.
+        self.text = ""
+        self._lastWall = progress.wallStart
+        self._lastSim = progress.simulatedSeconds()
+
+        self._server = None
+        if port is not None:
+            self._server = HTTPServer(("127.0.0.1", port), _MetricsHandler)
+            self._server.reporter = self
+
+        self.sample()
+        self._threads = [ threading.Thread(target=self._run) ]
+        if self._server is not None:
+            self._threads.append(
+                threading.Thread(target=self._server.serve_forever))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.sample()
+
+    def sample(self):
+        """Read the Progress now, and publish what we found."""
+        p = self._progress
+        now = time.time()
+        simSeconds = p.simulatedSeconds()
+        elapsed = now - p.wallStart
+
+        # Simulated hours per second of real time, since the last sample.
+        span = now - self._lastWall
+        rate = (simSeconds - self._lastSim) / 3600.0 / span if span else 0.0
+        self._lastWall = now
+        self._lastSim = simSeconds
+
+        done = p.fractionDone()
+        eta = elapsed * (1.0 - done) / done if done else float("nan")
+
+        dystopic = down = float("nan")
+        if p.clientStates is not None:
+            dystopic, down = p.clientStates()
+
+        metrics = [
+            ("simulated_seconds", "gauge",
+             "Simulated seconds since the simulation started.", simSeconds),
+            ("simulated_hours_planned", "gauge",
+             "Simulated hours the simulation will run for.", p.hours),
+            ("simulated_hours_per_second", "gauge",
+             "Simulated hours per wall-clock second, since the last sample.",
+             rate),
+            ("wall_seconds", "gauge",
+             "Wall-clock seconds since the simulation started.", elapsed),
+            ("eta_seconds", "gauge",
+             "Estimated wall-clock seconds until the simulation finishes.",
+             eta),
+            ("clients", "gauge", "Simulated clients.", p.clients),
+            ("circuits_total", "counter",
+             "Circuits the clients have tried to build.", p.circuits),
+            ("circuits_succeeded_total", "counter",
+             "Circuits the clients have built.", p.succeeded),
+            ("clients_dystopic", "gauge",
+             "Clients that think they're on a dystopic network.", dystopic),
+            ("clients_network_down", "gauge",
+             "Clients that think the network is down.", down),
+        ]
+        lines = []
+        for name, kind, doc, value in metrics:
+            lines.append("# HELP %s%s %s" % (PREFIX, name, doc))
+            lines.append("# TYPE %s%s %s" % (PREFIX, name, kind))
+            lines.append("%s%s %s" % (PREFIX, name, _format(value)))
+        lines.append("# HELP %sphase_seconds_total Wall-clock seconds spent "
+                     "in each phase of the simulation." % PREFIX)
+        lines.append("# TYPE %sphase_seconds_total counter" % PREFIX)
+        for phase, seconds in sorted(p.phases.items()):
+            lines.append('%sphase_seconds_total{phase="%s"} %s'
+                         % (PREFIX, phase, _format(seconds)))
+        self.text = "\n".join(lines) + "\n"
+
+        if self._path:
+            tmp = self._path + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(self.text)
+            os.rename(tmp, self._path)
+
+        if self._stream is not None:
+            print("[%5.1f%%] %.1f simulated hours, %.2f h/s, %d/%d circuits, "
+                  "ETA %s" % (done * 100.0, simSeconds / 3600.0, rate,
+                              p.succeeded, p.circuits, _formatETA(eta)),
+                  file=self._stream)
+            self._stream.flush()
+
+    def close(self):
+        """Take a final sample and stop reporting."""
+        self._stop.set()
+        self._threads[0].join()
+        self.sample()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def _format(value):
+    """Format the number 'value' for the Prometheus text format."""
+    if value != value:
+        return "NaN"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def _formatETA(seconds):
+    if seconds != seconds:
+        return "unknown"
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """Hands out the reporter's latest sample at /metrics."""
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.reporter.text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def makeReporter(progress, args):
+    """Return a Reporter for 'progress' as configured by the commandline
+       options 'args', or None if they don't ask for one."""
+    if not (args.metrics_file or args.metrics_port is not None or
+            args.progress):
+        return None
+    return Reporter(progress, args.metrics_file, args.metrics_port,
+                    sys.stderr if args.progress else None,
+                    args.metrics_interval)
@@ -0,0 +1,365 @@
+#!/usr/bin/python
+# This is distributed under cc0. See the LICENCE file distributed along with
+# this code.
+
+"""Run replicates of scenarios until the metrics we care about are known
+   precisely enough, instead of guessing a replicate count up front.
+
+   Each cell (a scenario and a set of client parameters) keeps getting new
+   replicates, with seeds 0, 1, 2, ..., until the confidence interval on
+   every target metric is narrower than asked for, or the budget of runs
+   is spent.  Across a sweep, each round gives more runs to the cells
+   that are furthest from converging, so easy scenarios stop early and
+   noisy ones get the samples they need.
+
+   Cells are described by the same JSON spec files as sweep.py (the
+   "seeds" key is ignored).  For example:
+
+       ./lib/replicate.py SPEC -t success_rate=0.001 \\
+           -t avg_bandwidth=0.05 --relative avg_bandwidth -j 4
+
+   To compare trying primary guards in parallel with trying them one at a
+   time, give the same scenarios two sets of parameters that differ only
+   in PARALLEL_GUARD_ATTEMPTS, and watch the connection metrics:
+
+       {"scenarios": {"plain": {}, "flaky": {"flaky_network": true}},
+        "params": {"sequential": {"PROP259": true},
+                   "parallel": {"PROP259": true,
+                                "PARALLEL_GUARD_ATTEMPTS": 3}},
+        "hours": 3}
+
+       ./lib/replicate.py SPEC -t connect_time=0.05 \\
+           -t bootstrap_latency=0.05 --relative connect_time \\
+           --relative bootstrap_latency -t distinct_guards=0.5 -j 4
+
+   Each scenario's two cells are printed next to each other.
+
+   Every replicate is a simulation of its own, so they can also share one
+   process, running in threads (--threads): that saves starting a process
+   and importing everything for each run, and on a free-threaded Python
+   the threads run in parallel.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import math
+
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from py3hax import *
+import scenario
+
+
+# Two-sided critical values of the normal distribution.
+Z_VALUES = {
+    0.90: 1.6449,
+    0.95: 1.9600,
+    0.99: 2.5758,
+}
+
+
+# Two-sided critical values of Student's t distribution with 1, 2, ... 30
+# degrees of freedom, at each confidence level in Z_VALUES.
+T_VALUES = {
+    0.90: (6.3138, 2.9200, 2.3534, 2.1318, 2.0150, 1.9432, 1.8946, 1.8595,
+           1.8331, 1.8125, 1.7959, 1.7823, 1.7709, 1.7613, 1.7531, 1.7459,
+           1.7396, 1.7341, 1.7291, 1.7247, 1.7207, 1.7171, 1.7139, 1.7109,
+           1.7081, 1.7056, 1.7033, 1.7011, 1.6991, 1.6973),
+    0.95: (12.7062, 4.3027, 3.1824, 2.7764, 2.5706, 2.4469, 2.3646, 2.3060,
+           2.2622, 2.2281, 2.2010, 2.1788, 2.1604, 2.1448, 2.1314, 2.1199,
+           2.1098, 2.1009, 2.0930, 2.0860, 2.0796, 2.0739, 2.0687, 2.0639,
+           2.0595, 2.0555, 2.0518, 2.0484, 2.0452, 2.0423),
+    0.99: (63.6567, 9.9248, 5.8409, 4.6041, 4.0321, 3.7074, 3.4995, 3.3554,
+           3.2498, 3.1693, 3.1058, 3.0545, 3.0123, 2.9768, 2.9467, 2.9208,
+           2.8982, 2.8784, 2.8609, 2.8453, 2.8314, 2.8188, 2.8073, 2.7969,
+           2.7874, 2.7787, 2.7707, 2.7633, 2.7564, 2.7500),
+}
+
+# A metric that came out the same in every replicate has a confidence
+# interval of width zero, but a handful of identical results doesn't prove
+# it never varies.  We only believe it once this many agree.
+MIN_AGREEING = 10
+
+
+def criticalValue(confidence, df):
+    """Return the two-sided critical value of Student's t distribution with
+       'df' degrees of freedom, at one of the confidence levels in Z_VALUES.
+       (Beyond the end of T_VALUES, we use the Cornish-Fisher expansion
+       around the normal value, which is accurate to 4 places there.)"""
+    if df <= len(T_VALUES[confidence]):
+        return T_VALUES[confidence][df - 1]
+    z = Z_VALUES[confidence]
+    return (z + (z ** 3 + z) / (4.0 * df) +
+            (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96.0 * df ** 2) +
+            (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) /
+            (384.0 * df ** 3))
+
+
+class RunningStats(object):
+    """Mean and variance of a stream of numbers, updated in O(1) per number
+       (Welford's method)."""
+
+    def __init__(self):
+        self._n = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, x):
+        self._n += 1
+        delta = x - self._mean
+        self._mean += delta / self._n
+        self._m2 += delta * (x - self._mean)
+
+    def count(self):
+        return self._n
+
+    def mean(self):
+        return self._mean
+
+    def variance(self):
+        """Return the sample variance, or infinity if we have fewer than two
+           samples."""
+        if self._n < 2:
+            return float("inf")
+        return self._m2 / (self._n - 1)
+
+    def halfWidth(self, confidence=0.95):
+        """Return the half-width of the confidence interval on the mean."""
+        if self._n < 2:
+            return float("inf")
+        return (criticalValue(confidence, self._n - 1) *
+                math.sqrt(self.variance() / self._n))
+
+
+class Cell(object):
+    """A scenario and client parameters that we're replicating, and what
+       we've learned about them so far."""
+
+    def __init__(self, name, scen, params, hours, targets, relative=()):
+        """'targets' maps each metric name to the confidence interval
+           half-width we want for it; for metrics in 'relative', that
+           half-width is a fraction of the metric's mean."""
+        self.name = name
+        self.scenario = scen
+        self.params = params
+        self.hours = hours
+        self._targets = targets
+        self._relative = set(relative)
+        self.stats = dict((metric, RunningStats()) for metric in targets)
+        self._n = 0
+        # The seed for the next replicate we schedule.
+        self.nextSeed = 0
+
+    def count(self):
+        return self._n
+
+    def add(self, result):
+        """Add a replicate's result.  Metrics that it has no value for
+           (like time_to_first_evil, if it never used an evil guard) are
+           left out of their statistics."""
+        self._n += 1
+        for metric, stats in self.stats.items():
+            if result[metric] is not None:
+                stats.add(result[metric])
+
+    def unmeasured(self):
+        """Return the target metrics that none of our replicates had a value
+           for, once we've run at least MIN_AGREEING of them.  More
+           replicates probably won't give us any either, so we stop waiting
+           for these metrics to converge."""
+        if self._n < MIN_AGREEING:
+            return []
+        return sorted(metric for metric, stats in self.stats.items()
+                      if not stats.count())
+
+    def _target(self, metric):
+        target = self._targets[metric]
+        if metric in self._relative:
+            target *= abs(self.stats[metric].mean())
+        return target
+
+    def shortfall(self, confidence=0.95):
+        """Return how far we are from converging: the largest ratio, over
+           all target metrics, of the current half-width to the target.
+           We've converged once this is at most 1.  A metric that hasn't
+           varied at all only counts as converged after MIN_AGREEING
+           replicates, and unmeasured() metrics don't count."""
+        worst = 0.0
+        unmeasured = self.unmeasured()
+        for metric, stats in self.stats.items():
+            if metric in unmeasured:
+                continue
+            hw = stats.halfWidth(confidence)
+            target = self._target(metric)
+            if hw == 0:
+                if stats.count() < MIN_AGREEING:
+                    return float("inf")
+                continue
+            if target <= 0:
+                return float("inf")
+            worst = max(worst, hw / target)
+        return worst
+
+    def wanted(self, confidence=0.95):
+        """Estimate how many more replicates we need to converge, given that
+           the half-width shrinks with the square root of the count."""
+        shortfall = self.shortfall(confidence)
+        if shortfall <= 1:
+            return 0
+        if shortfall == float("inf"):
+            return max(1, MIN_AGREEING - self.count())
+        return max(1, int(math.ceil(self.count() * (shortfall ** 2 - 1))))
+
+
+def _runReplicate(job):
+    """Pool entry point: run one replicate, quietly."""
+    idx, scen, params, seed, hours = job
+    with scenario.Quiet():
+        return idx, scenario.runScenario(scen, params, seed, hours)
+
+
+def _runJobs(jobs, pool):
+    if pool is None:
+        return [ _runReplicate(job) for job in jobs ]
+    return pool.imap_unordered(_runReplicate, jobs)
+
+
+def replicate(cells, budget=1000, minReplicates=5, maxRound=None,
+              confidence=0.95, pool=None, progress=None):
+    """Replicate every Cell in 'cells' until each one converges, or until
+       'budget' replicates have been run in total.
+
+       Every cell gets 'minReplicates' replicates to start with.  After that,
+       each round runs what each unconverged cell estimates it still
+       needs, capped at 'maxRound' replicates in total per round (by
+       default, 4 times the number of cells) and shared out in proportion to
+       those estimates.  If 'pool' is a multiprocessing.Pool or ThreadPool,
+       replicates run in it.  If given, 'progress' is called with 'cells'
+       after each round.
+
+       Return the number of replicates run.
+    """
+    if maxRound is None:
+        maxRound = 4 * len(cells)
+    used = 0
+
+    jobs = []
+    for idx, cell in enumerate(cells):
+        for _ in xrange(minReplicates):
+            jobs.append(idx)
+
+    while jobs and used < budget:
+        jobs = jobs[:budget - used]
+        batch = []
+        for idx in jobs:
+            cell = cells[idx]
+            batch.append((idx, cell.scenario, cell.params, cell.nextSeed,
+                          cell.hours))
+            cell.nextSeed += 1
+        for idx, result in _runJobs(batch, pool):
+            cells[idx].add(result)
+        used += len(batch)
+        if progress is not None:
+            progress(cells)
+
+        # Spend the next round where the variance is.
+        wanted = [ (idx, cell.wanted(confidence))
+                   for idx, cell in enumerate(cells) ]
+        total = sum(w for _, w in wanted)
+        jobs = []
+        for idx, w in wanted:
+            if w:
+                share = int(math.ceil(w * min(1.0, float(maxRound) / total)))
+                jobs.extend([idx] * share)
+
+    return used
+
+
+def makeCells(spec, targets, relative=()):
+    """Return a list of Cells for every combination of scenario and
+       parameters in the sweep spec 'spec'."""
+    cells = []
+    for scenName in sorted(spec["scenarios"]):
+        for paramsName in sorted(spec["params"]):
+            cells.append(Cell("%s/%s" % (scenName, paramsName),
+                              spec["scenarios"][scenName],
+                              spec["params"][paramsName],
+                              spec.get("hours", 30),
+                              targets, relative))
+    return cells
+
+
+def _printCells(cells, confidence):
+    for cell in cells:
+        unmeasured = cell.unmeasured()
+        parts = [ "%s=n/a" % metric if metric in unmeasured else
+                  "%s=%g+-%g" % (metric, stats.mean(),
+                                 stats.halfWidth(confidence))
+                  for metric, stats in sorted(cell.stats.items()) ]
+        status = "converged" if cell.shortfall(confidence) <= 1 else "open"
+        print("%-30s n=%-4d %-9s %s" % (cell.name, cell.count(), status,
+                                        " ".join(parts)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=("Replicate the cells of a sweep until their confidence "
+                     "intervals are narrow enough."))
+    parser.add_argument("spec", help="A JSON file describing the sweep.")
+    parser.add_argument(
+        "-t", "--target", action="append", metavar="METRIC=HALFWIDTH",
+        help=("Keep going until the confidence interval half-width on METRIC "
+              "is at most HALFWIDTH.  May be given more than once.  "
+              "(Default: success_rate=0.002)"))
+    parser.add_argument(
+        "--relative", action="append", default=[], metavar="METRIC",
+        help="Interpret METRIC's target as a fraction of its mean.")
+    parser.add_argument(
+        "-c", "--confidence", type=float, default=0.95,
+        choices=sorted(Z_VALUES),
+        help="Confidence level of the intervals.  (Default: %(default)s)")
+    parser.add_argument(
+        "-b", "--budget", type=int, default=1000,
+        help=("Stop after this many replicates in total.  "
+              "(Default: %(default)s)"))
+    parser.add_argument(
+        "--min-replicates", type=int, default=5,
+        help="Replicates to run for every cell first.  (Default: %(default)s)")
+    parser.add_argument(
+        "-j", "--workers", type=int, default=0,
+        help="Run replicates in this many worker processes.")
+    parser.add_argument(
+        "--threads", type=int, default=0,
+        help=("Run replicates in this many threads in this process instead "
+              "of in worker processes."))
+    args = parser.parse_args(argv)
+
+    targets = {}
+    for target in (args.target or ["success_rate=0.002"]):
+        metric, _, value = target.partition("=")
+        targets[metric] = float(value)
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+    cells = makeCells(spec, targets, args.relative)
+
+    if args.threads:
+        pool = ThreadPool(args.threads)
+    elif args.workers:
+        pool = Pool(args.workers)
+    else:
+        pool = None
+    used = replicate(cells, args.budget, args.min_replicates,
+                     confidence=args.confidence, pool=pool)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print("Ran %d replicates (budget %d)" % (used, args.budget))
+    _printCells(cells, args.confidence)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,371 @@
+#!/usr/bin/python
+# This is distributed under cc0. See the LICENCE file distributed along with
+# this code.
+
+"""Keep the results of many simulation runs in a local SQLite database, so
+   we can compare algorithms across thousands of runs without scraping
+   logs.
+
+   Every run gets a row in the "runs" table: its scenario, the client
+   parameters it used, its seed, the version of this code that produced
+   it, and its summary metrics (see scenario.runScenario()).  A run is
+   only stored once, however many times it's added: a second run of the
+   same scenario, parameters, seed and length, by the same version of the
+   code, is ignored.  Rerunning after changing the code adds new rows;
+   use --where code_version=... to report on one version.
+
+   Several processes can write to one database at once: each ResultStore
+   batches its rows and writes each batch in a single transaction, and
+   the database runs in WAL mode so readers don't block writers.
+
+       ./lib/results.py ingest results.db sweepdir/results.jsonl
+       ./lib/results.py report results.db --by scenario,prop
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import os
+import sqlite3
+import subprocess
+import time
+
+from py3hax import *
+import client
+
+
+# The ClientParams we keep in their own (indexed) columns, and the column
+# names we keep them in.  These hold the values the client actually used,
+# defaults included; params_json holds the parameters exactly as given.
+PARAM_COLUMNS = [
+    ("RETRY_DELAY", "retry_delay", "REAL"),
+    ("RETRY_MULT", "retry_mult", "REAL"),
+    ("N_PRIMARY_GUARDS", "n_primary_guards", "INTEGER"),
+    ("UTOPIC_GUARDS_THRESHOLD", "utopic_guards_threshold", "REAL"),
+    ("PRIORITIZE_BANDWIDTH", "prioritize_bandwidth", "INTEGER"),
+    ("PARALLEL_GUARD_ATTEMPTS", "parallel_guard_attempts", "INTEGER"),
+]
+
+# The metrics we keep in their own columns.  Any others are only in
+# metrics_json.
+METRIC_COLUMNS = [
+    ("circuits", "INTEGER"),
+    ("succeeded", "INTEGER"),
+    ("success_rate", "REAL"),
+    ("avg_bandwidth", "REAL"),
+    ("bootstrap_time", "REAL"),
+    ("guards_added", "INTEGER"),
+    ("evil_guard_fraction", "REAL"),
+    ("evil_circuit_fraction", "REAL"),
+    ("time_to_first_evil", "REAL"),
+    ("distinct_guards", "REAL"),
+    ("guard_turnover", "REAL"),
+    ("bootstrap_latency", "REAL"),
+    ("connect_time", "REAL"),
+]
+
+SCHEMA = [ """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    scenario TEXT NOT NULL,
+    scenario_json TEXT NOT NULL,
+    prop TEXT NOT NULL,
+    params_name TEXT,
+    params_json TEXT NOT NULL,
+    seed INTEGER,
+    hours INTEGER,
+    code_version TEXT,
+    created REAL,
+    metrics_json TEXT NOT NULL
+)""" ]
+
+# Indexes on the runs table, created once all its columns exist.
+INDEXES = [ """
+CREATE INDEX IF NOT EXISTS runs_scenario ON runs (scenario, prop)
+""", """
+CREATE INDEX IF NOT EXISTS runs_params ON runs
+    (prop, n_primary_guards, retry_delay, retry_mult, utopic_guards_threshold)
+""" ]
+
+# What identifies a run: adding another run with the same values for all
+# of these does nothing.  SQLite never counts two NULLs as equal, so
+# missing values are compared as -1 (or "").
+RUN_KEY = ("scenario_json", "params_json", "COALESCE(seed, -1)",
+           "COALESCE(hours, -1)", "COALESCE(code_version, '')")
+
+_codeVersion = None
+
+def codeVersion():
+    """Return a string naming the version of this code, from git if we
+       can."""
+    global _codeVersion
+    if _codeVersion is None:
+        here = os.path.dirname(os.path.abspath(__file__))
+        try:
+            out = subprocess.check_output(
+                ["git", "describe", "--always", "--dirty"], cwd=here,
+                stderr=open(os.devnull, "w"))
+            _codeVersion = out.decode("ascii").strip()
+        except (OSError, subprocess.CalledProcessError):
+            _codeVersion = "unknown"
+    return _codeVersion
+
+
+def propName(params):
+    """Return which proposal the ClientParams keywords 'params' follow."""
+    if params.get("PROP241"):
+        return "prop241"
+    if params.get("PROP259"):
+        return "prop259"
+    return "none"
+
+
+def _paramValues(params):
+    """Return the values of the PARAM_COLUMNS for a client run with the
+       ClientParams keywords 'params'."""
+    used = client.ClientParams(**params)
+    return [ getattr(used, name, None) for name, _, _ in PARAM_COLUMNS ]
+
+
+class _Transaction(object):
+    """Context manager for a transaction holding the database's write
+       lock from the start."""
+    def __init__(self, db):
+        self._db = db
+
+    def __enter__(self):
+        self._db.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, excType, *exc):
+        self._db.execute("ROLLBACK" if excType is not None else "COMMIT")
+
+
+class ResultStore(object):
+    """A connection to a results database, which batches up the runs added
+       to it."""
+
+    def __init__(self, path, batchSize=100, timeout=60.0):
+        """Open (creating if need be) the database at 'path'.  Runs are
+           written once 'batchSize' of them are waiting, and on flush().
+           Writers wait up to 'timeout' seconds for each other."""
+        # We manage our own transactions; see _transaction().
+        self._db = sqlite3.connect(path, timeout=timeout,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._batchSize = batchSize
+        self._pending = []
+        # How many runs we've been given that were already stored.
+        self.duplicates = 0
+        self._createSchema()
+
+    def _transaction(self):
+        """Return a context manager for a transaction that takes the write
+           lock straight away, so concurrent writers queue up instead of
+           failing halfway through."""
+        return _Transaction(self._db)
+
+    def _createSchema(self):
+        with self._transaction():
+            for statement in SCHEMA:
+                self._db.execute(statement)
+            have = set(row[1] for row in
+                       self._db.execute("PRAGMA table_info(runs)"))
+            wanted = ([ (col, kind) for _, col, kind in PARAM_COLUMNS ] +
+                      METRIC_COLUMNS)
+            # Add columns for any metrics that are newer than the database.
+            for col, kind in wanted:
+                if col not in have:
+                    self._db.execute("ALTER TABLE runs ADD COLUMN %s %s"
+                                     % (col, kind))
+            for statement in INDEXES:
+                self._db.execute(statement)
+
+            # Databases from before we had a key may hold the same run
+            # more than once: keep the first copy of each.  (Those whose
+            # key left out the code version can't, so they only need the
+            # new key.)  Databases from before the key also left
+            # parameters at their defaults NULL: fill those in.
+            indexes = set(row[1] for row in
+                          self._db.execute("PRAGMA index_list(runs)"))
+            if "runs_run_key" not in indexes:
+                key = ", ".join(RUN_KEY)
+                self._db.execute(
+                    "DELETE FROM runs WHERE id NOT IN "
+                    "(SELECT MIN(id) FROM runs GROUP BY %s)" % key)
+                self._db.execute("DROP INDEX IF EXISTS runs_key")
+                self._db.execute(
+                    "CREATE UNIQUE INDEX runs_run_key ON runs (%s)" % key)
+            if "runs_key" not in indexes and "runs_run_key" not in indexes:
+                sql = ("UPDATE runs SET %s WHERE id = ?"
+                       % ", ".join("%s = ?" % col
+                                   for _, col, _ in PARAM_COLUMNS))
+                rows = list(self._db.execute(
+                    "SELECT id, params_json FROM runs"))
+                for runID, paramsJSON in rows:
+                    self._db.execute(sql, _paramValues(json.loads(paramsJSON))
+                                     + [ runID ])
+
+    def add(self, record):
+        """Queue a run to be written.  'record' is a dict with the keys
+           "scenario_name", "scenario", "params", "seed" and "hours", plus
+           the run's metrics (like a sweep.py result).  If it has a
+           "code_version", that's the version of the code that ran it;
+           otherwise we assume it was this one."""
+        self._pending.append(record)
+        if len(self._pending) >= self._batchSize:
+            self.flush()
+
+    def flush(self):
+        """Write every queued run that isn't already stored, in one
+           transaction."""
+        if not self._pending:
+            return
+        paramCols = [ col for _, col, _ in PARAM_COLUMNS ]
+        metricCols = [ col for col, _ in METRIC_COLUMNS ]
+        cols = (["scenario", "scenario_json", "prop", "params_name",
+                 "params_json", "seed", "hours", "code_version", "created",
+                 "metrics_json"] + paramCols + metricCols)
+        sql = ("INSERT OR IGNORE INTO runs (%s) VALUES (%s)"
+               % (", ".join(cols), ", ".join("?" * len(cols))))
+        reserved = set(["scenario_name", "scenario", "params_name", "params",
+                        "seed", "hours", "code_version"])
+        now = time.time()
+
+        with self._transaction():
+            for record in self._pending:
+                params = record["params"]
+                metrics = dict((k, v) for k, v in record.items()
+                               if k not in reserved)
+                row = ([ record["scenario_name"],
+                         json.dumps(record["scenario"], sort_keys=True),
+                         propName(params),
+                         record.get("params_name"),
+                         json.dumps(params, sort_keys=True),
+                         record.get("seed"),
+                         record.get("hours"),
+                         record.get("code_version") or codeVersion(),
+                         now,
+                         json.dumps(metrics, sort_keys=True) ] +
+                       _paramValues(params) +
+                       [ record.get(col) for col in metricCols ])
+                if not self._db.execute(sql, row).rowcount:
+                    self.duplicates += 1
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+    def compare(self, groupBy=("scenario", "prop"), metrics=("success_rate",),
+                where=None):
+        """Return a list of rows summarizing the runs grouped by the columns
+           'groupBy'.  Each row is a tuple of the group's values, its number
+           of runs, and the mean, standard deviation and number of values of
+           each metric in 'metrics' (runs with no value for a metric don't
+           count towards it).  'where' is an optional dict mapping columns
+           to the values they must have."""
+        known = set(row[1] for row in
+                    self._db.execute("PRAGMA table_info(runs)"))
+        for col in tuple(groupBy) + tuple(metrics) + tuple(where or ()):
+            if col not in known:
+                raise ValueError("No such column %r" % col)
+
+        selects = list(groupBy) + ["COUNT(*)"]
+        for m in metrics:
+            selects += [ "AVG(%s)" % m, "AVG(%s * %s)" % (m, m),
+                         "COUNT(%s)" % m ]
+        sql = "SELECT %s FROM runs" % ", ".join(selects)
+        args = []
+        if where:
+            sql += " WHERE " + " AND ".join("%s = ?" % col for col in where)
+            args = list(where.values())
+        if groupBy:
+            sql += " GROUP BY %s ORDER BY %s" % (", ".join(groupBy),
+                                                 ", ".join(groupBy))
+
+        rows = []
+        for row in self._db.execute(sql, args):
+            out = list(row[:len(groupBy) + 1])
+            for i in xrange(len(metrics)):
+                start = len(groupBy) + 1 + 3 * i
+                mean, meanSq, n = row[start:start + 3]
+                if mean is None:
+                    out += [ None, None, n ]
+                    continue
+                var = max(0.0, meanSq - mean * mean) * n / max(1, n - 1)
+                out += [ mean, math.sqrt(var), n ]
+            rows.append(tuple(out))
+        return rows
+
+
+def ingest(store, path):
+    """Add every result in the JSON-lines file 'path' (like a sweep's
+       results.jsonl) to 'store', skipping runs that failed.  Return how
+       many we read; runs that were already stored are counted in
+       store.duplicates."""
+    n = 0
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if "error" not in record:
+                    store.add(record)
+                    n += 1
+    store.flush()
+    return n
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Store and compare simulation results.")
+    sub = parser.add_subparsers(dest="command")
+
+    p = sub.add_parser("ingest", help="Add JSON-lines results to a database.")
+    p.add_argument("db", help="The SQLite database.")
+    p.add_argument("files", nargs="+", help="JSON-lines result files.")
+
+    p = sub.add_parser("report", help="Compare groups of runs.")
+    p.add_argument("db", help="The SQLite database.")
+    p.add_argument(
+        "--by", default="scenario,prop",
+        help="Comma-separated columns to group by.  (Default: %(default)s)")
+    p.add_argument(
+        "--metrics", default="success_rate,avg_bandwidth",
+        help="Comma-separated metrics to summarize.  (Default: %(default)s)")
+    p.add_argument(
+        "--where", action="append", default=[], metavar="COLUMN=VALUE",
+        help="Only include runs where COLUMN is VALUE.")
+
+    args = parser.parse_args(argv)
+    store = ResultStore(args.db)
+
+    if args.command == "ingest":
+        for path in args.files:
+            before = store.duplicates
+            n = ingest(store, path)
+            print("%s: %d runs, %d already stored"
+                  % (path, n, store.duplicates - before))
+        store.close()
+        return
+
+    groupBy = [ c for c in args.by.split(",") if c ]
+    metrics = [ m for m in args.metrics.split(",") if m ]
+    where = {}
+    for clause in args.where:
+        col, _, value = clause.partition("=")
+        where[col] = value
+
+    header = groupBy + ["runs"]
+    for m in metrics:
+        header += [ m, "sd", "n" ]
+    print("\t".join(header))
+    for row in store.compare(groupBy, metrics, where):
+        print("\t".join("%.6g" % v if isinstance(v, float) else str(v)
+                        for v in row))
+    store.close()
+
+if __name__ == '__main__':
+    main()
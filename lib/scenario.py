@@ -0,0 +1,330 @@
+#!/usr/bin/python
+# This is distributed under cc0. See the LICENCE file distributed along with
+# this code.
+
+"""Turn parsed commandline options into the pieces of a simulation: the
+   Tor network, the local network each client sees it through, and the
+   client's parameters.  Also, run a single client through a scenario and
+   summarize how it did.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import threading
+
+from py3hax import *
+import bandwidth
+import tornet
+import client
+import paths
+import progress
+import simtime
+
+# The options that describe a scenario (as opposed to the client's
+# parameters), with their defaults.  These are the network options from
+# options.makeOptionsParser().
+SCENARIO_DEFAULTS = {
+    "total_relays": None,
+    "fascist_firewall": False,
+    "flaky_network": False,
+    "evil_filtering": False,
+    "sniper_network": False,
+    "port_policy": None,
+    "filtered_fraction": 0.0,
+    "bandwidth_model": "gamma",
+    "bandwidth_file": None,
+    "bandwidth_drift": 0.0,
+    "full_paths": False,
+    "warm_start": 0.0,
+}
+
+# Simulated seconds between each time the network churns, in runClient()
+# and population simulations.
+CHURN_INTERVAL = 10 * 120
+
+# How many relays the network has, unless the scenario says otherwise.
+NETWORK_SIZE = 1000
+
+
+def makeNetwork(args, eventLog=None, sim=None):
+    """Create the (undecorated) simulated Tor network, as part of the
+       simtime.Simulation 'sim' (or the default one), recording its events
+       in the events.EventWriter 'eventLog' if we have one."""
+    num = NETWORK_SIZE if not args.total_relays else args.total_relays
+    model = bandwidth.makeModel(args.bandwidth_model, args.bandwidth_file)
+    net = tornet.Network(num, eventLog=eventLog, bandwidthModel=model,
+                         bandwidthDrift=args.bandwidth_drift, sim=sim)
+    if args.warm_start:
+        net.warmStart()
+    return net
+
+# The scenario options under which clients lose guards to their local
+# network as well as to churn, which Client.warmStart() doesn't model.
+WARM_START_CONFLICTS = ("fascist_firewall", "flaky_network", "evil_filtering",
+                        "sniper_network", "port_policy", "filtered_fraction")
+
+def warmStartClient(c, net, args):
+    """If 'args' ask for a warm start, give the new client 'c', on the
+       (decorated) network 'net', the guards it might have after running
+       for args.warm_start hours.  Raise ValueError if the warm start
+       wouldn't stand in for a burn-in."""
+    if args.warm_start:
+        conflicts = [ name for name in WARM_START_CONFLICTS
+                      if getattr(args, name) ]
+        if conflicts:
+            raise ValueError("Warm starts don't model guards lost to %s"
+                             % ", ".join(conflicts))
+        c.warmStart(args.warm_start * 3600, net.deathRate(CHURN_INTERVAL))
+
+def makePolicy(args, n=0, cache=None):
+    """Return the policy (a tornet.ReachabilityPolicy, or a
+       tornet.MiddleboxPolicy with --filtered-fraction) for client number
+       'n', or None if 'args' don't give clients one.  Clients are given
+       the policies in args.port_policy in turn.  If 'cache' is a dict,
+       clients whose firewalls are the same share a single
+       ReachabilityPolicy from it."""
+    portPolicies = args.port_policy or []
+    if not portPolicies and not args.filtered_fraction:
+        return None
+
+    ports = None
+    if portPolicies:
+        ports = portPolicies[n % len(portPolicies)]
+        if isinstance(ports, str):
+            ports = ports.split(",")
+        ports = tuple(sorted(int(p) for p in ports))
+
+    if cache is not None and ports in cache:
+        policy = cache[ports]
+    else:
+        policy = tornet.ReachabilityPolicy(ports)
+        if cache is not None:
+            cache[ports] = policy
+    if args.filtered_fraction:
+        # Every client's middlebox filters different relays.
+        policy = tornet.MiddleboxPolicy(policy, args.filtered_fraction, n)
+    return policy
+
+def decorateNetwork(net, args, policy=None):
+    """Wrap 'net' in the decorators simulating a client's local network
+       connection, and return the result.  If the client has a
+       ReachabilityPolicy or MiddleboxPolicy, it is 'policy'."""
+    if policy is not None:
+        net = tornet.PolicyNetwork(net, policy)
+    if args.fascist_firewall:
+        net = tornet.FascistNetwork(net)
+    if args.flaky_network:
+        net = tornet.FlakyNetwork(net)
+    if args.evil_filtering:
+        net = tornet.EvilFilteringNetwork(net)
+    if args.sniper_network:
+        net = tornet.SniperNetwork(net)
+    return net
+
+def makePathBuilder(args):
+    """Return a paths.PathBuilder for clients to share, or None if 'args'
+       say circuits end at the guard."""
+    return paths.PathBuilder() if args.full_paths else None
+
+def makeClientParams(args):
+    """Return the client.ClientParams selected by 'args'."""
+    return client.ClientParams(
+        PROP241=args.prop241,
+        PROP259=args.prop259,
+        PARALLEL_GUARD_ATTEMPTS=args.parallel_guards,
+        PRIORITIZE_BANDWIDTH=not args.no_prioritize_bandwidth)
+
+def maybeRestart(c, args, hour, stateFile=None):
+    """Restart or HUP the client 'c' if 'args' say it's time to, at the
+       end of simulated hour number 'hour'."""
+    if args.restart_every and hour % args.restart_every == 0:
+        c.restart(stateFile)
+    elif args.hup_every and hour % args.hup_every == 0:
+        c.hup(stateFile)
+
+class Quiet(object):
+    """Context manager that throws away anything printed to stdout, since
+       the client is very chatty.  Simulations running in several threads
+       at once can all use it: stdout comes back when the last one
+       finishes."""
+    _lock = threading.Lock()
+    _depth = 0
+    _stdout = None
+
+    def __enter__(self):
+        with Quiet._lock:
+            if Quiet._depth == 0:
+                Quiet._stdout = sys.stdout
+                sys.stdout = open(os.devnull, "w")
+            Quiet._depth += 1
+
+    def __exit__(self, *exc):
+        with Quiet._lock:
+            Quiet._depth -= 1
+            if Quiet._depth == 0:
+                sys.stdout.close()
+                sys.stdout = Quiet._stdout
+
+def runClient(c, net, hours=30, onHour=None, tracker=None):
+    """Run client 'c' on the (decorated) network 'net' for 'hours' simulated
+       hours, and return a tuple of (successful circuits, failed circuits).
+       If given, 'onHour' is called with the hour number after each new
+       consensus.  We keep the progress.Progress 'tracker' up to date, if
+       we have one."""
+    ok = 0
+    bad = 0
+    clock = net.getSimulation().clock
+    if tracker is None:
+        tracker = progress.Progress(hours, clock)
+
+    for period in xrange(hours): # one hour each
+        for subperiod in xrange(30): # two minutes each
+            with tracker.phase("churn"):
+                if (subperiod % 10) == 0:
+                    # nodes left and arrived
+                    net.do_churn()
+                # nodes went up and down
+                net.updateRunning()
+
+            with tracker.phase("clients"):
+                for attempts in xrange(6): # 20 sec each
+
+                    # actually have the client act.
+                    if c.buildCircuit():
+                        ok += 1
+                    else:
+                        bad += 1
+
+                    # time passed
+                    clock.advanceTime(20)
+            tracker.setCircuits(ok + bad, ok)
+
+        # new consensus
+        with tracker.phase("consensus"):
+            net.publish_consensus()
+            c.updateGuardLists()
+
+            if onHour is not None:
+                onHour(period + 1)
+
+    return ok, bad
+
+def exposureMetrics(exposures):
+    """Summarize a list of client.Client.exposure() dicts, one per client,
+       as a dict of metrics:
+
+       - "evil_circuit_fraction": the fraction of all circuits built that
+         went through evil guards;
+       - "exposed_clients": the fraction of clients that ever did that;
+       - "time_to_first_evil": the mean time until each client that did
+         that first did it, or None if no client did;
+       - "distinct_guards": the mean number of guards each client tried;
+       - "guard_turnover": the mean number of times per hour that a
+         client's circuits switched guards.
+    """
+    n = float(len(exposures))
+    built = sum(e["circuits_built"] for e in exposures)
+    evil = sum(e["evil_circuits"] for e in exposures)
+    exposed = [ e for e in exposures if e["first_evil_after"] is not None ]
+    return {
+        "evil_circuit_fraction": evil / float(built) if built else 0.0,
+        "exposed_clients": len(exposed) / n,
+        "time_to_first_evil": (
+            sum(e["first_evil_after"] for e in exposed) / float(len(exposed))
+            if exposed else None),
+        "distinct_guards": sum(e["distinct_guards"] for e in exposures) / n,
+        "guard_turnover": sum(
+            e["guard_switches"] * 3600.0 / e["elapsed"]
+            if e["elapsed"] else 0.0
+            for e in exposures) / n,
+    }
+
+def printExposure(metrics):
+    """Print the dict returned by exposureMetrics()."""
+    print("Circuits through evil guards:       %f%%"
+          % (metrics["evil_circuit_fraction"] * 100.0))
+    print("Clients that used an evil guard:    %f%%"
+          % (metrics["exposed_clients"] * 100.0))
+    if metrics["time_to_first_evil"] is None:
+        print("Time until first evil guard (mean): n/a")
+    else:
+        print("Time until first evil guard (mean): %d s"
+              % metrics["time_to_first_evil"])
+    print("Distinct guards contacted (mean):   %.2f"
+          % metrics["distinct_guards"])
+    print("Guard turnover (mean):              %.3f switches/hour"
+          % metrics["guard_turnover"])
+
+def scenarioArgs(scenario):
+    """Return an argparse.Namespace for the scenario described by the dict
+       'scenario', which may set any of the keys in SCENARIO_DEFAULTS."""
+    unknown = set(scenario) - set(SCENARIO_DEFAULTS)
+    if unknown:
+        raise ValueError("Unknown scenario options: %s"
+                         % ", ".join(sorted(unknown)))
+    values = dict(SCENARIO_DEFAULTS)
+    values.update(scenario)
+    return argparse.Namespace(**values)
+
+def runScenario(scenario, params, seed, hours=30, burnIn=0):
+    """Run one fresh client through 'hours' hours of 'scenario' (a dict, as
+       for scenarioArgs()), using a client.ClientParams built from the
+       keyword arguments in the dict 'params', with the random number
+       generator seeded from 'seed'.  The run is a simtime.Simulation of
+       its own, so any number of them can go on in one process at once.
+       If 'burnIn' is given, run that many hours first without measuring
+       anything.
+
+       Return a dict of summary metrics.
+    """
+    sim = simtime.Simulation(seed)
+
+    args = scenarioArgs(scenario)
+    net = makeNetwork(args, sim=sim)
+    policy = makePolicy(args)
+    net = decorateNetwork(net, args, policy)
+    c = client.Client(net, client.ClientParams(**params), policy=policy,
+                      paths=makePathBuilder(args))
+    warmStartClient(c, net, args)
+
+    if burnIn:
+        runClient(c, net, burnIn)
+        c._resetStats()
+    start = sim.now()
+
+    ok, bad = runClient(c, net, hours)
+
+    bandwidths = c._GUARD_BANDWIDTHS
+    guards = [ g for g in c.allPrimaryGuards if g._addedAt >= start ]
+    bootstrap = c._FIRST_CIRCUIT_AT
+    metrics = exposureMetrics([c.exposure()])
+    del metrics["exposed_clients"]
+    metrics.update({
+        "circuits": ok + bad,
+        "succeeded": ok,
+        "success_rate": ok / float(ok + bad),
+        "avg_bandwidth": (float(sum(bandwidths)) / len(bandwidths)
+                          if bandwidths else 0.0),
+        # If we never built a circuit, count the whole run.
+        "bootstrap_time": (bootstrap if bootstrap is not None else
+                           sim.now()) - start,
+        # Simulated seconds until our first circuit was built, including
+        # the time spent connecting to guards; if we never built one, the
+        # whole run.
+        "bootstrap_latency": (c._BOOTSTRAP_LATENCY
+                              if c._BOOTSTRAP_LATENCY is not None else
+                              sim.now() - start),
+        # Mean simulated seconds per circuit spent connecting to guards.
+        "connect_time": c._CONNECT_TIME_TOTAL / float(ok + bad),
+        # Guards are never removed from the primary lists, so these are
+        # the ones we picked while we were measuring: not those from the
+        # burn-in or warm start.
+        "guards_added": len(guards),
+        "evil_guard_fraction": (
+            float(len([ g for g in guards if g.node.isReallyEvil() ])) /
+            len(guards) if guards else 0.0),
+    })
+    return metrics
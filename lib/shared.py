@@ -0,0 +1,293 @@
+#!/usr/bin/python
+# This is distributed under cc0. See the LICENCE file distributed along with
+# this code.
+
+"""Simulation state kept in shared memory, so that worker processes running
+   slices of a client population can read it without it being pickled and
+   sent to each of them.
+
+   Everything here is allocated with multiprocessing.sharedctypes before the
+   workers are started, and is inherited by them when they fork.
+"""
+
+from multiprocessing.sharedctypes import RawArray
+
+from py3hax import *
+import simtime
+import tornet
+
+
+class SharedConsensus(object):
+    """A fixed-size block of shared memory holding the most recently
+       published tornet.Consensus, as node indices.
+
+       The coordinator write()s each new consensus once; workers read() it
+       and get back a Consensus made of their own Node objects, rebuilding
+       it only when the generation number has changed.
+    """
+    def __init__(self, capacity):
+        """Create a block with room for consensuses of up to 'capacity'
+           nodes."""
+        self._capacity = capacity
+
+        # generation, number of utopic guards, number of dystopic guards,
+        # and the number of node indices the network had handed out.
+        self._header = RawArray('l', 4)
+
+        # the utopic guards' indices, then the dystopic guards', each in
+        # consensus (bandwidth) order.
+        self._order = RawArray('i', capacity)
+
+        # per-process cache of the last Consensus we read().
+        self._cached = None
+
+    def write(self, consensus, nIndices):
+        """Publish 'consensus', all of whose nodes have indices less than
+           'nIndices'."""
+        utopic = consensus.getUtopicGuards()
+        dystopic = consensus.getDystopicGuards()
+        nU = len(utopic)
+        nD = len(dystopic)
+        if nU + nD > self._capacity:
+            raise ValueError("Consensus of %d nodes doesn't fit in a shared "
+                             "block of %d" % (nU + nD, self._capacity))
+
+        order = self._order
+        for i, node in enumerate(utopic):
+            order[i] = node.getIndex()
+        for i, node in enumerate(dystopic):
+            order[nU + i] = node.getIndex()
+
+        # Write the generation last, so that a reader never sees a new
+        # generation number alongside a half-written node list.
+        header = self._header
+        header[1] = nU
+        header[2] = nD
+        header[3] = nIndices
+        header[0] = consensus.getGeneration()
+
+    def getGeneration(self):
+        """Return the generation of the consensus currently in the block."""
+        return self._header[0]
+
+    def read(self, network):
+        """Return the consensus in the block, built from the Nodes that
+           'network' (this process's copy of it) knows."""
+        generation = self._header[0]
+        if self._cached is not None and \
+           self._cached.getGeneration() == generation:
+            return self._cached
+
+        nU = self._header[1]
+        nD = self._header[2]
+        nodeAt = network.getNodeByIndex
+        order = self._order
+        utopic = [ nodeAt(order[i]) for i in xrange(nU) ]
+        dystopic = [ nodeAt(order[i]) for i in xrange(nU, nU + nD) ]
+
+        self._cached = tornet.Consensus(generation, utopic, dystopic,
+                                        self._header[3])
+        return self._cached
+
+
+# Length of a Node.getID() string.
+ID_LEN = 40
+
+class SharedNetworkState(object):
+    """The per-node state of a tornet.Network, kept in shared memory arrays
+       indexed by Node.getIndex().
+
+       Only the coordinator process changes the network (churn, liveness,
+       and any kills reported back by workers); after each change it calls
+       publish(), and workers see the new state through their
+       SharedNetworkView without anything being copied to them.
+    """
+    def __init__(self, network, capacity):
+        """Allocate room for 'capacity' node indices, and publish the current
+           state of 'network'.  Call this before starting the workers."""
+        self._capacity = capacity
+
+        # How many node indices the network has handed out.
+        self._nIndices = RawArray('l', 1)
+
+        # Things that change as the simulation goes on.  _bwVersion goes up
+        # whenever any node's bandwidth changes.
+        self._up = RawArray('b', capacity)
+        self._bandwidth = RawArray('l', capacity)
+        self._bwVersion = RawArray('l', 1)
+
+        # Things that never change once a node exists.  _known records
+        # which indices we've filled them in for.
+        self._known = RawArray('b', capacity)
+        self._port = RawArray('i', capacity)
+        self._evil = RawArray('b', capacity)
+        self._ids = RawArray('c', capacity * ID_LEN)
+
+        # The indices of the nodes that were on the network when we last
+        # published it.  Only the coordinator uses this.
+        self._published = set()
+
+        self.publish(network)
+
+    def publish(self, network):
+        """Copy the current state of every node on 'network' into shared
+           memory.  Only the coordinator may call this, and never while
+           workers are running their clients."""
+        nIndices = self._nIndices[0]
+        bwChanged = False
+        published = set()
+        for node in network.getNodes():
+            idx = node.getIndex()
+            published.add(idx)
+            if idx >= self._capacity:
+                raise ValueError("Node index %d doesn't fit in shared state "
+                                 "of %d nodes" % (idx, self._capacity))
+            if not self._known[idx]:
+                self._port[idx] = node.getPort()
+                self._evil[idx] = node.isReallyEvil()
+                start = idx * ID_LEN
+                self._ids[start:start + ID_LEN] = node.getID().encode("ascii")
+                self._known[idx] = 1
+            self._up[idx] = node.isReallyUp()
+            if self._bandwidth[idx] != node.bandwidth:
+                self._bandwidth[idx] = node.bandwidth
+                bwChanged = True
+            if idx >= nIndices:
+                nIndices = idx + 1
+        # Nodes that have been killed since are gone from the network.
+        for idx in self._published - published:
+            self._up[idx] = 0
+        self._published = published
+        self._nIndices[0] = nIndices
+        if bwChanged:
+            self._bwVersion[0] += 1
+
+    def getNIndices(self):
+        """Return how many node indices have been published."""
+        return self._nIndices[0]
+
+    def getBandwidthVersion(self):
+        """Return a number that changes whenever any bandwidth does."""
+        return self._bwVersion[0]
+
+    def getBandwidth(self, idx):
+        """Return the current bandwidth of the node with index 'idx'."""
+        return self._bandwidth[idx]
+
+    def isUp(self, idx):
+        """Return true iff the node with index 'idx' is running."""
+        return bool(self._up[idx])
+
+    def makeNode(self, idx):
+        """Build a local tornet.Node for the published node with index 'idx',
+           or return None if there isn't one."""
+        if idx >= self._capacity or not self._known[idx]:
+            return None
+        node = tornet.Node("node%d" % idx, port=self._port[idx],
+                           evil=bool(self._evil[idx]), index=idx,
+                           bandwidth=self._bandwidth[idx])
+        start = idx * ID_LEN
+        nodeID = self._ids[start:start + ID_LEN]
+        if not isinstance(nodeID, str):
+            nodeID = nodeID.decode("ascii")
+        node._id = nodeID
+        return node
+
+
+class SharedNetworkView(object):
+    """A worker process's view of a network whose state lives in a
+       SharedNetworkState.  It implements the parts of tornet.Network's
+       interface that clients (and network decorators) use, so they can
+       use it directly.  Consensuses come from the coordinator, through a
+       SharedConsensus, so there's no making or publishing them here.
+
+       Liveness is read straight from shared memory.  Nodes that attackers
+       kill are only recorded here: the coordinator collects them with
+       takeKills() at the end of each tick and applies them, so that every
+       worker sees the same network regardless of how clients are split up.
+       (A population run in one process does the same, through a
+       tornet.DeferredKillNetwork.)  Only the coordinator can add nodes, so
+       a view can't make the dead guards a warm start needs, and
+       --warm-start is refused with --workers.
+    """
+    def __init__(self, state, consensus, network):
+        """Create a view of 'state', with published consensuses in the
+           SharedConsensus 'consensus'.  'network' is this process's (forked)
+           copy of the network, whose Nodes we reuse."""
+        self._state = state
+        self._consensus = consensus
+
+        self._nodesByIndex = dict((node.getIndex(), node)
+                                  for node in network.getNodes())
+        self._nodesByID = dict((node.getID(), node)
+                               for node in network.getNodes())
+        self._synced = max(self._nodesByIndex) + 1 if self._nodesByIndex else 0
+        self._bwVersion = state.getBandwidthVersion()
+
+        # indices of the nodes killed since the last takeKills().
+        self._kills = set()
+
+    def sync(self):
+        """Create local Nodes for any nodes the coordinator has added since
+           we last looked, and catch up with any bandwidth drift.  Call this
+           at the start of every tick."""
+        nIndices = self._state.getNIndices()
+        for idx in xrange(self._synced, nIndices):
+            node = self._state.makeNode(idx)
+            if node is not None:
+                self._nodesByIndex[idx] = node
+                self._nodesByID[node.getID()] = node
+        self._synced = max(self._synced, nIndices)
+
+        bwVersion = self._state.getBandwidthVersion()
+        if bwVersion != self._bwVersion:
+            for idx, node in self._nodesByIndex.items():
+                node._bandwidth = self._state.getBandwidth(idx)
+            self._bwVersion = bwVersion
+
+    def takeKills(self):
+        """Return a sorted list of the indices of the nodes killed since the
+           last call, and forget them."""
+        kills = sorted(self._kills)
+        self._kills.clear()
+        return kills
+
+    def get_consensus(self):
+        return self._consensus.read(self)
+
+    def getNodes(self):
+        return list(self._nodesByIndex.values())
+
+    def getNode(self, nodeID):
+        return self._nodesByID.get(nodeID)
+
+    def getNodeByIndex(self, idx):
+        return self._nodesByIndex.get(idx)
+
+    def getNIndices(self):
+        return self._synced
+
+    def getSimulation(self):
+        """Each worker process runs its part of the simulation on its own
+           default clock and random number generator."""
+        return simtime.DEFAULT
+
+    def do_churn(self):
+        """Does nothing: the coordinator simulates churn."""
+        pass
+
+    def updateRunning(self):
+        """Does nothing: the coordinator decides which nodes are running."""
+        pass
+
+    def probe_node_is_up(self, node):
+        return self._state.isUp(node.getIndex())
+
+    def kill_node(self, node):
+        self._kills.add(node.getIndex())
+
+    def connect_latency(self, node):
+        return node.getLatency()
+
+    def connect_timeout(self):
+        return tornet.CONNECT_TIMEOUT
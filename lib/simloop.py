@@ -0,0 +1,86 @@
+#!/usr/bin/python
+# This is distributed under cc0. See the LICENCE file distributed along with
+# this code.
+
+"""A tiny discrete-event loop on simulated time, for modelling things a
+   client does concurrently, like connecting to several guards at once.
+
+   Callbacks are scheduled at simulated times and run in time order; the
+   loop's clock jumps straight from one to the next, so nothing ever
+   waits for real.  The clock starts at simtime.now() but runs on its
+   own, so the sub-second detail of one circuit attempt doesn't disturb
+   the global simulated time the rest of the simulation runs on.
+"""
+
+import heapq
+
+import simtime
+
+
+class Handle(object):
+    """A scheduled callback, which can be cancelled until it runs."""
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self._callback = callback
+        self._args = args
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def _run(self):
+        self._callback(*self._args)
+
+
+class EventLoop(object):
+    """Runs scheduled callbacks in simulated time order."""
+
+    def __init__(self, start=None):
+        """Start the clock at 'start', or at simtime.now() if that's None."""
+        self._now = simtime.now() if start is None else start
+        self._start = self._now
+        # heap of (when, sequence number, Handle); the sequence number
+        # keeps callbacks scheduled for the same time in order.
+        self._queue = []
+        self._seq = 0
+        self._stopped = False
+
+    def time(self):
+        """Return the loop's current simulated time."""
+        return self._now
+
+    def elapsed(self):
+        """Return how much simulated time has passed since the loop
+           started."""
+        return self._now - self._start
+
+    def callAt(self, when, callback, *args):
+        """Arrange for callback(*args) to run at simulated time 'when', and
+           return a Handle for it."""
+        handle = Handle(max(when, self._now), callback, args)
+        heapq.heappush(self._queue, (handle.when, self._seq, handle))
+        self._seq += 1
+        return handle
+
+    def callLater(self, delay, callback, *args):
+        """Arrange for callback(*args) to run 'delay' simulated seconds from
+           now, and return a Handle for it."""
+        return self.callAt(self._now + delay, callback, *args)
+
+    def stop(self):
+        """Make run() return once the callback that's running finishes."""
+        self._stopped = True
+
+    def run(self):
+        """Run callbacks until there are none left or one calls stop()."""
+        self._stopped = False
+        while self._queue and not self._stopped:
+            when, _, handle = heapq.heappop(self._queue)
+            if handle.cancelled():
+                continue
+            self._now = when
+            handle._run()
@@ -2,16 +2,68 @@
 # This is distributed under cc0. See the LICENCE file distributed along with
 # this code.
 
-"""Stupid simulated global time code."""
+"""Stupid simulated global time code.
 
-_time = 0
+   Each simulation has a Simulation object holding its own SimClock and
+   random number generator; a tornet.Network is given one when it's
+   created, and everything built on that network (clients, their guards
+   and timers) uses it.  That lets many simulations run in one process,
+   one after another, interleaved, or in threads.
+
+   The module-level functions work on DEFAULT, the simulation used when
+   nobody asks for another one, whose generator is the random module's
+   own.
+"""
+
+import random
+
+
+class SimClock(object):
+    """A simulated clock, counting seconds from the start of a simulation."""
+
+    def __init__(self, start=0):
+        self._time = start
+
+    def now(self):
+        """Return the current simulated time."""
+        return self._time
+
+    def advanceTime(self, n):
+        """Advance the current simulated time by X seconds."""
+        assert n >= 0
+        self._time += n
+
+    def reset(self):
+        """Set the simulated time back to zero, for a fresh simulation."""
+        self._time = 0
+
+
+class Simulation(object):
+    """What one simulation has of its own: a clock, and a random number
+       generator ('rng') that all its randomness comes from."""
+
+    def __init__(self, seed=None, clock=None, rng=None):
+        """Use the SimClock 'clock' (by default, a new one) and the
+           random.Random 'rng' (by default, a new one seeded with
+           'seed')."""
+        self.clock = clock if clock is not None else SimClock()
+        self.rng = rng if rng is not None else random.Random(seed)
+
+    def now(self):
+        """Return the current simulated time."""
+        return self.clock.now()
+
+
+DEFAULT = Simulation(rng=random)
 
 def now():
     """Return the current simulated time."""
-    return _time
+    return DEFAULT.clock.now()
 
 def advanceTime(n):
     """Advance the current simulated time by X seconds."""
-    global _time
-    assert n >= 0
-    _time += n
+    DEFAULT.clock.advanceTime(n)
+
+def reset():
+    """Set the current simulated time back to zero, for a fresh simulation."""
+    DEFAULT.clock.reset()
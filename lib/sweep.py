@@ -0,0 +1,380 @@
+#!/usr/bin/python
+# This is distributed under cc0. See the LICENCE file distributed along with
+# this code.
+
+"""Run a parameter sweep across any number of worker processes, on one or
+   more hosts, without an external scheduler.
+
+   The coordinator and workers talk through a shared directory:
+
+       DIR/pending/cell-NNNNNN.json          cells nobody is running
+       DIR/claimed/cell-NNNNNN.json@WORKER   cells WORKER is running
+       DIR/results/cell-NNNNNN.json          finished cells' results
+       DIR/results.jsonl                     every result, merged
+       DIR/DONE                              tells workers to exit
+
+   A worker claims a cell by renaming it out of pending/, which is atomic
+   even when several hosts share the directory.  While it runs the cell,
+   it keeps touching the claimed file; if it stops (because the worker
+   crashed), the coordinator moves the cell back to pending/ for someone
+   else to pick up.  If running a cell raises an exception, the worker
+   records that as the cell's result, with the traceback under "error",
+   and carries on.
+
+   A sweep is described by a JSON file like this:
+
+       {"scenarios": {"normal": {}, "sniper": {"sniper_network": true}},
+        "params": {"prop241": {"PROP241": true},
+                   "prop259": {"PROP259": true}},
+        "seeds": 10,
+        "hours": 30}
+
+   The scenarios are dicts for scenario.scenarioArgs(), the params are
+   keyword arguments for client.ClientParams, and every combination is run
+   with each of the seeds 0..seeds-1.
+
+   To try it all on one box:
+
+       ./lib/sweep.py run DIR SPEC -j 4
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from multiprocessing import Process
+
+from py3hax import *
+import results
+import scenario
+
+
+# How often a worker touches the cell it's running, in seconds.
+HEARTBEAT_INTERVAL = 5
+
+# How long a claimed cell can go without a heartbeat before the coordinator
+# decides its worker crashed, in seconds.
+HEARTBEAT_TIMEOUT = 60
+
+
+def makeCells(spec):
+    """Return a list of the cells (dicts) in the sweep described by the dict
+       'spec', numbered in a stable order."""
+    cells = []
+    for scenName in sorted(spec["scenarios"]):
+        for paramsName in sorted(spec["params"]):
+            for seed in xrange(spec.get("seeds", 1)):
+                cells.append({
+                    "cell": len(cells),
+                    "scenario_name": scenName,
+                    "scenario": spec["scenarios"][scenName],
+                    "params_name": paramsName,
+                    "params": spec["params"][paramsName],
+                    "seed": seed,
+                    "hours": spec.get("hours", 30),
+                })
+    return cells
+
+def runCell(cell):
+    """Run the sweep cell 'cell' and return its result record."""
+    started = time.time()
+    metrics = scenario.runScenario(cell["scenario"], cell["params"],
+                                   cell["seed"], cell["hours"])
+    record = dict((k, cell[k]) for k in
+                  ("cell", "scenario_name", "scenario", "params_name",
+                   "params", "seed", "hours"))
+    record.update(metrics)
+    record["elapsed"] = round(time.time() - started, 3)
+    record["code_version"] = results.codeVersion()
+    return record
+
+def failedCell(cell, error):
+    """Return the result record for the sweep cell 'cell', whose run raised
+       an exception with the traceback 'error'."""
+    record = dict((k, cell[k]) for k in
+                  ("cell", "scenario_name", "scenario", "params_name",
+                   "params", "seed", "hours"))
+    record["error"] = error
+    return record
+
+
+class SweepQueue(object):
+    """The shared directory through which a coordinator hands out cells and
+       workers return results."""
+
+    def __init__(self, directory):
+        self._dir = directory
+        self._pending = os.path.join(directory, "pending")
+        self._claimed = os.path.join(directory, "claimed")
+        self._results = os.path.join(directory, "results")
+        for d in (self._pending, self._claimed, self._results):
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+    def _cellName(self, n):
+        return "cell-%06d.json" % n
+
+    def _writeAtomically(self, path, data):
+        tmp = "%s.tmp.%s.%d" % (path, socket.gethostname(), os.getpid())
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    ###################
+    # Coordinator API #
+    ###################
+
+    def addCells(self, cells):
+        """Queue every cell in 'cells' that doesn't already have a result,
+           and isn't already queued or claimed."""
+        claimed = set(name.split("@")[0] for name in os.listdir(self._claimed))
+        queued = set(os.listdir(self._pending))
+        done = set(os.listdir(self._results))
+        for cell in cells:
+            name = self._cellName(cell["cell"])
+            if name not in claimed and name not in queued and name not in done:
+                self._writeAtomically(os.path.join(self._pending, name),
+                                      json.dumps(cell))
+
+    def reassignStale(self, timeout=HEARTBEAT_TIMEOUT):
+        """Move every claimed cell whose worker has stopped heartbeating
+           back to pending/.  Return how many we moved."""
+        now = time.time()
+        moved = 0
+        for name in os.listdir(self._claimed):
+            path = os.path.join(self._claimed, name)
+            try:
+                if os.path.getmtime(path) + timeout >= now:
+                    continue
+                os.rename(path, os.path.join(self._pending,
+                                             name.split("@")[0]))
+                moved += 1
+            except OSError:
+                # The worker finished (or someone else moved it) meanwhile.
+                pass
+        return moved
+
+    def countResults(self):
+        """Return how many cells have finished."""
+        return len([ n for n in os.listdir(self._results)
+                     if n.endswith(".json") ])
+
+    def countFailures(self):
+        """Return how many cells finished by raising an exception."""
+        failed = 0
+        for name in os.listdir(self._results):
+            if name.endswith(".json"):
+                with open(os.path.join(self._results, name)) as f:
+                    if "error" in json.load(f):
+                        failed += 1
+        return failed
+
+    def mergeResults(self):
+        """Write every result, in cell order, to DIR/results.jsonl, and
+           return the path."""
+        path = os.path.join(self._dir, "results.jsonl")
+        lines = []
+        for name in sorted(os.listdir(self._results)):
+            if name.endswith(".json"):
+                with open(os.path.join(self._results, name)) as f:
+                    lines.append(f.read().strip())
+        self._writeAtomically(path, "".join(line + "\n" for line in lines))
+        return path
+
+    def markDone(self):
+        """Tell the workers there's no more work coming."""
+        self._writeAtomically(os.path.join(self._dir, "DONE"), "")
+
+    def isDone(self):
+        return os.path.exists(os.path.join(self._dir, "DONE"))
+
+    def clearDone(self):
+        """Forget that an earlier sweep in this directory finished."""
+        try:
+            os.unlink(os.path.join(self._dir, "DONE"))
+        except OSError:
+            pass
+
+    ##############
+    # Worker API #
+    ##############
+
+    def claim(self, workerID):
+        """Claim a pending cell for 'workerID'.  Return a tuple of the cell
+           and the path of its claimed file, or None if nothing is pending."""
+        for name in sorted(os.listdir(self._pending)):
+            if not name.endswith(".json"):
+                continue
+            pendingPath = os.path.join(self._pending, name)
+            claimedPath = os.path.join(self._claimed,
+                                       "%s@%s" % (name, workerID))
+            try:
+                # Renaming doesn't change the mtime, so touch the file
+                # first, or the coordinator could think our claim was
+                # already stale.
+                os.utime(pendingPath, None)
+                os.rename(pendingPath, claimedPath)
+                with open(claimedPath) as f:
+                    return json.load(f), claimedPath
+            except OSError:
+                # Another worker got there first, or the coordinator
+                # took it back from us.
+                continue
+        return None
+
+    def finish(self, cell, claimedPath, record):
+        """Store the result 'record' for 'cell', and release our claim."""
+        self._writeAtomically(
+            os.path.join(self._results, self._cellName(cell["cell"])),
+            json.dumps(record, sort_keys=True))
+        try:
+            os.unlink(claimedPath)
+        except OSError:
+            # The coordinator thought we were dead and reassigned it.
+            pass
+
+
+def _heartbeat(path, stop):
+    """Touch 'path' every HEARTBEAT_INTERVAL seconds until 'stop' is set."""
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        try:
+            os.utime(path, None)
+        except OSError:
+            return
+
+def work(directory, db=None, poll=1.0):
+    """Run as a worker: keep claiming and running cells from the queue in
+       'directory' until the coordinator says we're done.  If 'db' is
+       given, also add each result to the results.ResultStore there."""
+    queue = SweepQueue(directory)
+    workerID = "%s-%d" % (socket.gethostname(), os.getpid())
+    store = results.ResultStore(db, batchSize=20) if db else None
+
+    while True:
+        claimed = queue.claim(workerID)
+        if claimed is None:
+            if store is not None:
+                # Don't sit on results while we wait.
+                store.flush()
+            if queue.isDone():
+                if store is not None:
+                    store.close()
+                return
+            time.sleep(poll)
+            continue
+
+        cell, claimedPath = claimed
+        stop = threading.Event()
+        beat = threading.Thread(target=_heartbeat, args=(claimedPath, stop))
+        beat.daemon = True
+        beat.start()
+        try:
+            with scenario.Quiet():
+                record = runCell(cell)
+        except Exception:
+            error = traceback.format_exc()
+            print("Cell %d failed:\n%s" % (cell["cell"], error),
+                  file=sys.stderr)
+            record = failedCell(cell, error)
+        finally:
+            stop.set()
+            beat.join()
+        record["worker"] = workerID
+        queue.finish(cell, claimedPath, record)
+        if store is not None and "error" not in record:
+            store.add(record)
+
+def serve(directory, spec, poll=1.0, timeout=HEARTBEAT_TIMEOUT):
+    """Run as the coordinator for the sweep described by the dict 'spec':
+       queue its cells, reassign cells whose workers die, and merge the
+       results once every cell has finished.  Return the path of the merged
+       results."""
+    queue = SweepQueue(directory)
+    queue.clearDone()
+    cells = makeCells(spec)
+    queue.addCells(cells)
+    print("Queued %d cells in %s" % (len(cells), directory))
+
+    started = time.time()
+    finished = queue.countResults()
+    while finished < len(cells):
+        time.sleep(poll)
+        moved = queue.reassignStale(timeout)
+        if moved:
+            print("Reassigned %d cells from unresponsive workers" % moved)
+        n = queue.countResults()
+        if n != finished:
+            finished = n
+            eta = ((time.time() - started) * (len(cells) - finished) /
+                   float(finished))
+            print("%d/%d cells finished, about %d s to go"
+                  % (finished, len(cells), eta))
+
+    queue.markDone()
+    failed = queue.countFailures()
+    if failed:
+        print("%d cells failed: see the \"error\" in their results" % failed)
+    return queue.mergeResults()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run a parameter sweep through a shared queue directory.")
+    sub = parser.add_subparsers(dest="command")
+
+    p = sub.add_parser("serve", help="Coordinate a sweep.")
+    p.add_argument("dir", help="The shared queue directory.")
+    p.add_argument("spec", help="A JSON file describing the sweep.")
+    p.add_argument("--timeout", type=float, default=HEARTBEAT_TIMEOUT,
+                   help=("Seconds without a heartbeat before a worker's cell "
+                         "is reassigned.  (Default: %(default)s)"))
+
+    p = sub.add_parser("work", help="Run cells from a sweep.")
+    p.add_argument("dir", help="The shared queue directory.")
+    p.add_argument("--db", help="Also add results to this SQLite database.")
+
+    p = sub.add_parser("run", help=("Coordinate a sweep, with some workers "
+                                    "on this host."))
+    p.add_argument("dir", help="The shared queue directory.")
+    p.add_argument("spec", help="A JSON file describing the sweep.")
+    p.add_argument("-j", "--workers", type=int, default=2,
+                   help="How many local workers to start.  (Default: 2)")
+    p.add_argument("--db", help="Also add results to this SQLite database.")
+    p.add_argument("--timeout", type=float, default=HEARTBEAT_TIMEOUT,
+                   help=("Seconds without a heartbeat before a worker's cell "
+                         "is reassigned.  (Default: %(default)s)"))
+
+    args = parser.parse_args(argv)
+
+    if args.command == "work":
+        work(args.dir, args.db)
+        return
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+
+    workers = []
+    if args.command == "run":
+        # Make sure the queue exists, and isn't left over from a finished
+        # sweep, before the workers look at it.
+        SweepQueue(args.dir).clearDone()
+        for _ in xrange(args.workers):
+            proc = Process(target=work, args=(args.dir, args.db))
+            proc.start()
+            workers.append(proc)
+
+    merged = serve(args.dir, spec, timeout=args.timeout)
+    print("Results written to %s" % merged)
+
+    for proc in workers:
+        proc.join()
+
+if __name__ == '__main__':
+    main()
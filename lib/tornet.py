@@ -8,26 +8,72 @@
    259, and some of its likely variants.
 """
 
+import binascii
+import math
 import random
 
-from math import floor
-
 from py3hax import *
+import bandwidth
+import events
+import simtime
+
+
+# Where nodes created without a bandwidth get one from.
+_DEFAULT_BANDWIDTH_MODEL = bandwidth.GammaModel()
+
+# The fraction of relays that allow exits, the fraction that declare a
+# family, and how many families there are.
+EXIT_FRACTION = 0.3
+FAMILY_FRACTION = 0.2
+N_FAMILIES = 50
+
+# How many seconds a client waits for a connection to a relay that isn't
+# answering before giving up on it.
+CONNECT_TIMEOUT = 10.0
+
+# The fraction of the time every node is running.  (Node ignores its
+# 'reliability' argument in favour of this.)
+NODE_RELIABILITY = 0.999
+
+# What a Network has by default: the fraction of its nodes that are evil,
+# and the mean numbers of nodes each churn adds and removes.
+PEVIL = 0.5
+AVGNEW = 1.5
+AVGDEL = 0.5
+
+# What the network decorators do by default: the chance that a
+# FlakyNetwork lets a connection through, that an EvilFilteringNetwork
+# blocks one to a good node, and that a SniperNetwork kills a good node
+# after a connection to it.
+FLAKY_RELIABILITY = 0.9
+P_BLOCK_GOOD = 1.0
+P_KILL_GOOD = 1.0
 
 
-def compareNodeBandwidth(this, other):
-    if this.bandwidth < other.bandwidth: return -1
-    elif this.bandwidth > other.bandwidth: return 1
-    else: return 0
+def meanChurnKills(avgdel):
+    """Return how many nodes Network.do_churn() kills on average, on a
+       network created with 'avgdel'."""
+    # do_churn() kills int(X + 0.5) nodes, for X drawn from an exponential
+    # distribution.  That's k nodes or more with probability
+    # exp(-lambda * (k - 0.5)), so on average:
+    lam = 1.0 / avgdel
+    return math.exp(-lam / 2.0) / (1.0 - math.exp(-lam))
 
 
 class Node(object):
-    def __init__(self, name, port, evil=False, reliability=0.96):
-        """Create a new Tor node."""
+    def __init__(self, name, port, evil=False, reliability=0.96, index=0,
+                 bandwidth=None, rng=random):
+        """Create a new Tor node.  Its bandwidth (in KB/s) is 'bandwidth',
+           or drawn from the default bandwidth model if that's None.  Its ID
+           is drawn using the random number generator 'rng'."""
 
         # name for this node.
         self._name = name
 
+        # small integer, unique within this node's network, used to find
+        # this node in consensus membership bitsets.
+        self._index = index
+
         # What port does this node expose?
         assert 1 <= port <= 65535
         self._port = port
@@ -36,7 +82,7 @@ class Node(object):
         self._evil = evil
 
         # How much of the time is this node running?
-        self._reliability = 0.999
+        self._reliability = NODE_RELIABILITY
 
         # True if this node is running
         self._up = True
@@ -44,21 +90,25 @@ class Node(object):
         # True if this node has been killed permanently
         self._dead = False
 
+        # Where this node is in its Network's list of live nodes, or -1 if
+        # it isn't in one.
+        self._slot = -1
+
         # random hex string.
-        self._id = "".join(random.choice("0123456789ABCDEF") for _ in xrange(40))
+        self._id = "".join(rng.choice("0123456789ABCDEF") for _ in xrange(40))
 
-        # Some completely made up number for the bandwidth of this guard.
-        self._bandwidth = 0
+        # The bandwidth of this guard in KB/s, as drawn from a
+        # bandwidth.BandwidthModel, and what it is now after any drift.
+        if bandwidth is None:
+            bandwidth = _DEFAULT_BANDWIDTH_MODEL.sample(1, rng)[0]
+        self._baseBandwidth = bandwidth
+        self._bandwidth = bandwidth
 
     @property
-    def bandwidth(self, alpha=1.0, beta=0.5, bandwidth_max=100000):
-        """Completely make-believe bandwith.  It's calculated as a random point
-        on the probability density function of a gamma distribution over
-        (0,100000] in KB/s.
+    def bandwidth(self):
+        """This node's current bandwidth in KB/s, as the consensus reports
+        it.
         """
-        if not self._bandwidth:
-            self._bandwidth = \
-                int(floor(random.gammavariate(alpha, beta) * bandwidth_max))
         return self._bandwidth
 
     def getName(self):
@@ -69,15 +119,43 @@ class Node(object):
         """Return the hex id for this node"""
         return self._id
 
-    def updateRunning(self):
+    def getIndex(self):
+        """Return the integer index of this node within its network."""
+        return self._index
+
+    # A node's exit flag, family and subnet are derived from its (random)
+    # ID, so they cost no extra random draws and every process that knows
+    # the ID agrees on them.
+
+    def isExit(self):
+        """Return true iff this node allows exit connections."""
+        return int(self._id[0:2], 16) < EXIT_FRACTION * 256
+
+    def getFamily(self):
+        """Return the number of the family this node declares, or None."""
+        if int(self._id[2:4], 16) >= FAMILY_FRACTION * 256:
+            return None
+        return int(self._id[4:6], 16) % N_FAMILIES
+
+    def getSubnet(self):
+        """Return a number identifying the /16 this node's address is in."""
+        return int(self._id[6:9], 16)
+
+    def getLatency(self):
+        """Return how many seconds it takes to connect to this node when
+           it's up: somewhere between 50 and 500 milliseconds."""
+        return 0.05 + 0.45 * int(self._id[9:12], 16) / 4096.0
+
+    def updateRunning(self, rng=random):
         """Enough time has passed that some nodes are no longer running.
-           Update this node randomly to see if it has come up or down."""
+           Update this node randomly (using the random number generator
+           'rng') to see if it has come up or down."""
 
         # XXXX Actually, it should probably take down nodes a while to
         # XXXXX come back up.  I wonder if that matters for us.
 
         if not self._dead:
-            self._up = random.random() < self._reliability
+            self._up = rng.random() < self._reliability
 
     def kill(self):
         """Mark this node as completely off the network, until resurrect
@@ -85,10 +163,10 @@ class Node(object):
         self._dead = True
         self._up = False
 
-    def resurrect(self):
+    def resurrect(self, rng=random):
         """Mark this node as back on the network."""
         self._dead = False
-        self.updateRunning()
+        self.updateRunning(rng)
 
     def getPort(self):
         """Return this node's ORPort"""
@@ -107,17 +185,347 @@ class Node(object):
     def seemsDystopic(self):
         """Return true iff this node seems like one we could use in a
            dystopic world."""
-        return self.getPort() in [80, 443]
+        return self.getPort() in FASCIST_PORTS
+
 
+# The only ports a FascistFirewall lets us connect to.
+FASCIST_PORTS = (80, 443)
 
-def _randport(pfascistfriendly):
+
+def _randport(pfascistfriendly, rng=random):
     """generate and return a random port.  If 'pfascistfriendly' is true,
        return a port in the FascistPortList.  Otherwise return any random
        TCP  port."""
-    if random.random() < pfascistfriendly:
-        return random.choice([80, 443])
+    if rng.random() < pfascistfriendly:
+        return rng.choice([80, 443])
     else:
-        return random.randint(1,65535)
+        return rng.randint(1,65535)
+
+
+def _bitsToInt(bits):
+    """Return the bitset in the little-endian bytearray 'bits' as an int, so
+       we can do set operations on it at C speed."""
+    if not bits:
+        return 0
+    return int(binascii.hexlify(bytes(bits[::-1])), 16)
+
+def _intToBits(value, nbytes):
+    """Return the int 'value' as a little-endian bytearray bitset 'nbytes'
+       long.  The inverse of _bitsToInt()."""
+    if not nbytes:
+        return bytearray()
+    return bytearray(binascii.unhexlify("%0*x" % (2 * nbytes, value)))[::-1]
+
+def _testBit(bits, idx):
+    byte = idx >> 3
+    return byte < len(bits) and bool(bits[byte] & (1 << (idx & 7)))
+
+def _popcount(value):
+    """Return the number of bits set in the int 'value'."""
+    return bin(value).count("1")
+
+# _hashIndex() returns values in [0, _HASH_RANGE).
+_HASH_RANGE = 1 << 64
+_MASK64 = _HASH_RANGE - 1
+
+def _hashIndex(seed, idx):
+    """Return a 64-bit number that looks random, but depends only on the
+       ints 'seed' and 'idx'.  (This is the splitmix64 finalizer, which is
+       much cheaper than seeding a random.Random.)"""
+    x = (seed * 0x9E3779B97F4A7C15 + idx + 1) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+class _FilteredGuardList(object):
+    """The guards of a consensus that are (or, if 'wanted' is false, aren't)
+       in a bitset, highest bandwidth first.  We know how many there are
+       straight from the bitset, and only work out which they are when
+       someone looks at them."""
+    def __init__(self, consensus, bits, wanted, length):
+        self._consensus = consensus
+        self._bits = bits
+        self._wanted = wanted
+        self._length = length
+        self._guards = None
+
+    def _get(self):
+        if self._guards is None:
+            bits = self._bits
+            wanted = self._wanted
+            self._guards = tuple(
+                node for node in self._consensus.getGuards()
+                if _testBit(bits, node.getIndex()) == wanted)
+        return self._guards
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __getitem__(self, i):
+        return self._get()[i]
+
+
+class Consensus(object):
+    """An immutable snapshot of the running guard nodes, as published at
+       one point in time.  Many clients can share a single instance.
+
+       The guards are already split into utopic and dystopic lists, each
+       sorted from highest bandwidth to lowest, so clients don't each need
+       to redo that work.  Membership is kept as a bitset over node indices,
+       so checking whether a node is listed costs the same however large
+       the network has become.
+    """
+    def __init__(self, generation, utopic, dystopic, nIndices, guards=None):
+        """Create a consensus numbered 'generation'.  'utopic' and 'dystopic'
+           are the already-sorted guard lists, and every node in them has an
+           index less than 'nIndices'.  'guards', if given, is both lists
+           together, also sorted.  Most callers want fromNodes()."""
+        self._generation = generation
+        self._utopic = tuple(utopic)
+        self._dystopic = tuple(dystopic)
+        # every guard, highest bandwidth first; see getGuards().
+        self._all = tuple(guards) if guards is not None else None
+        # the membership bitset as an int; see getMembershipInt().
+        self._membersInt = None
+
+        members = bytearray((nIndices + 7) >> 3)
+        for lst in (self._utopic, self._dystopic):
+            for node in lst:
+                idx = node.getIndex()
+                members[idx >> 3] |= 1 << (idx & 7)
+        self._members = members
+
+    @classmethod
+    def fromNodes(cls, generation, nodes, nIndices):
+        """Create a consensus numbered 'generation' listing 'nodes'."""
+        # Sort the nodes from highest bandwidth to lowest, as they are at
+        # the time of this consensus.  (Bandwidths can drift later.)
+        guards = sorted(nodes, key=lambda node: node.bandwidth, reverse=True)
+
+        utopic = []
+        dystopic = []
+        for node in guards:
+            if node.seemsDystopic():
+                dystopic.append(node)
+            else:
+                # XXXX Having this be 'else' means that FirewallPorts
+                # XXXX has affect even when FascistFirewall is disabled.
+                # XXXX Interesting!  And maybe bad!
+                utopic.append(node)
+
+        return cls(generation, utopic, dystopic, nIndices, guards)
+
+    def __iter__(self):
+        for node in self._utopic:
+            yield node
+        for node in self._dystopic:
+            yield node
+
+    def __len__(self):
+        return len(self._utopic) + len(self._dystopic)
+
+    def getGeneration(self):
+        """Return the sequence number of this consensus; later consensuses
+           have higher numbers."""
+        return self._generation
+
+    def getUtopicGuards(self):
+        """Return a tuple of the listed guards that don't seem dystopic,
+           highest bandwidth first."""
+        return self._utopic
+
+    def getDystopicGuards(self):
+        """Return a tuple of the listed guards that seem dystopic, highest
+           bandwidth first."""
+        return self._dystopic
+
+    def getGuards(self):
+        """Return a tuple of all the listed guards, highest bandwidth
+           first."""
+        if self._all is None:
+            # Only consensuses built without fromNodes() get here.
+            self._all = tuple(sorted(self, key=lambda node: node.bandwidth,
+                                     reverse=True))
+        return self._all
+
+    def getMembership(self):
+        """Return the set of listed node indices, as a little-endian
+           bytearray bitset.  Don't modify it."""
+        return self._members
+
+    def getMembershipInt(self):
+        """Return the set of listed node indices, as a bitset in an int."""
+        if self._membersInt is None:
+            self._membersInt = _bitsToInt(self._members)
+        return self._membersInt
+
+    def getNBytes(self):
+        """Return the length of our membership bitset, in bytes."""
+        return len(self._members)
+
+    def isListed(self, node):
+        """Return true iff 'node' is listed in this consensus."""
+        return _testBit(self._members, node.getIndex())
+
+
+class ReachabilityPolicy(object):
+    """Which relays a client's firewall lets it connect to: those on the
+       ports it allows, less any it blocks outright.
+
+       The client is configured to know about its firewall, so the
+       firewall decides which guards are utopic and which dystopic.  A
+       policy with no firewall leaves the consensus split the usual way,
+       by FASCIST_PORTS.
+
+       We precompute the answer for every relay as a bitset over node
+       indices, so checking a connection is a bit test, and splitting a
+       consensus is a bitwise AND.  Clients with the same firewall share
+       one policy, so the number of clients in a population makes no
+       difference to how much work that is.  A policy's bitset covers the
+       nodes of one network, so each network needs its own policies.
+    """
+    def __init__(self, ports=None, blockedIDs=()):
+        """Allow connections to relays on any port in 'ports' (or on any port
+           at all if it's None), except to the relays whose IDs are in
+           'blockedIDs'."""
+        self._ports = frozenset(ports) if ports is not None else None
+        self._blockedIDs = frozenset(blockedIDs)
+        self._hasFirewall = ports is not None or bool(self._blockedIDs)
+
+        # bit N of _bits is set iff our firewall allows the node with index
+        # N, for all N less than self._covered.
+        self._bits = bytearray()
+        self._covered = 0
+        self._bitsInt = None
+
+        # (generation, (utopic, dystopic)) for the last consensus we split.
+        self._partition = (None, None)
+
+    def allows(self, node):
+        """Work out from scratch whether our firewall lets us reach 'node'."""
+        if self._ports is not None and node.getPort() not in self._ports:
+            return False
+        return node.getID() not in self._blockedIDs
+
+    def update(self, network):
+        """Work out whether we can reach every node that 'network' has added
+           since we last looked."""
+        nIndices = network.getNIndices()
+        if nIndices <= self._covered:
+            return
+        self._bits.extend(bytearray(((nIndices + 7) >> 3) - len(self._bits)))
+        for idx in xrange(self._covered, nIndices):
+            node = network.getNodeByIndex(idx)
+            if node is not None and self.allows(node):
+                self._bits[idx >> 3] |= 1 << (idx & 7)
+        self._covered = nIndices
+        self._bitsInt = None
+
+    def canReach(self, node, network):
+        """Return true iff this policy lets us connect to 'node', which is on
+           'network'."""
+        idx = node._index
+        if idx >= self._covered:
+            self.update(network)
+        return bool(self._bits[idx >> 3] & (1 << (idx & 7)))
+
+    def seemsDystopic(self, node, network):
+        """Return true iff we're configured to think 'node', which is on
+           'network', is one we could use in a dystopic world."""
+        if not self._hasFirewall:
+            return node.seemsDystopic()
+        return self.canReach(node, network)
+
+    def partition(self, consensus, network):
+        """Split the guards in 'consensus' into a tuple of (those we can't
+           reach, those we can), each a sequence ordered highest bandwidth
+           first.  These are a client's utopic and dystopic guard lists.
+           The lengths come from a bitwise AND, and the guards in them are
+           only listed when a client first looks.  We remember the answer
+           for the most recent consensus, so clients sharing a policy share
+           the work."""
+        if not self._hasFirewall:
+            return (consensus.getUtopicGuards(), consensus.getDystopicGuards())
+
+        generation, result = self._partition
+        if generation == consensus.getGeneration():
+            return result
+
+        self.update(network)
+        if self._bitsInt is None:
+            self._bitsInt = _bitsToInt(self._bits)
+        reachableInt = consensus.getMembershipInt() & self._bitsInt
+        reachable = _intToBits(reachableInt, consensus.getNBytes())
+        nReachable = _popcount(reachableInt)
+
+        result = (_FilteredGuardList(consensus, reachable, False,
+                                     len(consensus) - nReachable),
+                  _FilteredGuardList(consensus, reachable, True, nReachable))
+        self._partition = (consensus.getGeneration(), result)
+        return result
+
+
+class MiddleboxPolicy(object):
+    """A client's ReachabilityPolicy, behind a filtering middlebox that
+       drops connections to a fraction of relays.
+
+       The client knows nothing about the middlebox, which only makes
+       connections fail: a guard it drops is still one the client expects
+       to reach, so the firewall alone splits the consensus.  Every client
+       has its own middlebox, but only a bitset of the relays it drops,
+       each picked by hashing the middlebox's seed with the relay's index.
+       The firewall's bitset and partitions stay shared.
+    """
+    def __init__(self, firewall, pFiltered, seed=0):
+        """Drop connections to a fraction 'pFiltered' of the relays that
+           the ReachabilityPolicy 'firewall' allows, chosen at random (but
+           always the same way for a given 'seed')."""
+        self._firewall = firewall
+        self._threshold = int(pFiltered * _HASH_RANGE)
+        self._seed = seed
+
+        # bit N of _dropped is set iff our middlebox drops the node with
+        # index N, for all N less than self._covered.
+        self._dropped = bytearray()
+        self._covered = 0
+
+    def drops(self, node):
+        """Return true iff our middlebox drops connections to 'node'."""
+        return _hashIndex(self._seed, node.getIndex()) < self._threshold
+
+    def update(self, network):
+        """Work out which of the nodes that 'network' has added since we
+           last looked our middlebox drops."""
+        nIndices = network.getNIndices()
+        if nIndices <= self._covered:
+            return
+        dropped = self._dropped
+        dropped.extend(bytearray(((nIndices + 7) >> 3) - len(dropped)))
+        seed, threshold = self._seed, self._threshold
+        for idx in xrange(self._covered, nIndices):
+            if _hashIndex(seed, idx) < threshold:
+                dropped[idx >> 3] |= 1 << (idx & 7)
+        self._covered = nIndices
+
+    def canReach(self, node, network):
+        """Return true iff this policy lets us connect to 'node', which is on
+           'network'."""
+        idx = node._index
+        if idx >= self._covered:
+            self.update(network)
+        if self._dropped[idx >> 3] & (1 << (idx & 7)):
+            return False
+        return self._firewall.canReach(node, network)
+
+    def seemsDystopic(self, node, network):
+        return self._firewall.seemsDystopic(node, network)
+
+    def partition(self, consensus, network):
+        return self._firewall.partition(consensus, network)
 
 
 class Network(object):
@@ -129,71 +537,259 @@ class Network(object):
        In this simulation, we ignore bandwidth, and consider every
        node to be a guard.  This shouldn't affect the algorithm.
     """
-    def __init__(self, num_nodes, pfascistfriendly=.3, pevil=0.5,
-                 avgnew=1.5, avgdel=0.5):
+    def __init__(self, num_nodes, pfascistfriendly=.3, pevil=PEVIL,
+                 avgnew=AVGNEW, avgdel=AVGDEL, eventLog=None,
+                 bandwidthModel=None, bandwidthDrift=0.0, sim=None):
 
         """Create a new network with 'num_nodes' randomly generated nodes.
            Each node should be fascist-friendly with probability
            'pfascistfriendly'.  Each node should be evil with
            probability 'pevil'.  Every time the network churns,
            'avgnew' nodes should be added on average, and 'avgdel'
-           deleted on average.
+           deleted on average.  If 'eventLog' is an events.EventWriter,
+           churn and nodes going up and down are recorded there.
+
+           Nodes' bandwidths are drawn from the bandwidth.BandwidthModel
+           'bandwidthModel' (by default, a GammaModel).  If
+           'bandwidthDrift' is nonzero, they drift with every consensus
+           (see bandwidth.drift()), by about that much in log space.
+
+           The network, and everything that uses it, keeps time and draws
+           random numbers using the simtime.Simulation 'sim' (by default,
+           simtime.DEFAULT).
         """
+        self._sim = sim if sim is not None else simtime.DEFAULT
+        rng = self._rng = self._sim.rng
+
         self._pfascistfriendly = pfascistfriendly
         self._pevil = pevil
-
-        # a list of all the Nodes on the network, dead and alive.
-        self._wholenet = [ Node("node%d"%n,
-                                port=_randport(pfascistfriendly),
-                                evil=random.random() < pevil)
-                           for n in xrange(num_nodes) ]
+        self._events = eventLog
+        self._bandwidthModel = bandwidthModel or _DEFAULT_BANDWIDTH_MODEL
+        self._bandwidthDrift = bandwidthDrift
+
+        # a list of all the Nodes on the network that haven't been killed,
+        # in no particular order.  Each node knows its place in the list
+        # (Node._slot), so that we can take it out in O(1) when it dies.
+        self._wholenet = []
+        # a map from Node.getID() to Node, so that clients can find the
+        # relays named in their saved state.
+        self._nodesByID = {}
+        # and the same, keyed by Node.getIndex().
+        self._nodesByIndex = {}
+
+        bandwidths = self._bandwidthModel.sample(num_nodes, rng)
+        for n in xrange(num_nodes):
+            self._addNode(Node("node%d"%n,
+                               port=_randport(pfascistfriendly, rng),
+                               evil=rng.random() < pevil,
+                               index=n,
+                               bandwidth=bandwidths[n],
+                               rng=rng))
         for node in self._wholenet:
-            node.updateRunning()
+            node.updateRunning(rng)
 
         # lambda parameters for our exponential distributions.
         self._lamdbaAdd = 1.0 / avgnew
         self._lamdbaDel = 1.0 / avgdel
+        self._avgdel = avgdel
 
-        # total number of nodes ever added on the network.
+        # total number of nodes ever added on the network.  This is also
+        # the index the next new node will get.
         self._total = num_nodes
 
+        # number of consensuses we've made so far.
+        self._generation = 0
+
+        # the most recently published Consensus, which every client shares.
+        self._consensus = None
+
     def new_consensus(self):
-        """Return a list of the running guard nodes."""
-        return [ node for node in self._wholenet if node.isReallyUp() ]
+        """Return a new Consensus listing the running guard nodes."""
+        self._generation += 1
+        return Consensus.fromNodes(
+            self._generation,
+            [ node for node in self._wholenet if node.isReallyUp() ],
+            self._total)
+
+    def publish_consensus(self):
+        """Make a new consensus and publish it to every client.  Call this
+           once per (simulated) hour."""
+        if self._bandwidthDrift and self._consensus is not None:
+            self.driftBandwidths()
+        self._consensus = self.new_consensus()
+        return self._consensus
+
+    def warmStart(self):
+        """Put the network straight into the state it would settle into
+           after running for a long time, instead of the state of a network
+           whose nodes were all just created.
+
+           Which nodes are running is already drawn from its stationary
+           distribution (every node is up with its own reliability,
+           independently of the past), and so are the nodes' base
+           bandwidths; if bandwidths drift, we draw where they've drifted
+           to from the stationary distribution of the drift.  Clients'
+           guards that died in the past are made with makeGhost().
+        """
+        if self._bandwidthDrift:
+            nodes = self._wholenet
+            new = bandwidth.stationary(
+                [ node._baseBandwidth for node in nodes ],
+                self._bandwidthDrift, rng=self._rng)
+            for node, bw in zip(nodes, new):
+                node._bandwidth = bw
+        # Any consensus we made was of the network as it was.
+        self._consensus = None
+
+    def deathRate(self, churnInterval):
+        """Return the rate, per simulated second, at which each node on the
+           network dies of churn, if do_churn() is called every
+           'churnInterval' seconds."""
+        if not self._wholenet:
+            return 0.0
+        return (meanChurnKills(self._avgdel) / churnInterval /
+                len(self._wholenet))
+
+    def makeGhost(self, node):
+        """Return a new Node like 'node', which died before the simulation
+           started, so was never on the network.  It has an index of its
+           own, but no other node refers to it."""
+        n = self._total
+        self._total += 1
+        ghost = Node("node%d"%n, port=node.getPort(),
+                     evil=node.isReallyEvil(), index=n,
+                     bandwidth=node.bandwidth, rng=self._rng)
+        ghost.kill()
+        return ghost
+
+    def driftBandwidths(self):
+        """Move every node's bandwidth a step along its random walk."""
+        nodes = self._wholenet
+        new = bandwidth.drift([ node._bandwidth for node in nodes ],
+                              [ node._baseBandwidth for node in nodes ],
+                              self._bandwidthDrift, rng=self._rng)
+        for node, bw in zip(nodes, new):
+            node._bandwidth = bw
+
+    def get_consensus(self):
+        """Return the most recently published Consensus, publishing one
+           first if there isn't one yet."""
+        if self._consensus is None:
+            self.publish_consensus()
+        return self._consensus
+
+    def getSimulation(self):
+        """Return the simtime.Simulation this network is part of."""
+        return self._sim
+
+    def getNodes(self):
+        """Return a sequence of all the Nodes on the network, running or
+           not.  Nodes that have been killed are no longer on it."""
+        return self._wholenet
+
+    def getNode(self, nodeID):
+        """Return the Node whose ID is 'nodeID', or None if there isn't
+           one (any more)."""
+        return self._nodesByID.get(nodeID)
+
+    def getNodeByIndex(self, idx):
+        """Return the Node whose index is 'idx', or None if there isn't
+           one (any more)."""
+        return self._nodesByIndex.get(idx)
+
+    def getNIndices(self):
+        """Return one more than the highest node index used so far."""
+        return self._total
+
+    def _addNode(self, node):
+        """Put the new Node 'node' on the network."""
+        node._slot = len(self._wholenet)
+        self._wholenet.append(node)
+        self._nodesByID[node.getID()] = node
+        self._nodesByIndex[node.getIndex()] = node
+
+    def _retireNode(self, node):
+        """Take the killed Node 'node' off the network, in O(1): move the
+           last live node into its slot, and forget it.  Once no client
+           refers to it any more, it can be freed."""
+        slot = node._slot
+        if slot < 0:
+            return
+        last = self._wholenet.pop()
+        if last is not node:
+            self._wholenet[slot] = last
+            last._slot = slot
+        node._slot = -1
+        del self._nodesByID[node.getID()]
+        del self._nodesByIndex[node.getIndex()]
 
     def do_churn(self):
-        """Simulate churn: delete and add nodes from/to the network."""
-        nAdd = int(random.expovariate(self._lamdbaAdd) + 0.5)
-        nDel = int(random.expovariate(self._lamdbaDel) + 0.5)
-
-        # kill nDel non-dead nodes at random.
-        random.shuffle(self._wholenet)
-        nkilled = 0
-        for node in self._wholenet:
-            if nkilled == nDel:
-                break
-            if not node._dead:
-                node.kill()
-                nkilled += 1
+        """Simulate churn: delete and add nodes from/to the network.  This
+           takes time proportional to the number of nodes churned, not to
+           the size of the network."""
+        rng = self._rng
+        nAdd = int(rng.expovariate(self._lamdbaAdd) + 0.5)
+        nDel = int(rng.expovariate(self._lamdbaDel) + 0.5)
+
+        # kill nDel live nodes at random.
+        alive = self._wholenet
+        for _ in xrange(min(nDel, len(alive))):
+            node = alive[rng.randrange(len(alive))]
+            node.kill()
+            self._retireNode(node)
+            if self._events is not None:
+                self._events.record(events.CHURN_KILLED, node.getIndex())
 
         # add nAdd new nodes.
-        for n in xrange(self._total, self._total+nAdd):
+        bandwidths = self._bandwidthModel.sample(nAdd, rng)
+        for bw in bandwidths:
+            n = self._total
             node = Node("node%d"%n,
-                        port=_randport(self._pfascistfriendly),
-                        evil=random.random() < self._pevil)
+                        port=_randport(self._pfascistfriendly, rng),
+                        evil=rng.random() < self._pevil,
+                        index=n,
+                        bandwidth=bw,
+                        rng=rng)
+            self._addNode(node)
             self._total += 1
+            if self._events is not None:
+                self._events.record(events.CHURN_ADDED, n)
 
     def updateRunning(self):
         """Enough time has passed for some nodes to go down and some to come
            up."""
+        rng = self._rng
+        if self._events is None:
+            for node in self._wholenet:
+                node.updateRunning(rng)
+            return
+
         for node in self._wholenet:
-            node.updateRunning()
+            wasUp = node._up
+            node.updateRunning(rng)
+            if node._up != wasUp:
+                self._events.record(events.LIVENESS, node.getIndex(), node._up)
 
     def probe_node_is_up(self, node):
         """Called when a simulated client is trying to connect to 'node'.
            Returns true iff the connection succeeds."""
         return node.isReallyUp()
 
+    def kill_node(self, node):
+        """Called when an attacker takes 'node' off the network."""
+        node.kill()
+        self._retireNode(node)
+
+    def connect_latency(self, node):
+        """Return how many seconds a successful connection to 'node'
+           takes."""
+        return node.getLatency()
+
+    def connect_timeout(self):
+        """Return how many seconds a client waits for a connection that
+           isn't going to succeed."""
+        return CONNECT_TIMEOUT
+
 
 class _NetworkDecorator(object):
     """Decorator class for Network: wraps a network and implements all its
@@ -202,60 +798,129 @@ class _NetworkDecorator(object):
 
     def __init__(self, network):
         self._network = network
+        # the random number generator of the simulation we're part of.
+        self._rng = network.getSimulation().rng
+
+    def getSimulation(self):
+        return self._network.getSimulation()
 
     def new_consensus(self):
         return self._network.new_consensus()
 
+    def publish_consensus(self):
+        return self._network.publish_consensus()
+
+    def get_consensus(self):
+        return self._network.get_consensus()
+
+    def getNodes(self):
+        return self._network.getNodes()
+
+    def getNode(self, nodeID):
+        return self._network.getNode(nodeID)
+
+    def getNodeByIndex(self, idx):
+        return self._network.getNodeByIndex(idx)
+
+    def getNIndices(self):
+        return self._network.getNIndices()
+
     def do_churn(self):
         self._network.do_churn()
 
     def probe_node_is_up(self, node):
         return self._network.probe_node_is_up(node)
 
+    def kill_node(self, node):
+        self._network.kill_node(node)
+
     def updateRunning(self):
         self._network.updateRunning()
 
+    def connect_latency(self, node):
+        return self._network.connect_latency(node)
+
+    def connect_timeout(self):
+        return self._network.connect_timeout()
+
+    def deathRate(self, churnInterval):
+        return self._network.deathRate(churnInterval)
+
+    def makeGhost(self, node):
+        return self._network.makeGhost(node)
+
 class FascistNetwork(_NetworkDecorator):
     """Network that blocks all connections except those to ports 80, 443"""
     def probe_node_is_up(self, node):
-        return (node.getPort() in [80,443] and
+        return (node.getPort() in FASCIST_PORTS and
+                self._network.probe_node_is_up(node))
+
+class PolicyNetwork(_NetworkDecorator):
+    """Network that only lets a client connect to the relays its
+       ReachabilityPolicy or MiddleboxPolicy allows."""
+    def __init__(self, network, policy):
+        super(PolicyNetwork, self).__init__(network)
+        self._policy = policy
+
+    def probe_node_is_up(self, node):
+        return (self._policy.canReach(node, self._network) and
                 self._network.probe_node_is_up(node))
 
 class EvilFilteringNetwork(_NetworkDecorator):
     """Network that blocks connections to non-evil nodes with P=pBlockGood"""
-    def __init__(self, network, pBlockGood=1.0):
+    def __init__(self, network, pBlockGood=P_BLOCK_GOOD):
         super(EvilFilteringNetwork, self).__init__(network)
         self._pblock = pBlockGood
 
     def probe_node_is_up(self, node):
         if not node.isReallyEvil():
-            if random.random() < self._pblock:
+            if self._rng.random() < self._pblock:
                 return False
         return self._network.probe_node_is_up(node)
 
 class SniperNetwork(_NetworkDecorator):
     """Network that does a DoS attack on a client's non-evil nodes with
        P=pKillGood after each connection."""
-    def __init__(self, network, pKillGood=1.0):
+    def __init__(self, network, pKillGood=P_KILL_GOOD):
         super(SniperNetwork, self).__init__(network)
         self._pkill = pKillGood
 
     def probe_node_is_up(self, node):
         result = self._network.probe_node_is_up(node)
 
-        if not node.isReallyEvil() and random.random() < self._pkill:
-            node.kill()
+        if not node.isReallyEvil() and self._rng.random() < self._pkill:
+            self._network.kill_node(node)
 
         return result
 
 class FlakyNetwork(_NetworkDecorator):
     """A network where all connections succeed only with probability
        'reliability', regardless of whether the node is up or down."""
-    def __init__(self, network, reliability=0.9):
+    def __init__(self, network, reliability=FLAKY_RELIABILITY):
         super(FlakyNetwork, self).__init__(network)
         self._reliability = reliability
 
     def probe_node_is_up(self, node):
-        if random.random() >= self._reliability:
+        if self._rng.random() >= self._reliability:
             return False
         return self._network.probe_node_is_up(node)
+
+class DeferredKillNetwork(_NetworkDecorator):
+    """Network that only records the nodes its clients kill, so they can be
+       killed all at once, at the end of a tick.  A population running in
+       one process uses this to see the same network its clients would if
+       they were split across workers (see shared.SharedNetworkView)."""
+    def __init__(self, network):
+        super(DeferredKillNetwork, self).__init__(network)
+        # indices of the nodes killed since the last takeKills().
+        self._kills = set()
+
+    def kill_node(self, node):
+        self._kills.add(node.getIndex())
+
+    def takeKills(self):
+        """Return a sorted list of the indices of the nodes killed since the
+           last call, and forget them."""
+        kills = sorted(self._kills)
+        self._kills.clear()
+        return kills
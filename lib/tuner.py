@@ -0,0 +1,287 @@
+#!/usr/bin/python
+# This is distributed under cc0. See the LICENCE file distributed along with
+# this code.
+
+"""Search the client.ClientParams space for parameters that do well on a
+   weighted objective, using successive halving.
+
+   We sample a batch of random candidates and run each of them once on
+   every scenario.  Then we keep the best 1/eta of them, run those with
+   eta times as many seeds, and so on until one candidate is left.  Most
+   of the compute goes to the candidates that look promising, and
+   candidates that are obviously bad are dropped after a single run.
+
+   A candidate's score is the weighted sum of the means of its summary
+   metrics (see scenario.runScenario()) across all scenarios and seeds;
+   higher is better, so metrics we want to be small get negative weights.
+
+   Every run's result is cached in a JSON-lines file, keyed by scenario,
+   parameters, seed and length, so later rungs (which reuse the earlier
+   rungs' seeds) and later tuning sessions never redo a simulation.
+
+   The search uses the "scenarios" and "hours" of a sweep spec (see
+   sweep.py), plus two optional keys: "base", the ClientParams keywords
+   every candidate starts from (default: {"PROP259": true}), and "space",
+   which replaces the default space for the base's proposal (see
+   defaultSpace()).  For example:
+
+       ./lib/tuner.py SPEC -n 27 -j 4 --cache tuner-cache.jsonl
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import os
+import random
+
+from multiprocessing import Pool
+
+from py3hax import *
+import replicate
+
+
+# For each ClientParams keyword we tune: its lowest and highest values, and
+# whether to sample it as an "int", a "float", or on a log scale ("log" or
+# "logint").  TOO_MANY_GUARDS and the GUARDLIST_FAILOVER_THRESHOLDs aren't
+# here, since client.Client doesn't look at them yet.
+DEFAULT_SPACE = {
+    "RETRY_DELAY": (5, 600, "logint"),
+    "RETRY_MULT": (1.0, 4.0, "float"),
+}
+
+# The keywords only one proposal's client looks at, and their ranges.
+PROPOSAL_SPACES = {
+    "PROP241": { "N_PRIMARY_GUARDS": (1, 10, "int") },
+    "PROP259": { "UTOPIC_GUARDS_THRESHOLD": (0.001, 0.05, "log") },
+}
+
+
+def defaultSpace(base):
+    """Return the space to tune candidates that start from the ClientParams
+       keywords 'base' in: DEFAULT_SPACE, plus whatever the proposal 'base'
+       follows looks at."""
+    space = dict(DEFAULT_SPACE)
+    for prop in sorted(PROPOSAL_SPACES):
+        if base.get(prop):
+            space.update(PROPOSAL_SPACES[prop])
+    return space
+
+# How much each metric counts towards a candidate's score.
+DEFAULT_WEIGHTS = {
+    "success_rate": 1.0,
+    # one hour to bootstrap costs as much as 10% of circuits failing.
+    "bootstrap_time": -0.1 / 3600,
+    "evil_circuit_fraction": -0.5,
+    "guards_added": -0.01,
+}
+
+
+def sampleParams(space, rng):
+    """Return a dict with a random value for every parameter in 'space',
+       drawn using the random.Random 'rng'."""
+    params = {}
+    for name in sorted(space):
+        low, high, kind = space[name]
+        if kind == "int":
+            value = rng.randint(int(low), int(high))
+        elif kind == "float":
+            value = rng.uniform(low, high)
+        elif kind in ("log", "logint"):
+            value = math.exp(rng.uniform(math.log(low), math.log(high)))
+            if kind == "logint":
+                value = int(round(value))
+        else:
+            raise ValueError("Unknown kind of parameter %r" % kind)
+        if isinstance(value, float):
+            # Four significant figures is plenty, and keeps cache keys tidy.
+            value = float("%.4g" % value)
+        params[name] = value
+    return params
+
+
+class ResultCache(object):
+    """Results of scenario.runScenario(), remembered in memory and, if we
+       were given a path, in a JSON-lines file there."""
+
+    def __init__(self, path=None):
+        self._path = path
+        self._results = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._results[entry["key"]] = entry["result"]
+
+    @staticmethod
+    def key(scen, params, seed, hours):
+        return json.dumps([scen, params, seed, hours], sort_keys=True)
+
+    def get(self, key):
+        return self._results.get(key)
+
+    def put(self, key, result):
+        self._results[key] = result
+        if self._path:
+            with open(self._path, "a") as f:
+                f.write(json.dumps({"key": key, "result": result},
+                                   sort_keys=True) + "\n")
+
+
+class Tuner(object):
+    """Successive halving over a ClientParams space."""
+
+    def __init__(self, scenarios, base=None, space=None, weights=None,
+                 hours=30, cache=None, pool=None, seed=0):
+        """'scenarios' is a dict mapping names to scenario dicts.  'base' is
+           the ClientParams keywords shared by all candidates.  If 'pool' is
+           a multiprocessing.Pool, simulations run in it."""
+        self._scenarios = scenarios
+        self._base = base if base is not None else {"PROP259": True}
+        self._space = space if space is not None else defaultSpace(self._base)
+        self._weights = weights if weights is not None else DEFAULT_WEIGHTS
+        self._hours = hours
+        self._cache = cache if cache is not None else ResultCache()
+        self._pool = pool
+        self._rng = random.Random(seed)
+
+    def _fullParams(self, candidate):
+        params = dict(self._base)
+        params.update(candidate)
+        return params
+
+    def evaluate(self, candidates, nSeeds):
+        """Return a list of the scores of 'candidates', each run with seeds
+           0..nSeeds-1 on every scenario."""
+        jobs = []
+        queued = set()
+        for candidate in candidates:
+            params = self._fullParams(candidate)
+            for scen in self._scenarios.values():
+                for seed in xrange(nSeeds):
+                    key = ResultCache.key(scen, params, seed, self._hours)
+                    if not self._isCached(key) and key not in queued:
+                        queued.add(key)
+                        jobs.append((key, scen, params, seed, self._hours))
+        for key, result in replicate._runJobs(jobs, self._pool):
+            self._cache.put(key, result)
+
+        scores = []
+        for candidate in candidates:
+            params = self._fullParams(candidate)
+            results = [ self._cache.get(ResultCache.key(scen, params, seed,
+                                                        self._hours))
+                        for scen in self._scenarios.values()
+                        for seed in xrange(nSeeds) ]
+            scores.append(self.score(results))
+        return scores
+
+    def _isCached(self, key):
+        """Return true iff the cache has a result for 'key' with every
+           metric we weigh.  (Results cached by older code may lack some.)"""
+        result = self._cache.get(key)
+        return (result is not None and
+                all(metric in result for metric in self._weights))
+
+    def score(self, results):
+        """Return the weighted objective for a list of result dicts.  A
+           metric that some results have no value for (like
+           time_to_first_evil) is averaged over the rest, and left out if
+           none of them have one."""
+        total = 0.0
+        for metric, weight in self._weights.items():
+            values = [ r[metric] for r in results if r[metric] is not None ]
+            if values:
+                total += weight * sum(values) / float(len(values))
+        return total
+
+    def run(self, nCandidates=27, eta=3, minSeeds=1, progress=None):
+        """Run successive halving, starting from 'nCandidates' random
+           candidates with 'minSeeds' seeds each.  If given, 'progress' is
+           called with each rung's number of seeds and ranked list of
+           (score, candidate) pairs.  Return the best (score, candidate)."""
+        if eta < 2:
+            raise ValueError("eta must be at least 2, not %r" % eta)
+        candidates = [ sampleParams(self._space, self._rng)
+                       for _ in xrange(nCandidates) ]
+        nSeeds = minSeeds
+        while True:
+            scores = self.evaluate(candidates, nSeeds)
+            ranked = sorted(zip(scores, candidates),
+                            key=lambda sc: sc[0], reverse=True)
+            if progress is not None:
+                progress(nSeeds, ranked)
+            if len(ranked) == 1:
+                return ranked[0]
+            ranked = ranked[:max(1, len(ranked) // eta)]
+            candidates = [ candidate for _, candidate in ranked ]
+            nSeeds *= eta
+
+
+def _printRung(nSeeds, ranked):
+    print("%d candidates with %d seeds each:" % (len(ranked), nSeeds))
+    for score, candidate in ranked[:5]:
+        print("  %10.5f  %s" % (score, json.dumps(candidate, sort_keys=True)))
+
+
+def _atLeastTwo(value):
+    n = int(value)
+    if n < 2:
+        raise argparse.ArgumentTypeError("must be at least 2")
+    return n
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Tune ClientParams by successive halving.")
+    parser.add_argument("spec", help="A JSON file describing the scenarios.")
+    parser.add_argument(
+        "-n", "--candidates", type=int, default=27,
+        help=("How many random candidates to start with.  "
+              "(Default: %(default)s)"))
+    parser.add_argument(
+        "--eta", type=_atLeastTwo, default=3,
+        help=("Keep 1/ETA of the candidates after each rung, and give them "
+              "ETA times as many seeds.  (Default: %(default)s)"))
+    parser.add_argument(
+        "-w", "--weight", action="append", default=[], metavar="METRIC=WEIGHT",
+        help="Override the weight of METRIC in the objective.")
+    parser.add_argument(
+        "--cache", metavar="PATH",
+        help="Cache simulation results in the JSON-lines file PATH.")
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="Seed for sampling candidates.  (Default: %(default)s)")
+    parser.add_argument(
+        "-j", "--workers", type=int, default=0,
+        help="Run simulations in this many worker processes.")
+    args = parser.parse_args(argv)
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+
+    weights = dict(DEFAULT_WEIGHTS)
+    for weight in args.weight:
+        metric, _, value = weight.partition("=")
+        weights[metric] = float(value)
+
+    space = None
+    if "space" in spec:
+        space = dict((name, tuple(v)) for name, v in spec["space"].items())
+
+    pool = Pool(args.workers) if args.workers else None
+    tuner = Tuner(spec["scenarios"], spec.get("base"), space, weights,
+                  spec.get("hours", 30), ResultCache(args.cache), pool,
+                  args.seed)
+    score, best = tuner.run(args.candidates, args.eta, progress=_printRung)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print("Best parameters (score %.5f): %s"
+          % (score, json.dumps(best, sort_keys=True)))
+
+if __name__ == '__main__':
+    main()
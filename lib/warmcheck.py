@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# This is distributed under cc0. See the LICENCE file distributed along with
+# this code.
+
+"""Check how well a warm start (--warm-start) stands in for a burn-in.
+
+   For each seed, we measure the same scenario three ways: starting cold,
+   as every simulation used to; after actually simulating a burn-in; and
+   warm-started as if the burn-in had happened.  Then we compare the
+   means of every metric.  Where the warm start is doing its job, its
+   means agree with the burn-in's, within their confidence intervals,
+   even where the cold start's don't.  (Metrics about guards only count
+   those picked while measuring, so all three are on the same footing.)
+
+   Warm starts only model prop259 clients that lose guards to churn
+   alone (see Client.warmStart()), so only those can be checked.
+
+       ./lib/warmcheck.py --scenario '{"bandwidth_drift": 0.1}' \\
+           --params '{"PROP259": true}' --seeds 20 -j 4
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+
+from multiprocessing import Pool
+
+from py3hax import *
+import replicate
+import scenario
+
+
+# The ways we start each run.
+MODES = ("cold", "warm", "burn-in")
+
+
+def _runMode(job):
+    """Pool entry point: run one seed of one mode, quietly."""
+    mode, scen, params, seed, hours, burnIn = job
+    if mode == "warm":
+        scen = dict(scen, warm_start=burnIn)
+    with scenario.Quiet():
+        return mode, scenario.runScenario(
+            scen, params, seed, hours, burnIn if mode == "burn-in" else 0)
+
+
+def compare(scen, params, seeds=10, hours=10, burnIn=30, pool=None):
+    """Run 'seeds' replicates of each mode, measuring 'hours' hours of the
+       scenario dict 'scen' with the client parameters 'params', after a
+       real or pretend burn-in of 'burnIn' hours.  Return a dict mapping
+       each mode to a dict mapping each metric to its
+       replicate.RunningStats.  Runs with no value for a metric (see
+       scenario.exposureMetrics()) are left out of its statistics."""
+    jobs = [ (mode, scen, params, seed, hours, burnIn)
+             for seed in xrange(seeds) for mode in MODES ]
+    if pool is None:
+        outcomes = [ _runMode(job) for job in jobs ]
+    else:
+        outcomes = pool.imap_unordered(_runMode, jobs)
+
+    stats = dict((mode, {}) for mode in MODES)
+    for mode, metrics in outcomes:
+        for metric, value in metrics.items():
+            s = stats[mode].setdefault(metric, replicate.RunningStats())
+            if value is not None:
+                s.add(value)
+    return stats
+
+
+def agrees(a, b, confidence=0.95):
+    """Return true iff the RunningStats 'a' and 'b' have overlapping
+       confidence intervals on their means, or either is empty."""
+    if not a.count() or not b.count():
+        return True
+    gap = abs(a.mean() - b.mean())
+    return gap <= a.halfWidth(confidence) + b.halfWidth(confidence)
+
+
+def printComparison(stats, confidence=0.95):
+    """Print the dict returned by compare() as a table, flagging metrics on
+       which the warm start and the burn-in disagree."""
+    print("%-22s %22s %22s %22s" % (("metric",) + MODES))
+    nBad = 0
+    for metric in sorted(stats["burn-in"]):
+        cells = []
+        for mode in MODES:
+            s = stats[mode][metric]
+            if not s.count():
+                cells.append("n/a")
+                continue
+            cells.append("%.4g +- %.2g" % (s.mean(), s.halfWidth(confidence)))
+        ok = agrees(stats["warm"][metric], stats["burn-in"][metric],
+                    confidence)
+        if not ok:
+            nBad += 1
+        print("%-22s %22s %22s %22s%s"
+              % ((metric,) + tuple(cells) + ("" if ok else "  DIFFERS",)))
+    print("Warm start disagrees with burn-in on %d of %d metrics"
+          % (nBad, len(stats["burn-in"])))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=("Compare warm-started runs against cold-started and "
+                     "burnt-in runs."))
+    parser.add_argument(
+        "--scenario", default="{}", metavar="JSON",
+        help="The scenario, as a JSON dict.  (Default: %(default)s)")
+    parser.add_argument(
+        "--params", default='{"PROP259": true}', metavar="JSON",
+        help=("The client parameters, as a JSON dict.  "
+              "(Default: %(default)s)"))
+    parser.add_argument(
+        "-s", "--seeds", type=int, default=10,
+        help="Replicates of each kind of run.  (Default: %(default)s)")
+    parser.add_argument(
+        "--hours", type=int, default=10,
+        help="Simulated hours to measure.  (Default: %(default)s)")
+    parser.add_argument(
+        "--burn-in", type=int, default=30,
+        help=("Simulated hours of burn-in, real or pretend.  "
+              "(Default: %(default)s)"))
+    parser.add_argument(
+        "-c", "--confidence", type=float, default=0.95,
+        choices=sorted(replicate.Z_VALUES),
+        help="Confidence level of the intervals.  (Default: %(default)s)")
+    parser.add_argument(
+        "-j", "--workers", type=int, default=0,
+        help="Run replicates in this many worker processes.")
+    args = parser.parse_args(argv)
+
+    scen = json.loads(args.scenario)
+    params = json.loads(args.params)
+    if not params.get("PROP259"):
+        parser.error("Warm starts only model PROP259 clients")
+    conflicts = [ name for name in scenario.WARM_START_CONFLICTS
+                  if scen.get(name) ]
+    if conflicts:
+        parser.error("Warm starts don't model guards lost to %s"
+                     % ", ".join(conflicts))
+
+    pool = Pool(args.workers) if args.workers else None
+    stats = compare(scen, params, args.seeds, args.hours, args.burn_in, pool)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    printComparison(stats, args.confidence)
+
+if __name__ == '__main__':
+    main()